@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# End-to-end benchmarks of the daemon against a fake mpv and a fake trakt API, without network access.
+#
+# The daemon runs unmodified as a subprocess in a temporary directory, with its trakt_api_url pointing to
+# fake_trakt.py and its mpv_ipc_sockets to fake_mpv.py. Benchmarks:
+#     latency    time from a change in mpv (start, pause, resume, seek, quit) to the scrobble arriving at trakt
+#     idle       CPU time of the daemon while mpv plays, extrapolated to one hour
+#     memory     resident memory of the daemon over a long session with many files
+# CPU and memory are read from /proc, so those benchmarks need Linux.
+# The exit status is 1, if a scrobble is missing or a result exceeds its --max-* threshold, e.g. for CI.
+import argparse
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_mpv import FakeMpv
+from fake_trakt import FakeTrakt, TOKEN
+
+REPOSITORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# the trakt action, that a scripted step should cause. Starting a file is followed by 'play' right away and isn't
+# measured on its own.
+EXPECTED_ACTIONS = {'pause': 'pause', 'resume': 'start', 'seek': 'start', 'quit': 'stop'}
+
+
+class Daemon:
+    def __init__(self, work_dir, config_overrides):
+        self.work_dir = work_dir
+        with open(os.path.join(REPOSITORY_DIR, 'config.json')) as file:
+            config = json.load(file)
+        config.update(config_overrides)
+        with open(os.path.join(work_dir, 'config.json'), 'w') as file:
+            json.dump(config, file, indent=2)
+        shutil.copy(os.path.join(REPOSITORY_DIR, 'log.conf'), work_dir)
+        with open(os.path.join(work_dir, 'trakt_token.json'), 'w') as file:
+            json.dump(dict(TOKEN, created_at=int(time.time())), file)
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, os.path.join(REPOSITORY_DIR, 'sync_daemon.py')],
+                                        cwd=self.work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def get_cpu_seconds(self):
+        with open('/proc/%d/stat' % self.process.pid) as file:
+            # the command name in field 2 may contain spaces, the fields after it don't
+            fields = file.read().rsplit(')', 1)[1].split()
+        # utime and stime are fields 14 and 15
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def get_rss_bytes(self):
+        with open('/proc/%d/status' % self.process.pid) as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+
+class Setup:
+    # a fake trakt, a fake mpv and the daemon connected to both
+    def __init__(self, args, config_overrides=None):
+        self.work_dir = tempfile.mkdtemp(prefix='mpv-trakt-bench-')
+        self.fake_trakt = FakeTrakt(latency=args.trakt_latency, jitter=args.trakt_jitter,
+                                    error_rate=args.trakt_error_rate)
+        self.fake_mpv = FakeMpv(os.path.join(self.work_dir, 'mpv-socket'), args.event_rate)
+        config = {
+            'trakt_api_url': self.fake_trakt.url,
+            'mpv_ipc_sockets': [self.fake_mpv.socket_path],
+            'mpv_property_mode': args.property_mode,
+            'seconds_between_mpv_event_and_trakt_sync': args.debounce,
+            'monitored_directories': [],
+            'excluded_directories': [],
+            # short scripted sessions count as finished
+            'factor_must_watch_before_scrobble': 0.0
+        }
+        config.update(config_overrides or {})
+        self.daemon = Daemon(self.work_dir, config)
+
+    def __enter__(self):
+        self.fake_trakt.start()
+        self.fake_mpv.start()
+        self.daemon.start()
+        if not self.fake_mpv.wait_for_client():
+            raise RuntimeError('The daemon did not connect, see %s' % os.path.join(self.work_dir, 'sync_daemon.log'))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.daemon.stop()
+        self.fake_mpv.close()
+        self.fake_trakt.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def wait_for_stop(fake_trakt, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if any(action == 'stop' for _, action, _ in fake_trakt.get_scrobbles()):
+            return
+        time.sleep(0.05)
+
+
+def bench_latency(args):
+    # returns a list of failures, like the other benchmarks
+    script = [('start-file', '/media/tv/Fake Show/Fake.Show.S01E01.720p.mkv', 1200), ('play', 3.0),
+              ('pause', 3.0), ('play', 3.0), ('seek', 95.0), ('play', 3.0), ('quit',)]
+    with Setup(args) as setup:
+        time.sleep(1.0)  # let the daemon subscribe to the properties
+        setup.fake_mpv.run_script(script)
+        # failed scrobbles are retried after up to a few minutes
+        wait_for_stop(setup.fake_trakt, args.debounce + 300.0)
+        scrobbles = setup.fake_trakt.get_scrobbles()
+
+    latencies = []
+    failures = []
+    print('%-12s %-8s %10s' % ('step', 'action', 'latency'))
+    previous_step_name = None
+    for step_time, step in setup.fake_mpv.timeline:
+        step_name = step[0]
+        if step_name == 'play' and previous_step_name == 'pause':
+            step_name = 'resume'
+        previous_step_name = step[0]
+        if step_name not in EXPECTED_ACTIONS:
+            continue
+        action = EXPECTED_ACTIONS[step_name]
+        matches = [arrived_at for arrived_at, scrobble_action, _ in scrobbles
+                   if arrived_at >= step_time and scrobble_action == action]
+        if len(matches) == 0:
+            print('%-12s %-8s %10s' % (step_name, action, 'missing'))
+            failures.append('no scrobble/%s after %s' % (action, step_name))
+            continue
+        latencies.append(matches[0] - step_time)
+        print('%-12s %-8s %9.3fs' % (step_name, action, latencies[-1]))
+        if args.max_latency is not None and latencies[-1] > args.max_latency:
+            failures.append('%s took %.3fs, more than --max-latency %.3fs' % (step_name, latencies[-1],
+                                                                               args.max_latency))
+    if len(latencies) > 0:
+        print('median %.3fs, max %.3fs, debounce %.3fs, %d scrobbles in total' %
+              (statistics.median(latencies), max(latencies), args.debounce, len(scrobbles)))
+    return failures
+
+
+def bench_idle(args):
+    with Setup(args) as setup:
+        setup.fake_mpv.run_script([('start-file', '/media/movies/Fake.Movie.2017.1080p.mkv', 7200),
+                                   ('play', 2.0)])  # let start-up and the first sync finish
+        cpu_start = setup.daemon.get_cpu_seconds()
+        start = time.monotonic()
+        setup.fake_mpv.run_script([('play', args.duration)])
+        cpu_seconds = setup.daemon.get_cpu_seconds() - cpu_start
+        elapsed = time.monotonic() - start
+    cpu_seconds_per_hour = cpu_seconds / elapsed * 3600
+    print('%.1fs of playback at %.0f property changes/s: %.3f CPU seconds, %.1f CPU seconds per hour' %
+          (elapsed, args.event_rate, cpu_seconds, cpu_seconds_per_hour))
+    if args.max_cpu_per_hour is not None and cpu_seconds_per_hour > args.max_cpu_per_hour:
+        return ['%.1f CPU seconds per hour, more than --max-cpu-per-hour %.1f' % (cpu_seconds_per_hour,
+                                                                                  args.max_cpu_per_hour)]
+    return []
+
+
+def bench_memory(args):
+    samples = []
+    with Setup(args) as setup:
+        time.sleep(1.0)
+        end = time.monotonic() + args.duration
+        episode = 0
+        while time.monotonic() < end:
+            episode += 1
+            setup.fake_mpv.run_script([('start-file', '/media/tv/Show %d/Show.%d.S01E%02d.mkv' %
+                                        (episode, episode, episode % 24 + 1), 1500),
+                                       ('play', 0.5), ('seek', 95.0), ('play', 0.5)])
+            samples.append((episode, setup.daemon.get_rss_bytes()))
+    print('%d files played' % episode)
+    for episode, rss in samples[::max(len(samples) // 10, 1)] + samples[-1:]:
+        print('after %5d files: %7.1f MiB' % (episode, rss / 2 ** 20))
+    max_mib = max(rss for _, rss in samples) / 2 ** 20
+    print('max %.1f MiB' % max_mib)
+    if args.max_memory is not None and max_mib > args.max_memory:
+        return ['%.1f MiB resident memory, more than --max-memory %.1f MiB' % (max_mib, args.max_memory)]
+    return []
+
+
+BENCHMARKS = {'latency': bench_latency, 'idle': bench_idle, 'memory': bench_memory}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the daemon against a fake mpv and a fake trakt API.')
+    parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS),
+                        help='benchmarks to run: %s. All by default.' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds of the idle and memory benchmarks')
+    parser.add_argument('--event-rate', type=float, default=30.0, help='percent-pos changes per second in mpv')
+    parser.add_argument('--debounce', type=float, default=1.0,
+                        help='seconds_between_mpv_event_and_trakt_sync of the daemon')
+    parser.add_argument('--property-mode', choices=['observe', 'poll'], default='observe')
+    parser.add_argument('--trakt-latency', type=float, default=0.05)
+    parser.add_argument('--trakt-jitter', type=float, default=0.0)
+    parser.add_argument('--trakt-error-rate', type=float, default=0.0)
+    parser.add_argument('--max-latency', type=float, help='fail if a scrobble takes longer, in seconds')
+    parser.add_argument('--max-cpu-per-hour', type=float, help='fail if the idle daemon uses more CPU seconds per hour')
+    parser.add_argument('--max-memory', type=float, help='fail if the resident memory exceeds this many MiB')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+
+    failures = []
+    for name in args.benchmarks:
+        print('== %s ==' % name)
+        failures.extend('%s: %s' % (name, failure) for failure in BENCHMARKS[name](args))
+    if len(failures) > 0:
+        print('FAILED')
+        for failure in failures:
+            print('  ' + failure)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Micro-benchmark of MpvMonitor's line framing and JSON parsing.
+#
+# Replays a high-rate mpv IPC stream in recv()-sized chunks, through the old string-concatenating framer and
+# through mpv.LineFramer. Without --replay, a stream like the one mpv sends while seeking is generated: many
+# property-change events and log messages with multi-byte characters. To benchmark a real stream, record one with
+#     socat - UNIX-CONNECT:/tmp/mpv-socket > ipc_stream.jsonl
+# and pass it with --replay ipc_stream.jsonl.
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mpv  # noqa: E402
+
+
+def generate_stream(line_count):
+    lines = []
+    position = 0.0
+    for i in range(line_count):
+        position += 0.0417
+        kind = i % 10
+        if kind < 7:
+            message = {'event': 'property-change', 'id': 3, 'name': 'percent-pos', 'data': position % 100}
+        elif kind < 9:
+            message = {'event': 'log-message', 'prefix': 'cplayer', 'level': 'v',
+                       'text': 'Séquence d\'ouverture – 東京 ✓ %d\n' % i}
+        else:
+            message = {'request_id': i, 'error': 'success', 'data': position}
+        lines.append(json.dumps(message, ensure_ascii=False))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def split_into_chunks(stream, chunk_size):
+    # recv() returns arbitrary slices, which also split multi-byte characters
+    random.seed(0)
+    chunks = []
+    position = 0
+    while position < len(stream):
+        size = random.randint(chunk_size // 2, chunk_size)
+        chunks.append(stream[position:position + size])
+        position += size
+    return chunks
+
+
+class LegacyFramer:
+    # MpvMonitor.on_data before LineFramer, decoding errors of split characters are replaced to keep it running
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, data):
+        lines = []
+        self.buffer = self.buffer + data.decode('utf-8', errors='replace')
+        while True:
+            line_end = self.buffer.find('\n')
+            if line_end == -1:
+                break
+            lines.append(self.buffer[:line_end])
+            self.buffer = self.buffer[line_end + 1:]
+        return lines
+
+
+def run(framer, chunks, parse):
+    line_count = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        for line in framer.feed(chunk):
+            parse(line)
+            line_count += 1
+    return line_count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks framing and parsing of mpv IPC streams.')
+    parser.add_argument('--replay', help='recorded mpv IPC stream, one JSON message per line')
+    parser.add_argument('--lines', type=int, default=200000, help='number of generated lines')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[512, 4096, 65536])
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        with open(args.replay, 'rb') as file:
+            stream = file.read()
+    else:
+        stream = generate_stream(args.lines)
+
+    # the legacy framer produces str, LineFramer str with json like MpvMonitor and bytes with orjson
+    setups = [('legacy', LegacyFramer, 'json', json.loads),
+              ('LineFramer', lambda: mpv.LineFramer(decode=True), 'json', json.loads)]
+    if mpv.parse_json is not json.loads:
+        setups += [('legacy', LegacyFramer, 'orjson', mpv.parse_json),
+                   ('LineFramer', mpv.LineFramer, 'orjson', mpv.parse_json)]
+
+    print('%d bytes, %d lines' % (len(stream), stream.count(b'\n')))
+    for chunk_size in args.chunk_sizes:
+        chunks = split_into_chunks(stream, chunk_size)
+        for framer_name, create_framer, parser_name, parse in setups:
+            line_count, seconds = run(create_framer(), chunks, parse)
+            print('chunk %6d  %-10s  %-6s  %8.3fs  %10.0f lines/s' %
+                  (chunk_size, framer_name, parser_name, seconds, line_count / seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Fake mpv, that speaks mpv's JSON IPC protocol on a Unix socket and plays a scripted session.
+#
+# Supports what the daemon uses: get_property, observe_property, property-change events, and the start-file, seek,
+# pause, unpause and end-file events. A script is a list of steps:
+#     ('start-file', path, duration)    load a file, paused at 0%
+#     ('play', seconds)                 play, percent-pos changes event_rate times per second
+#     ('pause', seconds)                pause and wait
+#     ('seek', percent)                 jump to a position
+#     ('quit',)                         close all connections and remove the socket
+# Every step is timestamped in FakeMpv.timeline, so that a harness can relate scrobbles to what caused them.
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+
+# properties mpv reports, when they aren't set by the script
+DEFAULT_PROPERTIES = {'working-directory': '/media', 'path': None, 'percent-pos': None, 'pause': True,
+                      'duration': None}
+
+
+class FakeMpvClient:
+    def __init__(self, connection):
+        self.connection = connection
+        self.observed = {}  # property name -> observe id
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        with self.lock:
+            try:
+                self.connection.sendall(data)
+            except OSError:
+                pass
+
+
+class FakeMpv:
+    def __init__(self, socket_path, event_rate=10.0):
+        self.socket_path = socket_path
+        self.event_rate = event_rate
+        self.properties = dict(DEFAULT_PROPERTIES)
+        self.clients = []
+        self.lock = threading.Lock()
+        self.timeline = []  # (time.time(), step)
+        self.server = None
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen(8)
+        threading.Thread(target=self.accept, name='fake-mpv', daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            client = FakeMpvClient(connection)
+            with self.lock:
+                self.clients.append(client)
+            threading.Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    def wait_for_client(self, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if len(self.clients) > 0:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def serve(self, client):
+        for line in client.connection.makefile('rb'):
+            try:
+                command = json.loads(line)
+            except ValueError:
+                continue
+            self.handle_command(client, command)
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def handle_command(self, client, command):
+        elements = command.get('command', [])
+        response = {'request_id': command.get('request_id', 0), 'error': 'success'}
+        if len(elements) == 2 and elements[0] == 'get_property':
+            with self.lock:
+                value = self.properties.get(elements[1])
+            if value is None:
+                response['error'] = 'property unavailable'
+            else:
+                response['data'] = value
+            client.send(response)
+        elif len(elements) == 3 and elements[0] == 'observe_property':
+            client.observed[elements[2]] = elements[1]
+            client.send(response)
+            with self.lock:
+                value = self.properties.get(elements[2])
+            # like mpv, the current value is pushed right away
+            client.send({'event': 'property-change', 'id': elements[1], 'name': elements[2], 'data': value})
+        else:
+            response['error'] = 'invalid parameter'
+            client.send(response)
+
+    def broadcast(self, message):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.send(message)
+
+    def set_property(self, name, value):
+        with self.lock:
+            self.properties[name] = value
+            clients = list(self.clients)
+        for client in clients:
+            if name in client.observed:
+                client.send({'event': 'property-change', 'id': client.observed[name], 'name': name, 'data': value})
+
+    def run_script(self, script):
+        for step in script:
+            self.timeline.append((time.time(), step))
+            getattr(self, 'do_' + step[0].replace('-', '_'))(*step[1:])
+
+    def do_start_file(self, path, duration):
+        if self.properties['path'] is not None:
+            self.broadcast({'event': 'end-file', 'reason': 'stop'})
+        self.broadcast({'event': 'start-file'})
+        self.set_property('pause', True)
+        self.set_property('path', path)
+        self.set_property('duration', float(duration))
+        self.set_property('percent-pos', 0.0)
+        self.broadcast({'event': 'file-loaded'})
+
+    def do_play(self, seconds):
+        if self.properties['pause']:
+            self.set_property('pause', False)
+            self.broadcast({'event': 'unpause'})
+        interval = 1.0 / self.event_rate
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            time.sleep(min(interval, max(end - time.monotonic(), 0.0)))
+            position = self.properties['percent-pos'] + interval / self.properties['duration'] * 100
+            self.set_property('percent-pos', min(position, 100.0))
+
+    def do_pause(self, seconds):
+        if not self.properties['pause']:
+            self.set_property('pause', True)
+            self.broadcast({'event': 'pause'})
+        time.sleep(seconds)
+
+    def do_seek(self, percent):
+        self.broadcast({'event': 'seek'})
+        self.set_property('percent-pos', float(percent))
+        self.broadcast({'event': 'playback-restart'})
+
+    def do_quit(self):
+        self.broadcast({'event': 'end-file', 'reason': 'quit'})
+        self.close()
+
+    def close(self):
+        with self.lock:
+            clients = list(self.clients)
+            self.clients = []
+        for client in clients:
+            try:
+                client.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.connection.close()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+def create_episode_script(episodes, play_seconds, pause_seconds):
+    # watch episodes with a pause and a seek each, and finish each one
+    script = []
+    for episode in range(1, episodes + 1):
+        script.append(('start-file', '/media/tv/Fake Show/Fake.Show.S01E%02d.720p.mkv' % episode, 1200))
+        script.append(('play', play_seconds))
+        script.append(('pause', pause_seconds))
+        script.append(('seek', 95.0))
+        script.append(('play', play_seconds))
+    script.append(('quit',))
+    return script
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves a scripted fake mpv session on an IPC socket.')
+    parser.add_argument('--socket', default='/tmp/fake-mpv-socket')
+    parser.add_argument('--episodes', type=int, default=3)
+    parser.add_argument('--play-seconds', type=float, default=20.0)
+    parser.add_argument('--pause-seconds', type=float, default=5.0)
+    parser.add_argument('--event-rate', type=float, default=10.0, help='percent-pos changes per second')
+    args = parser.parse_args()
+
+    fake_mpv = FakeMpv(args.socket, args.event_rate)
+    fake_mpv.start()
+    print('Listening on %s, waiting for the daemon to connect' % args.socket)
+    fake_mpv.wait_for_client(timeout=float('inf'))
+    fake_mpv.run_script(create_episode_script(args.episodes, args.play_seconds, args.pause_seconds))
+
+
+if __name__ == '__main__':
+    main()
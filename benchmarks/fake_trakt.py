@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# Local stub of the trakt API endpoints the daemon uses: search, scrobble, sync/history, the watch history and oauth.
+# Successful scrobble/stop requests are added to the watch history.
+#
+# Every request is recorded with the time it was answered in FakeTrakt.requests. latency (plus up to jitter) delays
+# every answer, error_rate answers a random share of requests with 503, and fail_next() lets the next requests fail.
+import argparse
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+TOKEN = {'access_token': 'fake-access-token', 'token_type': 'bearer', 'expires_in': 90 * 24 * 60 * 60,
+         'refresh_token': 'fake-refresh-token', 'scope': 'public', 'created_at': 0}
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + '.%03dZ' % (timestamp % 1 * 1000)
+
+
+class FakeTraktRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like api.trakt.tv
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        fake_trakt = self.server.fake_trakt
+        parts = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length > 0 else None
+        time.sleep(fake_trakt.get_delay())
+        failed = fake_trakt.should_fail()
+        fake_trakt.record(method, parts.path, urllib.parse.parse_qs(parts.query), body, failed)
+        if failed:
+            self.reply(503, {'error': 'injected failure'})
+            return
+
+        if method == 'GET' and parts.path in ('/search/show', '/search/movie'):
+            kind = parts.path.rsplit('/', 1)[1]
+            query = urllib.parse.parse_qs(parts.query).get('query', [''])[0]
+            self.reply(200, [{'type': kind, 'score': 1000.0,
+                              kind: {'title': query, 'year': None, 'ids': {'trakt': fake_trakt.get_id(query)}}}])
+        elif method == 'POST' and parts.path.startswith('/scrobble/'):
+            self.reply(201, dict(body, id=len(fake_trakt.requests), action=parts.path.rsplit('/', 1)[1]))
+        elif method == 'GET' and parts.path == '/sync/last_activities':
+            watched_at = fake_trakt.get_last_watched_at()
+            self.reply(200, {'all': watched_at, 'episodes': {'watched_at': watched_at},
+                             'movies': {'watched_at': watched_at}})
+        elif method == 'GET' and parts.path in ('/sync/history/episodes', '/sync/history/movies'):
+            kind = parts.path.rsplit('/', 1)[1]
+            self.reply(200, fake_trakt.get_history(kind))
+        elif method == 'GET' and parts.path in ('/sync/watched/shows', '/sync/watched/movies'):
+            self.reply(200, fake_trakt.get_watched(parts.path.rsplit('/', 1)[1]))
+        elif method == 'POST' and parts.path == '/sync/history':
+            self.reply(201, {'added': {'movies': len(body.get('movies', [])), 'episodes': 0}})
+        elif method == 'POST' and parts.path in ('/oauth/token', '/oauth/device/token'):
+            self.reply(200, dict(TOKEN, created_at=int(time.time())))
+        elif method == 'POST' and parts.path == '/oauth/device/code':
+            self.reply(200, {'device_code': 'fake', 'user_code': 'FAKE', 'verification_url': 'http://localhost/',
+                             'expires_in': 600, 'interval': 1})
+        else:
+            self.reply(404, {'error': 'not found'})
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTraktServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the daemon closing its kept-alive connections isn't an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeTrakt:
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = []  # (time.time(), method, path, query, body, failed)
+        self.ids = {}
+        self.failures_left = 0
+        self.lock = threading.Lock()
+        self.server = FakeTraktServer(('127.0.0.1', port), FakeTraktRequestHandler)
+        self.server.fake_trakt = self
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-trakt', daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, method, path, query, body, failed):
+        with self.lock:
+            self.requests.append((time.time(), method, path, query, body, failed))
+
+    def get_delay(self):
+        return self.latency + random.uniform(0.0, self.jitter)
+
+    def fail_next(self, count):
+        with self.lock:
+            self.failures_left = count
+
+    def should_fail(self):
+        with self.lock:
+            if self.failures_left > 0:
+                self.failures_left -= 1
+                return True
+        return random.random() < self.error_rate
+
+    def get_id(self, title):
+        with self.lock:
+            return self.ids.setdefault(title.lower(), len(self.ids) + 1)
+
+    def get_history(self, kind):
+        # GET /sync/history/<kind> of the successful stop scrobbles, newest first. Not paginated.
+        history = []
+        with self.lock:
+            for history_id, (answered_at, method, path, _, body, failed) in enumerate(self.requests):
+                if path != '/scrobble/stop' or failed or (kind == 'movies') != ('movie' in body):
+                    continue
+                entry = {'id': history_id + 1, 'action': 'scrobble', 'watched_at': format_time(answered_at)}
+                if 'movie' in body:
+                    entry.update(type='movie', movie=body['movie'])
+                else:
+                    entry.update(type='episode', show=body['show'], episode=body['episode'])
+                history.append(entry)
+        history.reverse()
+        return history
+
+    def get_watched(self, kind):
+        # GET /sync/watched/<kind>, summed up from the history
+        if kind == 'movies':
+            movies = {}
+            for entry in self.get_history('movies'):
+                movie = movies.setdefault(entry['movie']['ids']['trakt'], {
+                    'plays': 0, 'last_watched_at': entry['watched_at'], 'movie': entry['movie']})
+                movie['plays'] += 1
+            return list(movies.values())
+        shows = {}
+        for entry in self.get_history('episodes'):
+            show = shows.setdefault(entry['show']['ids']['trakt'], {'show': entry['show'], 'seasons': {}})
+            season = show['seasons'].setdefault(entry['episode']['season'], {})
+            episode = season.setdefault(entry['episode']['number'], {
+                'number': entry['episode']['number'], 'plays': 0, 'last_watched_at': entry['watched_at']})
+            episode['plays'] += 1
+        return [{'show': show['show'],
+                 'seasons': [{'number': number, 'episodes': list(episodes.values())}
+                             for number, episodes in show['seasons'].items()]}
+                for show in shows.values()]
+
+    def get_last_watched_at(self):
+        history = self.get_history('episodes') + self.get_history('movies')
+        return max([entry['watched_at'] for entry in history] + [format_time(0)])
+
+    def get_scrobbles(self):
+        # successful scrobbles as [(time.time(), action, progress)]
+        with self.lock:
+            return [(answered_at, path.rsplit('/', 1)[1], body.get('progress'))
+                    for answered_at, method, path, _, body, failed in self.requests
+                    if path.startswith('/scrobble/') and not failed]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves a local stub of the trakt API.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every answer is delayed')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds of random extra delay')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    args = parser.parse_args()
+
+    fake_trakt = FakeTrakt(args.port, args.latency, args.jitter, args.error_rate)
+    print('Serving fake trakt API on %s. Set "trakt_api_url" in config.json to use it.' % fake_trakt.url)
+    fake_trakt.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import collections
+import copy
+import difflib
+import json
+
+import log_pipeline
+
+NUMBER = (int, float)
+
+Option = collections.namedtuple('Option', ['types', 'default', 'item_types', 'choices', 'minimum', 'reloadable'])
+
+
+def option(types, default, item_types=None, choices=None, minimum=None, reloadable=True):
+    # item_types: types of the entries of a list or the values of an object
+    # reloadable: if false, a changed value only takes effect after a restart, e.g. because it sizes a thread pool
+    return Option(types, default, item_types, choices, minimum, reloadable)
+
+
+# All options of config.json with their defaults, in the order of the README
+OPTIONS = collections.OrderedDict([
+    ('monitored_directories', option(list, [], item_types=str)),
+    ('excluded_directories', option(list, ['https://www.youtube.com/'], item_types=str)),
+    ('mpv_ipc_sockets', option(list, [], item_types=str)),
+    ('mpv_ipc_transport', option(str, 'threads', choices=('threads', 'asyncio'), reloadable=False)),
+    ('mpv_property_mode', option(str, 'observe', choices=('observe', 'poll'), reloadable=False)),
+    ('seconds_between_mpv_running_checks', option(NUMBER, 30.0, minimum=0)),
+    ('seconds_between_mpv_event_and_trakt_sync', option(NUMBER, 10.0, minimum=0)),
+    ('seconds_between_regular_get_property_commands', option(NUMBER, 30.0, minimum=0)),
+    ('min_seconds_between_trakt_syncs', option(NUMBER, 3.0, minimum=0)),
+    ('trakt_request_timeout_seconds', option(NUMBER, 10.0, minimum=0)),
+    ('trakt_max_retries', option(int, 3, minimum=0)),
+    ('trakt_id_cache_days', option(NUMBER, 90.0, minimum=0, reloadable=False)),
+    ('trakt_id_cache_not_found_hours', option(NUMBER, 24.0, minimum=0, reloadable=False)),
+    ('trakt_id_cache_max_entries', option(int, 10000, minimum=1, reloadable=False)),
+    ('prefetch_workers', option(int, 4, minimum=1)),
+    ('prefetch_requests_per_second', option(NUMBER, 3.0, minimum=0)),
+    ('scrobble_sinks', option(list, [], item_types=dict, reloadable=False)),
+    ('scrobble_sink_workers', option(int, 4, minimum=1, reloadable=False)),
+    ('watch_history_sync_minutes', option(NUMBER, 60.0, minimum=0)),
+    ('scrobble_rewatches', option(bool, True)),
+    ('trakt_api_url', option(str, 'https://api.trakt.tv')),
+    ('metrics_port', option(int, 0, minimum=0, reloadable=False)),
+    ('metrics_address', option(str, '127.0.0.1', reloadable=False)),
+    ('metrics_allow_profiling', option(bool, False, reloadable=False)),
+    ('log_sample_rates', option(dict, log_pipeline.DEFAULT_SAMPLE_RATES, item_types=int)),
+    ('factor_must_watch_before_scrobble', option(NUMBER, 0.1, minimum=0)),
+    ('percent_minimal_playback_position_before_scrobble', option(NUMBER, 90.0, minimum=0)),
+])
+
+# keys of the entries of scrobble_sinks, the arguments of scrobble_sinks.create_sink()
+SINK_KEYS = collections.OrderedDict([
+    ('type', str),
+    ('name', str),
+    ('url', str),
+    ('headers', dict),
+    ('timeout_seconds', NUMBER),
+])
+SINK_TYPES = ('http_json',)  # of scrobble_sinks.SINK_TYPES
+
+# the validated config.json, with defaults for missing options. Accessed as config.monitored_directories etc.
+Config = collections.namedtuple('Config', OPTIONS.keys())
+
+
+class ConfigError(Exception):
+    pass
+
+
+def has_type(value, types):
+    # bool is a subclass of int, but true isn't a number of seconds
+    if isinstance(value, bool) and types is not bool:
+        return False
+    return isinstance(value, types)
+
+
+def get_type_name(types):
+    names = {bool: 'a boolean', int: 'an integer', NUMBER: 'a number', str: 'a string', list: 'a list',
+             dict: 'an object'}
+    return names[types]
+
+
+def check_option(name, value):
+    # returns a list of problems of the value of option name
+    option_spec = OPTIONS[name]
+    if not has_type(value, option_spec.types):
+        return ['%s must be %s, not %s' % (name, get_type_name(option_spec.types), json.dumps(value))]
+    problems = []
+    if option_spec.choices is not None and value not in option_spec.choices:
+        problems.append('%s must be one of %s, not %s' % (name, ', '.join(json.dumps(choice)
+                                                                          for choice in option_spec.choices),
+                                                          json.dumps(value)))
+    if option_spec.minimum is not None and value < option_spec.minimum:
+        problems.append('%s must be at least %s, not %s' % (name, option_spec.minimum, value))
+    if option_spec.item_types is not None:
+        items = value.values() if isinstance(value, dict) else value
+        for item in items:
+            if not has_type(item, option_spec.item_types):
+                problems.append('entries of %s must be %s, not %s' % (name, get_type_name(option_spec.item_types),
+                                                                       json.dumps(item)))
+    return problems
+
+
+def get_unknown_problem(problem, name, known_names):
+    # problem is e.g. 'unknown option %s', a close match of name is suggested
+    suggestions = difflib.get_close_matches(name, known_names, n=1)
+    if len(suggestions) > 0:
+        return '%s, did you mean %s?' % (problem % name, suggestions[0])
+    return problem % name
+
+
+def check_sink(sink):
+    # returns a list of problems of an entry of scrobble_sinks
+    problems = []
+    for key, value in sink.items():
+        if key not in SINK_KEYS:
+            problems.append(get_unknown_problem('unknown key %s in an entry of scrobble_sinks', key,
+                                                SINK_KEYS.keys()))
+        elif not has_type(value, SINK_KEYS[key]):
+            problems.append('%s of scrobble_sinks entries must be %s, not %s' % (key, get_type_name(SINK_KEYS[key]),
+                                                                                 json.dumps(value)))
+    if 'url' not in sink:
+        problems.append('every entry of scrobble_sinks needs a url: %s' % json.dumps(sink))
+    if isinstance(sink.get('type'), str) and sink['type'] not in SINK_TYPES:
+        problems.append('type of scrobble_sinks entries must be one of %s, not %s' % (
+            ', '.join(json.dumps(sink_type) for sink_type in SINK_TYPES), json.dumps(sink['type'])))
+    if has_type(sink.get('timeout_seconds'), NUMBER) and sink['timeout_seconds'] < 0:
+        problems.append('timeout_seconds of scrobble_sinks entries must be at least 0, not %s' %
+                        sink['timeout_seconds'])
+    return problems
+
+
+def parse(values):
+    # Returns a Config of the dict values. Raises ConfigError listing all problems, e.g. misspelled options.
+    if not isinstance(values, dict):
+        raise ConfigError('config.json must contain an object')
+    problems = []
+    for name in values:
+        if name not in OPTIONS:
+            problems.append(get_unknown_problem('unknown option %s', name, OPTIONS.keys()))
+        else:
+            problems.extend(check_option(name, values[name]))
+    for sink in values.get('scrobble_sinks', []) if isinstance(values.get('scrobble_sinks'), list) else []:
+        if isinstance(sink, dict):
+            problems.extend(check_sink(sink))
+    if len(problems) > 0:
+        raise ConfigError('\n'.join(problems))
+    return Config(**{name: values[name] if name in values else copy.deepcopy(option_spec.default)
+                     for name, option_spec in OPTIONS.items()})
+
+
+def get_restart_options(old_config, new_config):
+    # names of the options that changed, but only take effect after a restart
+    return [name for name, option_spec in OPTIONS.items()
+            if not option_spec.reloadable and getattr(old_config, name) != getattr(new_config, name)]
+
+
+def load(path):
+    # Raises ConfigError if path isn't valid JSON or one of the options is invalid, and OSError if it can't be read
+    with open(path) as file:
+        try:
+            values = json.load(file)
+        except ValueError as e:
+            raise ConfigError('%s is not valid JSON: %s' % (path, e))
+    return parse(values)
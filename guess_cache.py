@@ -0,0 +1,140 @@
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger('mpvTraktSync')
+
+VIDEO_EXTENSIONS = {'.3gp', '.avi', '.divx', '.flv', '.m2ts', '.m4v', '.mkv', '.mov', '.mp4', '.mpeg', '.mpg', '.ogm',
+                    '.ogv', '.ts', '.webm', '.wmv'}
+
+# guessit keys needed for scrobbling
+GUESS_KEYS = ('type', 'title', 'year', 'season', 'episode', 'episode_title')
+
+
+def get_scrobble_guess(guess):
+    # the part of the guessit result that is needed for scrobbling, in a form that can be stored as JSON
+    return {key: guess[key] for key in GUESS_KEYS if key in guess}
+
+
+def get_mtime(path):
+    # None for URLs and files that can't be accessed
+    try:
+        return os.stat(path).st_mtime
+    except (OSError, ValueError):
+        return None
+
+
+# Memoizes guessit results, which are by far the most CPU-expensive part of a sync.
+# Recent results are kept in an LRU dict. Results of local files are also kept in a SQLite index keyed by path and
+# modification time, which can be filled ahead of playback with index_directories().
+class GuessCache:
+    def __init__(self, index_path, max_size=256):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.recent_guesses = collections.OrderedDict()
+
+        self.index = sqlite3.connect(index_path, check_same_thread=False)
+        self.index.execute('PRAGMA journal_mode=WAL')
+        with self.index:
+            self.index.execute('CREATE TABLE IF NOT EXISTS guesses ('
+                               'path TEXT PRIMARY KEY, '
+                               'mtime REAL NOT NULL, '
+                               'guess TEXT NOT NULL, '
+                               'indexed_at REAL NOT NULL)')
+
+    def warm_up(self):
+        # guessit compiles its rules on first use, which takes about a second
+        self.parse('Warm.Up.S01E01.720p.mkv')
+
+    def parse(self, path):
+        # guessit and its dependencies take a while to import, so it happens on the first parse, in warm_up()
+        import guessit
+
+        start = time.perf_counter()
+        guess = get_scrobble_guess(guessit.guessit(path))
+        seconds = time.perf_counter() - start
+        metrics.guessit_parse_seconds.observe(seconds)
+        log.debug('guessit(%s) took %.3fs', path, seconds)
+        return guess
+
+    def guess(self, path):
+        mtime = get_mtime(path)
+        key = (path, mtime)
+        with self.lock:
+            guess = self.recent_guesses.get(key)
+            if guess is not None:
+                self.recent_guesses.move_to_end(key)
+                metrics.guess_cache_lookups_total.inc('memory')
+                return dict(guess)
+            if mtime is not None:
+                row = self.index.execute('SELECT guess FROM guesses WHERE path = ? AND mtime = ?',
+                                         (path, mtime)).fetchone()
+                if row is not None:
+                    guess = json.loads(row[0])
+
+        if guess is not None:
+            metrics.guess_cache_lookups_total.inc('index')
+        else:
+            metrics.guess_cache_lookups_total.inc('parsed')
+            guess = self.parse(path)
+            if mtime is not None:
+                self.store(path, mtime, guess)
+
+        with self.lock:
+            self.recent_guesses[key] = guess
+            self.recent_guesses.move_to_end(key)
+            if len(self.recent_guesses) > self.max_size:
+                self.recent_guesses.popitem(last=False)
+        return dict(guess)
+
+    def store(self, path, mtime, guess):
+        with self.lock, self.index:
+            self.index.execute('INSERT OR REPLACE INTO guesses VALUES (?, ?, ?, ?)',
+                               (path, mtime, json.dumps(guess), time.time()))
+
+    def is_indexed(self, path, mtime):
+        with self.lock:
+            return self.index.execute('SELECT 1 FROM guesses WHERE path = ? AND mtime = ?',
+                                      (path, mtime)).fetchone() is not None
+
+    def get_indexed_guesses(self):
+        # [(path, guess)] of all indexed files
+        with self.lock:
+            rows = self.index.execute('SELECT path, guess FROM guesses').fetchall()
+        return [(path, json.loads(guess)) for path, guess in rows]
+
+    def index_directories(self, directories, is_included=lambda path: True):
+        # Parses all video files below directories, which aren't indexed with their current mtime yet.
+        # Returns (number of parsed files, number of skipped files)
+        parsed = 0
+        skipped = 0
+        for directory in directories:
+            if not os.path.isdir(directory):
+                # monitored_directories may contain URLs
+                continue
+            for root, _, file_names in os.walk(directory):
+                for file_name in file_names:
+                    if os.path.splitext(file_name)[1].lower() not in VIDEO_EXTENSIONS:
+                        continue
+                    path = os.path.join(root, file_name)
+                    mtime = get_mtime(path)
+                    if mtime is None or not is_included(path):
+                        continue
+                    if self.is_indexed(path, mtime):
+                        skipped += 1
+                        continue
+                    self.store(path, mtime, self.parse(path))
+                    parsed += 1
+                    if parsed % 100 == 0:
+                        log.info('Indexed %d files', parsed)
+        return parsed, skipped
+
+    def close(self):
+        with self.lock:
+            self.index.close()
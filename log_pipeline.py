@@ -0,0 +1,106 @@
+import atexit
+import copy
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# high-rate debug messages of the mpv IPC, e.g. every property change. Sampled by SamplingFilter.
+IPC_LOGGER = 'mpvTraktSync.ipc'
+
+DEFAULT_SAMPLE_RATES = {IPC_LOGGER: 10}
+
+listener = None
+listener_lock = threading.Lock()
+
+
+# Formats records as one JSON object per line, e.g. for log shippers or jq
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + '.%03d' % record.msecs,
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=repr)
+
+
+# Keeps only every n-th DEBUG record of a logger and its children, configured as {logger name: n}.
+# Other levels always pass.
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = {}
+        self.counters = {}
+        self.configure(rates or {})
+
+    def configure(self, rates):
+        self.rates = dict(rates)
+        # next() of itertools.count is atomic, the filter runs in all logging threads
+        self.counters = {name: itertools.count() for name in self.rates}
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG:
+            return True
+        name = record.name
+        while True:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return rate <= 1 or next(self.counters[name]) % rate == 0
+            if '.' not in name:
+                return True
+            name = name.rsplit('.', 1)[0]
+
+
+# Hands records to the listener thread unformatted. Formatting, e.g. of a parsed mpv JSON message, happens in the
+# listener, so the arguments of log calls must not be changed after logging them.
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info:
+            # the traceback has to be rendered before its frames change
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+sampling_filter = SamplingFilter(DEFAULT_SAMPLE_RATES)
+
+
+def make_non_blocking(logger):
+    # Moves the handlers of logger, e.g. from log.conf, to a listener thread. Logging calls then only enqueue the
+    # record, instead of waiting for the file and stdout writes.
+    global listener
+    with listener_lock:
+        if listener is not None:
+            return
+        handlers = list(logger.handlers)
+        record_queue = queue.SimpleQueue()
+        queue_handler = LazyQueueHandler(record_queue)
+        queue_handler.addFilter(sampling_filter)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        listener = logging.handlers.QueueListener(record_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        # before logging's own shutdown at exit, which would close the handlers while records are queued
+        atexit.register(shutdown)
+
+
+def shutdown():
+    # writes the queued records and closes the handlers
+    global listener
+    with listener_lock:
+        if listener is not None:
+            listener.stop()
+            listener = None
+    logging.shutdown()
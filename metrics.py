@@ -0,0 +1,314 @@
+import bisect
+import io
+import logging
+import sys
+import threading
+import time
+import urllib.parse
+
+log = logging.getLogger('mpvTraktSync')
+
+# upper bounds in seconds, from IPC round trips in the sub-millisecond range up to retried trakt requests
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   300.0)
+
+# number of lines in profiling and allocation reports
+REPORT_LINES = 40
+
+# The profiling modules and http.server are imported where they're used, so a daemon without metrics_port doesn't
+# pay for importing them at start-up.
+
+
+def format_labels(label_names, label_values):
+    if len(label_names) == 0:
+        return ''
+    pairs = []
+    for name, value in zip(label_names, label_values):
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append('%s="%s"' % (name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> count
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s counter' % self.name]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, format_labels(self.label_names, label_values),
+                                          format_value(value)))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> [bucket counts..., sum]
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # one count per bucket, one for +Inf and the sum
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, *label_values):
+        return Timer(self, label_values)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        label_names = self.label_names + ('le',)
+        with self.lock:
+            for label_values, counts in sorted(self.values.items()):
+                cumulative_count = 0
+                for upper_bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative_count += count
+                    lines.append('%s_bucket%s %d' % (self.name,
+                                                     format_labels(label_names,
+                                                                   label_values + (format_value(upper_bound),)),
+                                                     cumulative_count))
+                labels = format_labels(self.label_names, label_values)
+                lines.append('%s_sum%s %s' % (self.name, labels, format_value(counts[-1])))
+                lines.append('%s_count%s %d' % (self.name, labels, cumulative_count))
+        return lines
+
+
+class Timer:
+    # with histogram.time(...): observes the duration of the block
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.add(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help_text, label_names, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+mpv_ipc_round_trip_seconds = registry.histogram(
+    'mpv_ipc_round_trip_seconds', 'Time between sending a command to mpv and receiving its response.', ['command'])
+guessit_parse_seconds = registry.histogram(
+    'guessit_parse_seconds', 'Time guessit takes to parse a file name.')
+guess_cache_lookups_total = registry.counter(
+    'guess_cache_lookups_total', 'guessit result lookups by where they were found (memory, index or parsed).',
+    ['result'])
+trakt_id_cache_lookups_total = registry.counter(
+    'trakt_id_cache_lookups_total', 'trakt id cache lookups by result (hit, not_found or miss).', ['result'])
+trakt_search_cache_lookups_total = registry.counter(
+    'trakt_search_cache_lookups_total', 'Lookups of cached trakt search results by result (hit or miss).', ['result'])
+trakt_request_seconds = registry.histogram(
+    'trakt_request_seconds', 'Latency of trakt API requests, per attempt.', ['method', 'endpoint'])
+trakt_requests_total = registry.counter(
+    'trakt_requests_total', 'trakt API request attempts by status code, or "error" if no response arrived.',
+    ['method', 'endpoint', 'status'])
+scrobble_debounce_seconds = registry.histogram(
+    'scrobble_debounce_seconds', 'Time between the first mpv state change of a burst and the debounced sync.')
+scrobble_send_delay_seconds = registry.histogram(
+    'scrobble_send_delay_seconds', 'Time between a scrobble decision and its delivery to a sink.', ['sink'])
+
+
+# Since Python 3.12, cProfile is built on sys.monitoring: a profile sees all threads, and only one can be enabled
+PROCESS_WIDE_PROFILE = sys.version_info >= (3, 12)
+
+
+# Optional cProfile profiling of the daemon's entry points.
+# Before Python 3.12, cProfile only sees the thread it was enabled in, so every thread gets its own profile while a
+# call through profiler.call() runs, and the profiles are merged for the report. Since 3.12, a single profile is
+# enabled from start() to stop() instead.
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.profiles = []
+        self.local = threading.local()
+
+    def start(self):
+        with self.lock:
+            if self.enabled and PROCESS_WIDE_PROFILE:
+                self.profiles[0].disable()
+            self.profiles = []
+            self.enabled = True
+            if PROCESS_WIDE_PROFILE:
+                import cProfile
+
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError as e:
+                    # e.g. a debugger or another profiler is active
+                    self.enabled = False
+                    return 'Profiling not possible: %s\n' % e
+                self.profiles.append(profile)
+        return 'profiling\n'
+
+    def stop(self):
+        # Returns the report of the calls since start()
+        with self.lock:
+            if self.enabled and PROCESS_WIDE_PROFILE:
+                self.profiles[0].disable()
+            self.enabled = False
+            profiles = self.profiles
+            self.profiles = []
+        if len(profiles) == 0:
+            return 'No profiled calls\n'
+        import pstats
+
+        output = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=output)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+        return output.getvalue()
+
+    def call(self, function, *args):
+        # profiled calls may be nested, only the outermost enables the profile
+        if not self.enabled or PROCESS_WIDE_PROFILE or getattr(self.local, 'depth', 0) > 0:
+            return function(*args)
+        import cProfile
+
+        profile = getattr(self.local, 'profile', None)
+        with self.lock:
+            if profile is None or profile not in self.profiles:
+                profile = self.local.profile = cProfile.Profile()
+                self.profiles.append(profile)
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiling tool is active. The call must not fail because of profiling.
+            return function(*args)
+        self.local.depth = 1
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            self.local.depth = 0
+
+    def wrap(self, function):
+        return lambda *args: self.call(function, *args)
+
+
+profiler = Profiler()
+
+
+def get_allocation_report():
+    import tracemalloc
+
+    if not tracemalloc.is_tracing():
+        return 'tracemalloc is not running\n'
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ['traced memory: %d bytes, peak %d bytes' % (current, peak)]
+    for statistic in tracemalloc.take_snapshot().statistics('lineno')[:REPORT_LINES]:
+        lines.append(str(statistic))
+    return '\n'.join(lines) + '\n'
+
+
+# Mixed into http.server.BaseHTTPRequestHandler by start_server()
+class MetricsRequestHandler:
+    # GET /metrics in Prometheus text format. With profiling allowed, also:
+    #   /debug/profile/start, /debug/profile/stop    cProfile report of the calls in between
+    #   /debug/tracemalloc/start, /debug/tracemalloc, /debug/tracemalloc/stop    top allocations
+    allow_profiling = False
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/metrics':
+            self.reply(registry.render(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif path.startswith('/debug/') and self.allow_profiling:
+            self.handle_debug(path)
+        else:
+            self.send_error(404)
+
+    def handle_debug(self, path):
+        import tracemalloc
+
+        if path == '/debug/profile/start':
+            self.reply(profiler.start())
+        elif path == '/debug/profile/stop':
+            self.reply(profiler.stop())
+        elif path == '/debug/tracemalloc/start':
+            tracemalloc.start()
+            self.reply('tracing allocations\n')
+        elif path == '/debug/tracemalloc':
+            self.reply(get_allocation_report())
+        elif path == '/debug/tracemalloc/stop':
+            report = get_allocation_report()
+            tracemalloc.stop()
+            self.reply(report)
+        else:
+            self.send_error(404)
+
+    def reply(self, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('metrics: ' + format, *args)
+
+
+def start_server(address, port, allow_profiling=False):
+    import http.server
+
+    handler = type('ConfiguredMetricsRequestHandler', (MetricsRequestHandler, http.server.BaseHTTPRequestHandler),
+                   {'allow_profiling': allow_profiling})
+    server = http.server.ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log.info('Serving metrics on http://%s:%d/metrics', address, server.server_address[1])
+    return server
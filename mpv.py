@@ -1,51 +1,162 @@
+import concurrent.futures
+import glob
 import json
 import logging
 import sys
 import threading
 import queue
+import stat
 import time
 import os
 
+import metrics
+
 log = logging.getLogger('mpvTraktSync')
+ipc_log = logging.getLogger('mpvTraktSync.ipc')  # every message, sampled by log_pipeline
+
+
+try:
+    # optional, see requirements.txt. Parses mpv's messages several times faster than the json module
+    import orjson
+
+    parse_json = orjson.loads
+    DECODE_LINES = False  # orjson parses bytes directly
+except ImportError:
+    parse_json = json.loads
+    # json.loads is faster with str, decoding all complete lines of a read at once is cheaper than each line
+    DECODE_LINES = True
+
+# read sizes of the socket reader adapt between these, depending on how much data mpv sends
+MIN_READ_SIZE = 4096
+MAX_READ_SIZE = 256 * 1024
+
+# commands mpv hasn't answered after this many seconds are dropped
+COMMAND_TIMEOUT_SECONDS = 60.0
+
+
+# Commands written together by send_commands(). Collects their responses, and completes when all arrived.
+class CommandBatch:
+    def __init__(self, commands, on_complete):
+        self.commands = commands
+        self.on_complete = on_complete
+        self.responses = {}  # request_id -> response
+        self.future = concurrent.futures.Future()
+
+    def add_response(self, monitor, response):
+        self.responses[response['request_id']] = response
+        if len(self.responses) < len(self.commands) or self.future.done():
+            return
+        responses = [self.responses[command['request_id']] for command in self.commands]
+        self.future.set_result(responses)
+        if self.on_complete is not None:
+            self.on_complete(monitor, self.commands, responses)
+
+    def fail(self, exception):
+        if not self.future.done():
+            self.future.set_exception(exception)
+
+
+class LineFramer:
+    # Splits a byte stream into lines without copying the buffer for every line.
+    # Lines are only decoded when complete, so a UTF-8 character split between two reads is no problem.
+
+    def __init__(self, decode=False):
+        self.buffer = bytearray()
+        self.scan_start = 0  # the buffer before this doesn't contain \n
+        self.decode = decode
+
+    def feed(self, data):
+        # returns the completed lines without \n, as str if decode is set, bytes otherwise
+        self.buffer += data
+        last_line_end = self.buffer.rfind(b'\n', self.scan_start)
+        if last_line_end == -1:
+            # partial line received
+            self.scan_start = len(self.buffer)
+            return []
+        # one copy of all complete lines, split in C
+        if self.decode:
+            # mpv passes on file names that aren't valid UTF-8, keep their bytes like os.fsdecode() does
+            lines = self.buffer[:last_line_end].decode('utf-8', errors='surrogateescape').split('\n')
+        else:
+            lines = self.buffer[:last_line_end].split(b'\n')
+        # deleting from the front of a bytearray doesn't move the remaining bytes
+        del self.buffer[:last_line_end + 1]
+        self.scan_start = len(self.buffer)
+        return lines
+
+
+def expand_ipc_paths(patterns):
+    # Each pattern is either a path, a glob or a directory containing IPC sockets (one per mpv instance).
+    # Windows named pipes can't be listed, so only plain paths are supported there.
+    paths = []
+    for pattern in patterns:
+        pattern = os.path.expanduser(pattern)
+        if os.name == 'nt':
+            paths.append(pattern)
+        elif os.path.isdir(pattern):
+            for name in sorted(os.listdir(pattern)):
+                path = os.path.join(pattern, name)
+                if is_socket(path):
+                    paths.append(path)
+        elif any(char in pattern for char in '*?['):
+            paths.extend(path for path in sorted(glob.glob(pattern)) if is_socket(path))
+        else:
+            paths.append(pattern)
+    return paths
+
+
+def is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except OSError:
+        return False
 
 
 class MpvMonitor:
     @staticmethod
     def create(on_connected=None, on_event=None, on_command_response=None, on_disconnected=None,
-               mpv_ipc_path='auto-detect'):
+               mpv_ipc_path='auto-detect', use_asyncio=False):
 
         if mpv_ipc_path == 'auto-detect':
-            if os.name == 'posix':
-                config_path = os.path.expanduser('~/.config/mpv/mpv.conf')
-            elif os.name == 'nt':
-                config_path = os.path.expandvars('%APPDATA%\\mpv\\mpv.conf')
-            else:
-                log.critical('Unknown operating system: ' + os.name)
-                sys.exit(11)
-            lines = open(config_path).readlines()
-            for line in lines:
-                stripped_line = line.strip()
-                if stripped_line.startswith('input-ipc-server='):
-                    mpv_ipc_path = stripped_line[stripped_line.index('=') + 1:]
-                    break
-            if mpv_ipc_path == 'auto-detect':
-                log.critical('Could not auto-detect mpv IPC path. '
-                             'Make sure you have a input-ipc-server=<path> entry in your mpv.conf')
-                sys.exit(22)
+            mpv_ipc_path = MpvMonitor.detect_ipc_path()
 
-        if os.name == 'posix':
+        if os.name == 'posix' and use_asyncio:
+            return AsyncPosixMpvMonitor(mpv_ipc_path, on_connected, on_event, on_command_response, on_disconnected)
+        elif os.name == 'posix':
             return PosixMpvMonitor(mpv_ipc_path, on_connected, on_event, on_command_response, on_disconnected)
         elif os.name == 'nt':
+            if use_asyncio:
+                log.warning('asyncio transport is not available for Windows named pipes. Using a thread instead.')
             return WindowsMpvMonitor(mpv_ipc_path, on_connected, on_event, on_command_response, on_disconnected)
         else:
-            log.critical('Unknown operating system: ' + os.name)
+            log.critical('Unknown operating system: %s', os.name)
             sys.exit(11)
 
+    @staticmethod
+    def detect_ipc_path():
+        if os.name == 'posix':
+            config_path = os.path.expanduser('~/.config/mpv/mpv.conf')
+        elif os.name == 'nt':
+            config_path = os.path.expandvars('%APPDATA%\\mpv\\mpv.conf')
+        else:
+            log.critical('Unknown operating system: %s', os.name)
+            sys.exit(11)
+        lines = open(config_path).readlines()
+        for line in lines:
+            stripped_line = line.strip()
+            if stripped_line.startswith('input-ipc-server='):
+                return stripped_line[stripped_line.index('=') + 1:]
+        log.critical('Could not auto-detect mpv IPC path. '
+                     'Make sure you have a input-ipc-server=<path> entry in your mpv.conf')
+        sys.exit(22)
+
     def __init__(self, on_connected, on_event, on_command_response, on_disconnected):
         self.lock = threading.Lock()
-        self.buffer = ''
+        self.framer = LineFramer(decode=DECODE_LINES)
         self.command_counter = 1
         self.sent_commands = {}
+        self.command_sent_at = {}  # request_id -> time.monotonic(), in the order the commands were sent
+        self.batches = {}  # request_id -> CommandBatch
         self.write_queue = queue.Queue()
 
         self.on_connected = on_connected
@@ -57,60 +168,114 @@ class MpvMonitor:
         pass
 
     def write(self, data):
-        log.debug(data)
+        ipc_log.debug('-> %s', data)
         self.write_queue.put(data)
 
     def on_data(self, data):
-        self.buffer = self.buffer + data.decode('utf-8')
-        while True:
-            line_end = self.buffer.find('\n')
-            if line_end == -1:
-                # partial line received
-                # self.on_line() is called in next data batch
-                break
-            else:
-                self.on_line(self.buffer[:line_end])  # doesn't include \n
-                self.buffer = self.buffer[line_end + 1:]  # doesn't include \n
+        for line in self.framer.feed(data):
+            self.on_line(line)
 
     def on_line(self, line):
+        # line is a str or bytes-like object without \n
         try:
-            mpv_json = json.loads(line)
-        except json.JSONDecodeError:
-            log.warning('invalid JSON received. skipping. ' + line)
+            mpv_json = parse_json(line)
+        except ValueError:
+            log.warning('invalid JSON received. skipping. %r', line)
             return
-        log.debug(mpv_json)
+        ipc_log.debug('<- %s', mpv_json)
         if 'event' in mpv_json:
             if self.on_event is not None:
                 self.on_event(self, mpv_json)
         elif 'request_id' in mpv_json:
-            with self.lock:
-                request_id = mpv_json['request_id']
-                if request_id not in self.sent_commands:
-                    log.warning('got response for unsent command request ' + str(mpv_json))
-                else:
-                    if self.on_command_response is not None:
-                        self.on_command_response(self, self.sent_commands[request_id], mpv_json)
-                    del self.sent_commands[request_id]
+            self.on_response(mpv_json)
         else:
-            log.warning('Unknown mpv output: ' + line)
+            log.warning('Unknown mpv output: %r', line)
+
+    def on_response(self, response):
+        with self.lock:
+            request_id = response['request_id']
+            sent_at = self.command_sent_at.pop(request_id, None)
+            command = self.sent_commands.pop(request_id, None)
+            batch = self.batches.pop(request_id, None)
+            if command is None:
+                log.warning('got response for unsent or expired command request %s', response)
+                return
+            metrics.mpv_ipc_round_trip_seconds.observe(time.monotonic() - sent_at, command['command'][0])
+            if batch is None and self.on_command_response is not None:
+                self.on_command_response(self, command, response)
+        if batch is not None:
+            # outside of the lock, so on_complete can send commands
+            batch.add_response(self, response)
 
     def fire_connected(self):
         if self.on_connected is not None:
             self.on_connected(self)
 
     def fire_disconnected(self):
+        self.drop_commands(list(self.command_sent_at), ConnectionError('mpv closed'))
         if self.on_disconnected is not None:
             self.on_disconnected()
 
+    def register_command(self, elements):
+        # expects self.lock to be held. Returns the command, serialized for mpv.
+        command = {'command': elements, 'request_id': self.command_counter}
+        self.sent_commands[self.command_counter] = command
+        self.command_sent_at[self.command_counter] = time.monotonic()
+        self.command_counter += 1
+        return str.encode(json.dumps(command) + '\n')
+
     def send_command(self, elements):
+        self.expire_commands()
+        with self.lock:
+            self.write(self.register_command(elements))
+
+    def send_commands(self, elements_list, on_complete=None):
+        # Writes several commands at once, so they reach mpv in a single write. Returns a concurrent.futures.Future,
+        # which resolves with the list of responses, once all arrived. If on_complete is given, it is called with
+        # (monitor, commands, responses) then, instead of on_command_response for each single response.
+        self.expire_commands()
         with self.lock:
-            command = {'command': elements, 'request_id': self.command_counter}
-            self.sent_commands[self.command_counter] = command
-            self.command_counter += 1
-            self.write(str.encode(json.dumps(command) + '\n'))
+            first_request_id = self.command_counter
+            data = b''.join([self.register_command(elements) for elements in elements_list])
+            request_ids = range(first_request_id, self.command_counter)
+            batch = CommandBatch([self.sent_commands[request_id] for request_id in request_ids], on_complete)
+            for request_id in request_ids:
+                self.batches[request_id] = batch
+            self.write(data)
+        return batch.future
+
+    def expire_commands(self):
+        # drops commands mpv never answered, so that lost responses don't pile up over long runs
+        deadline = time.monotonic() - COMMAND_TIMEOUT_SECONDS
+        with self.lock:
+            expired_request_ids = []
+            for request_id, sent_at in self.command_sent_at.items():
+                if sent_at > deadline:
+                    break
+                expired_request_ids.append(request_id)
+        if len(expired_request_ids) > 0:
+            log.warning('mpv did not answer %d commands within %.0fs', len(expired_request_ids),
+                        COMMAND_TIMEOUT_SECONDS)
+            self.drop_commands(expired_request_ids, TimeoutError('mpv did not answer'))
+
+    def drop_commands(self, request_ids, exception):
+        with self.lock:
+            batches = []
+            for request_id in request_ids:
+                self.command_sent_at.pop(request_id, None)
+                self.sent_commands.pop(request_id, None)
+                batch = self.batches.pop(request_id, None)
+                if batch is not None:
+                    batches.append(batch)
+        for batch in batches:
+            batch.fail(exception)
 
     def send_get_property_command(self, property_name):
-        self.send_command(['get_property', property_name])
+        return self.send_command(['get_property', property_name])
+
+    def send_observe_property_command(self, property_id, property_name):
+        # mpv answers with property-change events carrying property_id, instead of a single response
+        return self.send_command(['observe_property', property_id, property_name])
 
 
 class PosixMpvMonitor(MpvMonitor):
@@ -134,30 +299,147 @@ class PosixMpvMonitor(MpvMonitor):
         self.sock = socket.socket(socket.AF_UNIX)
         self.sock.connect(self.socket_path)
 
-        log.info('POSIX socket connected')
+        log.info('POSIX socket connected: %s', self.socket_path)
         self.fire_connected()
 
+        read_size = MIN_READ_SIZE
         while True:
             r, _, _ = select.select([self.sock], [], [], 1.0)
             if r == [self.sock]:
                 # socket has data to read
-                data = self.sock.recv(512)
+                data = self.sock.recv(read_size)
                 if len(data) == 0:
                     # EOF reached
                     break
                 self.on_data(data)
+                # read more at once while mpv floods the socket, e.g. while seeking
+                if len(data) == read_size:
+                    read_size = min(read_size * 2, MAX_READ_SIZE)
+                elif len(data) < read_size // 4:
+                    read_size = max(read_size // 2, MIN_READ_SIZE)
 
             while not self.write_queue.empty():
                 select.select([], [self.sock], [])  # blocks until self.sock can be written to
-                self.sock.send(self.write_queue.get_nowait())
+                self.sock.sendall(self.write_queue.get_nowait())
+
+            self.expire_commands()
 
-        log.info('POSIX socket closed')
+        log.info('POSIX socket closed: %s', self.socket_path)
         self.sock.close()
         self.sock = None
 
         self.fire_disconnected()
 
 
+class AsyncPosixMpvMonitor(PosixMpvMonitor):
+    # Reads and writes the socket from an asyncio event loop, so a single loop can drive many mpv instances.
+    # run() is a coroutine. Commands are written right away and send_command() returns an asyncio future, which
+    # resolves with mpv's response. on_command_response is still called, if given.
+
+    # asyncio is imported where it's used, so the default threads transport doesn't pay for importing it at start-up.
+
+    # mpv answers e.g. playlist requests with long lines. asyncio's default limit is 64 KiB.
+    LINE_LIMIT = 2 ** 20
+
+    def __init__(self, socket_path, on_connected, on_event, on_command_response, on_disconnected):
+        super().__init__(socket_path, on_connected, on_event, on_command_response, on_disconnected)
+        self.loop = None
+        self.writer = None
+        self.response_futures = {}
+
+    async def run(self):
+        import asyncio
+
+        self.loop = asyncio.get_running_loop()
+        reader, self.writer = await asyncio.open_unix_connection(self.socket_path, limit=self.LINE_LIMIT)
+
+        log.info('POSIX socket connected: %s', self.socket_path)
+        self.fire_connected()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b'\n'):
+                    # EOF reached. A partial last line is incomplete JSON.
+                    break
+                self.on_line(line[:-1])
+        except (ConnectionError, ValueError) as e:
+            # ValueError: line longer than LINE_LIMIT
+            log.warning('Error while reading from POSIX socket %s: %s', self.socket_path, e)
+
+        log.info('POSIX socket closed: %s', self.socket_path)
+        self.writer.close()
+        self.writer = None
+
+        # also fails the futures of unanswered commands
+        self.fire_disconnected()
+
+    def is_in_loop_thread(self):
+        import asyncio
+
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def write(self, data):
+        ipc_log.debug('-> %s', data)
+        if self.is_in_loop_thread():
+            self.write_now(data)
+        else:
+            # commands from other threads (e.g. timers) are handed to the loop
+            self.loop.call_soon_threadsafe(self.write_now, data)
+
+    def write_now(self, data):
+        if self.writer is not None:
+            self.writer.write(data)
+
+    def send_command(self, elements):
+        self.expire_commands()
+        future = self.loop.create_future()
+        future.add_done_callback(retrieve_exception)
+        with self.lock:
+            self.response_futures[self.command_counter] = future
+            data = self.register_command(elements)
+        self.write(data)
+        return future
+
+    def send_commands(self, elements_list, on_complete=None):
+        import asyncio
+
+        future = asyncio.wrap_future(super().send_commands(elements_list, on_complete), loop=self.loop)
+        future.add_done_callback(retrieve_exception)
+        return future
+
+    def drop_commands(self, request_ids, exception):
+        with self.lock:
+            futures = [self.response_futures.pop(request_id) for request_id in request_ids
+                       if request_id in self.response_futures]
+        for future in futures:
+            # may be called from other threads than the loop's
+            self.loop.call_soon_threadsafe(fail_future, future, exception)
+        super().drop_commands(request_ids, exception)
+
+    def on_response(self, response):
+        with self.lock:
+            future = self.response_futures.pop(response['request_id'], None)
+        if future is not None and not future.done():
+            future.set_result(response)
+        super().on_response(response)
+
+
+def fail_future(future, exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
+def retrieve_exception(future):
+    # Most commands are sent without awaiting their future. Without retrieving its exception, asyncio would log
+    # "Future exception was never retrieved" for each of them when mpv disconnects. Awaiting still raises it.
+    if not future.cancelled():
+        future.exception()
+
+
 class WindowsMpvMonitor(MpvMonitor):
     def __init__(self, named_pipe_path, on_connected, on_event, on_command_response, on_disconnected):
         super().__init__(on_connected, on_event, on_command_response, on_disconnected)
@@ -176,7 +458,7 @@ class WindowsMpvMonitor(MpvMonitor):
                                                 win32file.OPEN_EXISTING,
                                                 0, None)
 
-        log.info('Windows named pipe connected')
+        log.info('Windows named pipe connected: %s', self.named_pipe_path)
         self.fire_connected()
 
         while True:
@@ -197,14 +479,16 @@ class WindowsMpvMonitor(MpvMonitor):
             size = win32file.GetFileSize(self.file_handle)
             if size > 0:
                 while size > 0:
-                    # pipe has data to read
-                    data = win32file.ReadFile(self.file_handle, 512)
+                    # pipe has data to read, read all of it at once
+                    data = win32file.ReadFile(self.file_handle, min(size, MAX_READ_SIZE))
                     self.on_data(data[1])
                     size = win32file.GetFileSize(self.file_handle)
             else:
                 time.sleep(1)
 
-        log.info('Windows named pipe closed')
+            self.expire_commands()
+
+        log.info('Windows named pipe closed: %s', self.named_pipe_path)
         win32file.CloseHandle(self.file_handle)
         self.file_handle = None
 
@@ -0,0 +1,202 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+log = logging.getLogger('mpvTraktSync')
+
+# inotify events in a watched directory, that may mean a new mpv IPC socket
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+IN_ATTRIB = 0x00000004
+SOCKET_EVENTS = IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+# inotify events in the directory of a watched file, that may mean it changed. Editors either write the file in
+# place or replace it.
+IN_CLOSE_WRITE = 0x00000008
+FILE_EVENTS = IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO
+# events were lost, so anything may have changed
+IN_Q_OVERFLOW = 0x00004000
+
+# struct inotify_event without the name: watch descriptor, mask, cookie, length of the name
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# delay of the first check after something changed. mpv creates the socket file right before listening on it,
+# so the first connection attempt may fail and is retried with growing delays.
+MIN_DELAY_SECONDS = 0.01
+
+
+def open_inotify():
+    # returns (libc, file descriptor) or (None, None) if inotify isn't available
+    if not sys.platform.startswith('linux'):
+        return None, None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        # IN_NONBLOCK and IN_CLOEXEC have the values of O_NONBLOCK and O_CLOEXEC
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError) as e:
+        log.info('inotify not available, polling for mpv instances: %s', e)
+        return None, None
+    if fd < 0:
+        log.info('inotify not available, polling for mpv instances: %s', os.strerror(ctypes.get_errno()))
+        return None, None
+    return libc, fd
+
+
+def get_watch_directory(pattern):
+    # the directory whose entries change, when a socket matching pattern is created
+    pattern = os.path.expanduser(pattern)
+    if os.path.isdir(pattern):
+        return pattern
+    directory = os.path.dirname(pattern)
+    if any(char in directory for char in '*?['):
+        # globs in directory names can't be watched, they are found by polling
+        return None
+    return directory or '.'
+
+
+def read_events(fd):
+    # yields (watch descriptor, mask, name) of the queued inotify events. The kernel only returns whole events.
+    while True:
+        try:
+            buffer = os.read(fd, 4096)
+        except BlockingIOError:
+            return
+        if len(buffer) == 0:
+            return
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(buffer):
+            watch_descriptor, mask, _, name_length = INOTIFY_EVENT.unpack_from(buffer, offset)
+            offset += INOTIFY_EVENT.size
+            # the name is padded with null bytes
+            name = os.fsdecode(buffer[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            yield watch_descriptor, mask, name
+
+
+# Waits until a new mpv instance may have appeared, or a file passed to watch_file() may have changed.
+# On Linux, the directories of the IPC sockets are watched with inotify, so a new socket is noticed right away
+# without polling. Only entries that match a socket pattern or a watched file count, other files created in e.g.
+# /tmp don't. Otherwise, and as a safety net, checks happen with exponentially growing delays, starting at
+# MIN_DELAY_SECONDS after a change and ending at max_delay.
+class MpvDiscovery:
+    def __init__(self, patterns, max_delay):
+        self.max_delay = max_delay
+        self.delay = MIN_DELAY_SECONDS
+        self.libc, self.inotify_fd = open_inotify()
+        self.socket_directories = {}  # directory -> name patterns of sockets in it, None for any name
+        self.file_directories = {}  # directory -> names of watched files in it
+        self.watched_directories = {}  # directory -> (watch descriptor, inotify events)
+        self.set_patterns(patterns)
+        # wake() from other threads interrupts wait(). A pipe is needed to wait together with inotify.
+        self.wake_event = threading.Event()
+        if self.inotify_fd is not None:
+            self.wake_read_fd, self.wake_write_fd = os.pipe()
+            os.set_blocking(self.wake_read_fd, False)
+
+    def set_patterns(self, patterns):
+        # the IPC socket patterns may change while waiting, e.g. when the config is reloaded
+        socket_directories = {}
+        for pattern in patterns:
+            directory = get_watch_directory(pattern)
+            if directory is None:
+                continue
+            name_patterns = socket_directories.get(directory, ())
+            if directory == os.path.expanduser(pattern):
+                # every socket in the directory
+                socket_directories[directory] = None
+            elif name_patterns is not None:
+                socket_directories[directory] = name_patterns + (os.path.basename(pattern),)
+        self.socket_directories = socket_directories
+
+    def watch_file(self, path):
+        path = os.path.abspath(path)
+        self.file_directories.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+
+    def is_relevant(self, watch_descriptor, mask, name):
+        # whether an inotify event may mean a new mpv socket or a changed watched file
+        if mask & IN_Q_OVERFLOW:
+            return True
+        for directory, (directory_watch_descriptor, _) in self.watched_directories.items():
+            if directory_watch_descriptor != watch_descriptor:
+                continue
+            if mask & SOCKET_EVENTS and directory in self.socket_directories:
+                name_patterns = self.socket_directories[directory]
+                if name_patterns is None or any(fnmatch.fnmatchcase(name, name_pattern)
+                                                for name_pattern in name_patterns):
+                    return True
+            if mask & FILE_EVENTS and name in self.file_directories.get(directory, ()):
+                return True
+        return False
+
+    def get_watch_events(self):
+        # directory -> inotify events to watch
+        events = {}
+        for directory in self.socket_directories:
+            events[directory] = events.get(directory, 0) | SOCKET_EVENTS
+        for directory in self.file_directories:
+            events[directory] = events.get(directory, 0) | FILE_EVENTS
+        return events
+
+    def add_watches(self):
+        # directories that don't exist yet are tried again before each wait
+        watch_events = self.get_watch_events()
+        for directory in list(self.watched_directories):
+            if directory not in watch_events:
+                self.libc.inotify_rm_watch(self.inotify_fd, self.watched_directories.pop(directory)[0])
+                log.debug('Stopped watching %s', directory)
+        for directory, events in watch_events.items():
+            if self.watched_directories.get(directory, (None, None))[1] == events:
+                continue
+            # replaces the events of an existing watch of directory
+            watch_descriptor = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(directory), events)
+            if watch_descriptor >= 0:
+                log.debug('Watching %s', directory)
+                self.watched_directories[directory] = (watch_descriptor, events)
+
+    def wake(self):
+        # e.g. after an mpv instance closed, so a restarted one is found quickly without inotify
+        if self.inotify_fd is not None:
+            os.write(self.wake_write_fd, b'\0')
+        else:
+            self.wake_event.set()
+
+    def wait(self):
+        if self.inotify_fd is not None:
+            self.add_watches()
+            deadline = time.monotonic() + self.delay
+            changed = False
+            # events of other files in the watched directories don't end the wait
+            while not changed and time.monotonic() < deadline:
+                ready_fds, _, _ = select.select([self.inotify_fd, self.wake_read_fd], [], [],
+                                                max(deadline - time.monotonic(), 0))
+                if len(ready_fds) == 0:
+                    break
+                if self.inotify_fd in ready_fds:
+                    # all events are read, so they don't wake the next select
+                    relevant_events = [event for event in read_events(self.inotify_fd) if self.is_relevant(*event)]
+                    changed = len(relevant_events) > 0
+                if self.wake_read_fd in ready_fds:
+                    drain(self.wake_read_fd)
+                    changed = True
+        else:
+            changed = self.wake_event.wait(self.delay)
+            self.wake_event.clear()
+
+        if changed:
+            self.delay = MIN_DELAY_SECONDS
+        else:
+            self.delay = min(self.delay * 2, self.max_delay)
+
+
+def drain(fd):
+    try:
+        while len(os.read(fd, 4096)) > 0:
+            pass
+    except BlockingIOError:
+        pass
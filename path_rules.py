@@ -0,0 +1,135 @@
+import os
+import re
+import urllib.parse
+
+# marks the end of a rule in a PrefixTrie node
+RULE_END = None
+
+
+def is_url(path):
+    try:
+        return urllib.parse.urlsplit(path).scheme not in ('', 'file') and '://' in path
+    except ValueError:
+        return False
+
+
+def is_glob(rule):
+    return any(char in rule for char in '*?[')
+
+
+def split_local_path(path, resolve_symlinks=True):
+    # '/media/tv/' and '/media/./tv' both become ['media', 'tv']. With resolve_symlinks, a file played via a
+    # symlink becomes its real location.
+    if path.startswith('file://'):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+    path = os.path.expanduser(path)
+    path = os.path.realpath(path) if resolve_symlinks else os.path.abspath(path)
+    return [component for component in os.path.normcase(path).split(os.sep) if component != '']
+
+
+def split_url(url):
+    # http and https URLs of a host are treated the same. The query string is ignored.
+    parts = urllib.parse.urlsplit(url)
+    return [parts.netloc.lower()] + [component for component in parts.path.split('/') if component != '']
+
+
+def glob_to_regex(rule):
+    # '*' matches within one path component, '**' across components. A rule also matches everything below it.
+    # Rules are matched against the path without its leading separator, so absolute rules work on Windows, too.
+    rule = os.path.normcase(os.path.expanduser(rule)).replace(os.sep, '/').lstrip('/')
+    regex = ''
+    i = 0
+    while i < len(rule):
+        if rule.startswith('**/', i):
+            # also no directory at all, so 'a/**/b' matches 'a/b'
+            regex += '(?:.*/)?'
+            i += 3
+        elif rule.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif rule[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif rule[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif rule[i] == '[' and ']' in rule[i + 1:]:
+            end = rule.index(']', i + 1)
+            regex += '[' + rule[i + 1:end].replace('\\', '\\\\') + ']'
+            i = end + 1
+        else:
+            regex += re.escape(rule[i])
+            i += 1
+    return regex.rstrip('/') + '(?:/.*)?'
+
+
+class PrefixTrie:
+    def __init__(self):
+        self.root = {}
+
+    def add(self, components):
+        node = self.root
+        for component in components:
+            node = node.setdefault(component, {})
+        node[RULE_END] = True
+
+    def matches(self, components):
+        # True if any added rule is a prefix of components. Takes O(len(components)), independent of the rule count.
+        node = self.root
+        if RULE_END in node:
+            return True
+        for component in components:
+            node = node.get(component)
+            if node is None:
+                return False
+            if RULE_END in node:
+                return True
+        return False
+
+
+# A list of directory rules, compiled once: plain directories and URL prefixes go into prefix tries,
+# globs into one combined anchored regex.
+class RuleSet:
+    def __init__(self, rules):
+        self.rule_count = len(rules)
+        self.local_trie = PrefixTrie()
+        self.url_trie = PrefixTrie()
+        glob_regexes = []
+        for rule in rules:
+            if is_url(rule):
+                self.url_trie.add(split_url(rule))
+            elif is_glob(rule):
+                glob_regexes.append(glob_to_regex(rule))
+            else:
+                self.local_trie.add(split_local_path(rule))
+                self.local_trie.add(split_local_path(rule, resolve_symlinks=False))
+        if len(glob_regexes) > 0:
+            self.glob_regex = re.compile('|'.join('(?:%s)' % regex for regex in glob_regexes), re.DOTALL)
+        else:
+            self.glob_regex = None
+
+    def is_empty(self):
+        return self.rule_count == 0
+
+    def matches(self, path):
+        if is_url(path):
+            return self.url_trie.matches(split_url(path))
+        # both the path as played and its resolved location are checked
+        for components in (split_local_path(path, resolve_symlinks=False), split_local_path(path)):
+            if self.local_trie.matches(components):
+                return True
+            if self.glob_regex is not None and self.glob_regex.fullmatch('/'.join(components)) is not None:
+                return True
+        return False
+
+
+class PathRules:
+    def __init__(self, monitored_directories, excluded_directories):
+        self.monitored = RuleSet(monitored_directories)
+        self.excluded = RuleSet(excluded_directories)
+
+    def is_monitored(self, path):
+        # excluded_directories override monitored_directories. No monitored_directories means: monitor everything.
+        if self.excluded.matches(path):
+            return False
+        return self.monitored.is_empty() or self.monitored.matches(path)
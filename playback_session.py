@@ -0,0 +1,111 @@
+import collections
+import threading
+import time
+
+# A position that differs by more than this from where uninterrupted playback would be, is a seek
+SEEK_TOLERANCE_SECONDS = 10.0
+
+PlaybackSnapshot = collections.namedtuple('PlaybackSnapshot', [
+    'is_paused', 'playback_position', 'working_dir', 'path', 'duration', 'file_start_timestamp',
+    'position_updated_at'
+])
+
+# mpv property name -> PlaybackSession field
+PROPERTY_FIELDS = {
+    'pause': 'is_paused',
+    'percent-pos': 'playback_position',
+    'working-directory': 'working_dir',
+    'path': 'path',
+    'duration': 'duration'
+}
+
+
+# Playback state of one mpv instance.
+# It is updated from the thread reading the mpv socket, and read by the scheduler and the sync workers. All access
+# goes through the lock, readers get immutable snapshots. The last snapshot that was synced to trakt is kept, so a
+# sync can be skipped if nothing changed that trakt would notice.
+class PlaybackSession:
+    __slots__ = ('lock', 'is_paused', 'playback_position', 'working_dir', 'path', 'duration', 'file_start_timestamp',
+                 'position_updated_at', 'last_synced')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # expects self.lock to be held, or the session not to be shared yet
+        self.is_paused = None
+        self.playback_position = None
+        self.working_dir = None
+        self.path = None
+        self.duration = None
+        self.file_start_timestamp = None
+        self.position_updated_at = None
+        self.last_synced = None
+
+    def update(self, property_name, value):
+        # Returns the previous value of the property
+        field = PROPERTY_FIELDS[property_name]
+        with self.lock:
+            previous_value = getattr(self, field)
+            setattr(self, field, value)
+            if field == 'is_paused' and not value and self.file_start_timestamp is None:
+                self.file_start_timestamp = time.time()
+            elif field == 'playback_position':
+                self.position_updated_at = time.time()
+            return previous_value
+
+    def get_snapshot(self):
+        with self.lock:
+            return self.take_snapshot()
+
+    def take_snapshot(self):
+        # expects self.lock to be held. None, while the state is incomplete
+        if self.is_paused is None or self.playback_position is None or self.working_dir is None \
+                or self.path is None or self.duration is None:
+            return None
+        return PlaybackSnapshot(self.is_paused, self.playback_position, self.working_dir, self.path, self.duration,
+                                self.file_start_timestamp, self.position_updated_at)
+
+    def reset(self):
+        # Atomically returns the last snapshot and clears the state, e.g. when mpv closes or starts another file
+        with self.lock:
+            snapshot = self.take_snapshot()
+            self.clear()
+            return snapshot
+
+    def needs_sync(self, snapshot):
+        with self.lock:
+            return has_trakt_relevant_changes(self.last_synced, snapshot)
+
+    def is_transition(self, snapshot):
+        with self.lock:
+            return has_transition(self.last_synced, snapshot)
+
+    def mark_synced(self, snapshot):
+        with self.lock:
+            # a reset in the meantime means the snapshot belongs to a file that isn't played anymore
+            if self.path == snapshot.path:
+                self.last_synced = snapshot
+
+
+def has_transition(old, new):
+    # another file, pausing or resuming. Unlike seeks, these are single events worth syncing right away.
+    return old is None or old.path != new.path or old.working_dir != new.working_dir \
+        or old.is_paused != new.is_paused or old.duration != new.duration
+
+
+def has_trakt_relevant_changes(old, new):
+    # trakt only needs to know about another file, pausing and resuming, and seeking. Normal playback progress
+    # is extrapolated by trakt itself.
+    if has_transition(old, new):
+        return True
+    expected_position = old.playback_position
+    if not old.is_paused and old.duration > 0:
+        elapsed_seconds = new.position_updated_at - old.position_updated_at
+        expected_position += elapsed_seconds / old.duration * 100
+    if old.duration > 0:
+        tolerance = SEEK_TOLERANCE_SECONDS / old.duration * 100
+    else:
+        tolerance = 0.0
+    return abs(new.playback_position - expected_position) > tolerance
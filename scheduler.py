@@ -0,0 +1,101 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger('mpvTraktSync')
+
+
+# A call on the scheduler thread, that can be cancelled and rescheduled.
+# Rescheduling reuses the call: moving the deadline later only updates it, and the heap entry is moved when it comes
+# due. A debounce timer that is rescheduled on every mpv event therefore doesn't grow the heap.
+class ScheduledCall:
+    def __init__(self, scheduler, function, args):
+        self.scheduler = scheduler
+        self.function = function
+        self.args = args
+        self.deadline = None  # None while not scheduled
+        self.queued_deadline = None  # deadline of the live heap entry
+
+    def reschedule(self, delay):
+        self.scheduler.schedule(self, time.monotonic() + delay)
+
+    def cancel(self):
+        # the heap entry stays and is dropped when it reaches the top
+        with self.scheduler.condition:
+            self.deadline = None
+
+    def is_scheduled(self):
+        return self.deadline is not None
+
+
+# Runs the delayed calls of all mpv sessions on a single thread, instead of one threading.Timer thread per call.
+# Calls are executed on the scheduler thread, so they must not block. Longer work is handed to an executor.
+class Scheduler:
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()  # tie breaker for calls with equal deadlines
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def create_call(self, function, *args):
+        # returns an unscheduled call, that is started with reschedule()
+        return ScheduledCall(self, function, args)
+
+    def call_later(self, delay, function, *args):
+        call = self.create_call(function, *args)
+        call.reschedule(delay)
+        return call
+
+    def call_soon(self, function, *args):
+        # runs function after all calls that are due already, in order
+        return self.call_later(0, function, *args)
+
+    def schedule(self, call, deadline):
+        with self.condition:
+            call.deadline = deadline
+            if call.queued_deadline is None or deadline < call.queued_deadline:
+                # a later deadline is picked up when the current heap entry comes due
+                call.queued_deadline = deadline
+                heapq.heappush(self.heap, (deadline, next(self.counter), call))
+                self.condition.notify()
+
+    def next_due_call(self):
+        with self.condition:
+            while True:
+                if len(self.heap) == 0:
+                    self.condition.wait()
+                    continue
+                deadline, _, call = self.heap[0]
+                if deadline != call.queued_deadline or call.deadline is None:
+                    # replaced by an earlier heap entry, or cancelled
+                    heapq.heappop(self.heap)
+                    if deadline == call.queued_deadline:
+                        call.queued_deadline = None
+                elif call.deadline > deadline:
+                    # rescheduled to a later time
+                    heapq.heapreplace(self.heap, (call.deadline, next(self.counter), call))
+                    call.queued_deadline = call.deadline
+                else:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        heapq.heappop(self.heap)
+                        call.deadline = None
+                        call.queued_deadline = None
+                        return call
+                    self.condition.wait(timeout)
+
+    def run(self):
+        while True:
+            call = self.next_due_call()
+            try:
+                metrics.profiler.call(call.function, *call.args)
+            except Exception:
+                log.exception('Scheduled call %s failed', call.function)
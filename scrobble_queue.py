@@ -0,0 +1,287 @@
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import metrics
+import trakt_client
+import trakt_v2_oauth
+
+log = logging.getLogger('mpvTraktSync')
+
+# Scrobbles older than this were queued while trakt was unreachable. A late 'start' would show a file as
+# 'watching now' that isn't played anymore, so it's dropped. A late 'stop' is added to the watch history instead.
+REALTIME_SECONDS = 5 * 60
+
+# after a failed send, wait 1s, 2s, 4s, ... up to MAX_RETRY_DELAY_SECONDS before trying again
+MAX_RETRY_DELAY_SECONDS = 5 * 60
+
+# errors of resolve() and the trakt response, that repeat on every retry of the same scrobble, e.g. for a guess
+# without a title. Such a scrobble is dropped, others stay pending.
+PERMANENT_ERRORS = (KeyError, TypeError, ValueError)
+
+# stop() waits this long for a request in progress
+STOP_TIMEOUT_SECONDS = 10
+
+# rewrite the journal after this many finished entries, so it doesn't grow forever
+COMPACT_AFTER_DONE_COUNT = 500
+
+HISTORY_BATCH_SIZE = 100
+
+
+def get_item_key(guess):
+    # scrobbles of the same show episode or movie supersede each other
+    return json.dumps([guess.get('type'), guess.get('title', '').lower(), guess.get('year'),
+                       guess.get('season'), guess.get('episode')])
+
+
+# Durable queue of scrobbles to send to trakt.
+# enqueue() appends to an on-disk journal (one JSON line per record) and returns without touching the network.
+# A background worker sends the queued scrobbles, resolving trakt ids on the way. If trakt is unreachable, it keeps
+# them and retries with backoff. Scrobbles still pending when the daemon stops are sent after the next start.
+class ScrobbleQueue:
+    def __init__(self, journal_path, resolve, on_watched=None):
+        # resolve(guess) returns the trakt scrobble data of a guess, or None if trakt doesn't know the title.
+        # It raises requests.RequestException, if trakt can't be reached.
+        # on_watched(data) is called for every finished watch trakt accepted.
+        self.journal_path = journal_path
+        self.resolve = resolve
+        self.on_watched = on_watched
+        self.condition = threading.Condition()
+        self.pending = {}  # seq -> entry, in insertion order
+        self.next_seq = 1
+        self.done_count = 0
+        self.retry_at = 0.0
+        self.retry_delay = 1.0
+        self.journal = None
+        self.thread = None
+        self.is_stopping = False
+
+    def start(self):
+        self.load()
+        self.compact()
+        self.thread = threading.Thread(target=self.run, name='scrobble-queue', daemon=True)
+        self.thread.start()
+
+    def load(self):
+        if not os.path.isfile(self.journal_path):
+            return
+        with open(self.journal_path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a crash while appending may leave a partial last line
+                    log.warning('Skipping invalid scrobble journal line: %s', line)
+                    continue
+                if record['op'] == 'add':
+                    self.pending[record['seq']] = record
+                elif record['op'] == 'done':
+                    self.pending.pop(record['seq'], None)
+                self.next_seq = max(self.next_seq, record['seq'] + 1)
+        if len(self.pending) > 0:
+            log.info('%d scrobbles pending from last run', len(self.pending))
+
+    def compact(self):
+        # expects no concurrent access to the journal
+        if self.journal is not None:
+            self.journal.close()
+        directory = os.path.dirname(os.path.abspath(self.journal_path))
+        file_descriptor, temp_path = tempfile.mkstemp(prefix='.scrobble_journal.', dir=directory)
+        with os.fdopen(file_descriptor, 'w') as file:
+            for entry in self.pending.values():
+                file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.journal_path)
+        self.journal = open(self.journal_path, 'a')
+        self.done_count = 0
+
+    def append(self, record):
+        # expects self.condition to be held
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def enqueue(self, action, guess, progress):
+        with self.condition:
+            entry = {'op': 'add', 'seq': self.next_seq, 'action': action, 'guess': guess, 'progress': progress,
+                     'created_at': time.time()}
+            self.next_seq += 1
+            self.append(entry)
+            self.pending[entry['seq']] = entry
+            self.condition.notify()
+
+    def mark_done(self, entries):
+        with self.condition:
+            for entry in entries:
+                if self.pending.pop(entry['seq'], None) is not None:
+                    self.append({'op': 'done', 'seq': entry['seq']})
+                    self.done_count += 1
+            if self.done_count >= COMPACT_AFTER_DONE_COUNT:
+                self.compact()
+
+    def stop(self):
+        # Stops the worker, e.g. before the caches used by resolve() are closed. Pending scrobbles are sent after the
+        # next start.
+        with self.condition:
+            self.is_stopping = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(STOP_TIMEOUT_SECONDS)
+            if self.thread.is_alive():
+                log.warning('Stopping the scrobble queue timed out, %d scrobbles pending', len(self.pending))
+
+    def next_batch(self):
+        # returns None once stop() was called
+        with self.condition:
+            while not self.is_stopping and (len(self.pending) == 0 or time.time() < self.retry_at):
+                if len(self.pending) == 0:
+                    self.condition.wait()
+                else:
+                    self.condition.wait(self.retry_at - time.time())
+            if self.is_stopping:
+                return None
+            return list(self.pending.values())
+
+    def run(self):
+        import requests
+
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            try:
+                metrics.profiler.call(self.process, batch)
+            except requests.RequestException as e:
+                log.warning('trakt unreachable, %d scrobbles pending. Retrying in %.0fs: %s',
+                            len(self.pending), self.retry_delay, e)
+            except (sqlite3.Error, OSError) as e:
+                # e.g. a locked cache database. Local and temporary, the scrobbles are kept.
+                log.warning('Sending scrobbles failed, %d pending. Retrying in %.0fs: %s',
+                            len(self.pending), self.retry_delay, e)
+            except Exception:
+                log.exception('Sending scrobbles failed, %d pending. Retrying in %.0fs',
+                              len(self.pending), self.retry_delay)
+            else:
+                self.retry_delay = 1.0
+                continue
+            self.retry_at = time.time() + self.retry_delay
+            self.retry_delay = min(self.retry_delay * 2, MAX_RETRY_DELAY_SECONDS)
+
+    def process(self, batch):
+        # Raises requests.RequestException if trakt can't be reached, and other exceptions than PERMANENT_ERRORS.
+        # Unsent entries stay pending.
+        import requests
+
+        latest_entries, superseded_entries = collapse(batch)
+        if len(superseded_entries) > 0:
+            log.debug('Dropping %d superseded scrobbles', len(superseded_entries))
+            self.mark_done(superseded_entries)
+
+        history_entries = []
+        for entry in latest_entries:
+            if self.is_stopping:
+                return
+            is_late = time.time() - entry['created_at'] > REALTIME_SECONDS
+            if is_late and entry['action'] == 'stop':
+                history_entries.append(entry)
+            elif is_late and entry['action'] == 'start':
+                log.info('Dropping late scrobble/start of %s', entry['guess'].get('title'))
+                self.mark_done([entry])
+            else:
+                try:
+                    self.send_scrobble(entry)
+                except requests.RequestException:
+                    raise
+                except PERMANENT_ERRORS:
+                    # it would fail again on every retry and block the entries after it, also after a restart
+                    log.exception('Dropping scrobble/%s of %s', entry['action'], entry['guess'])
+                self.mark_done([entry])
+
+        for start in range(0, len(history_entries), HISTORY_BATCH_SIZE):
+            if self.is_stopping:
+                return
+            history_batch = history_entries[start:start + HISTORY_BATCH_SIZE]
+            self.send_history(history_batch)
+            self.mark_done(history_batch)
+
+    def send_scrobble(self, entry):
+        import requests
+
+        data = self.resolve(entry['guess'])
+        if data is None:
+            return
+        data['progress'] = entry['progress']
+        data['app_version'] = '1.0.3'
+        endpoint = '/scrobble/' + entry['action']
+        req = trakt_client.get_client().post(endpoint, json=data, access_token=trakt_v2_oauth.get_access_token())
+        log.info('%s %s %s', endpoint, req.status_code, req.text)
+        if trakt_client.is_transient_failure(req.status_code):
+            raise requests.HTTPError('%s returned %d' % (endpoint, req.status_code), response=req)
+        metrics.scrobble_send_delay_seconds.observe(time.time() - entry['created_at'], 'trakt')
+        if entry['action'] == 'stop' and req.status_code == 201 and self.on_watched is not None:
+            self.on_watched(data)
+
+    def send_history(self, entries):
+        # replays finished watches with their original time, in a single request
+        import requests
+
+        movies = []
+        shows = {}
+        watched = []
+        for entry in entries:
+            try:
+                data = self.resolve(entry['guess'])
+            except requests.RequestException:
+                raise
+            except PERMANENT_ERRORS:
+                log.exception('Dropping finished watch of %s', entry['guess'])
+                continue
+            if data is None:
+                continue
+            watched.append(data)
+            watched_at = datetime.datetime.fromtimestamp(entry['created_at'], datetime.timezone.utc).isoformat()
+            if 'movie' in data:
+                movies.append({'ids': data['movie']['ids'], 'watched_at': watched_at})
+            else:
+                show_id = data['show']['ids']['trakt']
+                show = shows.setdefault(show_id, {'ids': data['show']['ids'], 'seasons': {}})
+                season = show['seasons'].setdefault(data['episode']['season'],
+                                                    {'number': data['episode']['season'], 'episodes': []})
+                season['episodes'].append({'number': data['episode']['number'], 'watched_at': watched_at})
+        if len(movies) == 0 and len(shows) == 0:
+            return
+        history = {
+            'movies': movies,
+            'shows': [{'ids': show['ids'], 'seasons': list(show['seasons'].values())} for show in shows.values()]
+        }
+        req = trakt_client.get_client().post('/sync/history', json=history,
+                                             access_token=trakt_v2_oauth.get_access_token())
+        log.info('/sync/history %s %s', req.status_code, req.text)
+        if trakt_client.is_transient_failure(req.status_code):
+            raise requests.HTTPError('/sync/history returned %d' % req.status_code, response=req)
+        if req.status_code == 201 and self.on_watched is not None:
+            for data in watched:
+                self.on_watched(data)
+
+
+def collapse(entries):
+    # Only the latest scrobble of an item matters, earlier starts and pauses are superseded.
+    # stop entries are finished watches and are always kept.
+    # Returns (entries to send in order, superseded entries)
+    latest_seq_per_item = {}
+    for entry in entries:
+        latest_seq_per_item[get_item_key(entry['guess'])] = entry['seq']
+    latest_entries = []
+    superseded_entries = []
+    for entry in entries:
+        if entry['action'] == 'stop' or latest_seq_per_item[get_item_key(entry['guess'])] == entry['seq']:
+            latest_entries.append(entry)
+        else:
+            superseded_entries.append(entry)
+    return latest_entries, superseded_entries
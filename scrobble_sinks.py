@@ -0,0 +1,145 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger('mpvTraktSync')
+
+# events a sink can fall behind by, before its oldest events are dropped
+MAX_QUEUED_EVENTS = 100
+
+
+def create_scrobble_event(action, guess, progress, path):
+    # what every sink receives: action is 'start', 'pause' or 'stop', progress the playback position in percent
+    return {'action': action, 'guess': guess, 'progress': progress, 'path': path, 'created_at': time.time()}
+
+
+# Receives scrobble events. Exceptions only affect the sink that raised them.
+class ScrobbleSink:
+    # True: send() is called from the dispatcher's worker threads, never concurrently for the same sink, and in the
+    # order of the events.
+    # False for sinks that only queue the event durably in send(), and record their delivery delay themselves.
+    # The dispatcher calls their send() right away, in the thread of dispatch(). Every sync thread dispatches, so
+    # send() of these sinks is called concurrently and has to be thread-safe, like ScrobbleQueue.enqueue().
+    delivers_in_send = True
+
+    def __init__(self, name):
+        self.name = name
+
+    def send(self, event):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# Hands events to the durable trakt ScrobbleQueue, which resolves trakt ids and talks to trakt in its own thread.
+class TraktSink(ScrobbleSink):
+    delivers_in_send = False
+
+    def __init__(self, scrobble_queue):
+        super().__init__('trakt')
+        self.scrobble_queue = scrobble_queue
+
+    def send(self, event):
+        self.scrobble_queue.enqueue(event['action'], event['guess'], event['progress'])
+
+
+# POSTs every event as JSON to a URL, e.g. a local media server or an analytics collector.
+# Delivery is best effort: a failed request is logged and the event is dropped.
+class HttpJsonSink(ScrobbleSink):
+    def __init__(self, url, name=None, headers=None, timeout=5.0):
+        import requests
+
+        super().__init__(name or url)
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+
+    def send(self, event):
+        response = self.session.post(self.url, json=event, timeout=self.timeout)
+        log.debug('%s: POST %s %s', self.name, self.url, response.status_code)
+        response.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+SINK_TYPES = {
+    'http_json': HttpJsonSink
+}
+
+
+def create_sink(sink_config):
+    # sink_config is an entry of the 'scrobble_sinks' config list
+    sink_config = dict(sink_config)
+    sink_type = sink_config.pop('type', 'http_json')
+    if sink_type not in SINK_TYPES:
+        raise ValueError('Unknown scrobble sink type: %s' % sink_type)
+    if 'timeout_seconds' in sink_config:
+        sink_config['timeout'] = sink_config.pop('timeout_seconds')
+    return SINK_TYPES[sink_type](**sink_config)
+
+
+class SinkLane:
+    def __init__(self, sink, max_queued_events):
+        self.sink = sink
+        self.events = collections.deque(maxlen=max_queued_events)
+        self.is_draining = False
+
+
+# Fans out scrobble events to all sinks.
+# Sinks that only queue events themselves, like TraktSink, get every event right away, so none is lost.
+# Every other sink has its own bounded queue and at most one worker of a shared pool drains it at a time, so events
+# reach each sink in order, and a slow or failing sink only delays itself. If a sink falls behind by more than
+# max_queued_events, its oldest events are dropped.
+class ScrobbleDispatcher:
+    def __init__(self, sinks, max_workers=4, max_queued_events=MAX_QUEUED_EVENTS):
+        self.queueing_sinks = [sink for sink in sinks if not sink.delivers_in_send]
+        self.lanes = [SinkLane(sink, max_queued_events) for sink in sinks if sink.delivers_in_send]
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix='scrobble-sink')
+
+    def dispatch(self, event):
+        for sink in self.queueing_sinks:
+            try:
+                sink.send(event)
+            except Exception as e:
+                log.warning('Scrobble sink %s failed to queue %s of %s: %s', sink.name, event['action'],
+                            event['guess'].get('title'), e)
+        with self.lock:
+            for lane in self.lanes:
+                if len(lane.events) == lane.events.maxlen:
+                    log.warning('Scrobble sink %s is falling behind, dropping its oldest event', lane.sink.name)
+                lane.events.append(event)
+                if not lane.is_draining:
+                    lane.is_draining = True
+                    self.executor.submit(self.drain, lane)
+
+    def drain(self, lane):
+        while True:
+            with self.lock:
+                if len(lane.events) == 0:
+                    lane.is_draining = False
+                    return
+                event = lane.events.popleft()
+            try:
+                metrics.profiler.call(lane.sink.send, event)
+            except Exception as e:
+                log.warning('Scrobble sink %s failed to send %s of %s: %s', lane.sink.name, event['action'],
+                            event['guess'].get('title'), e)
+            else:
+                if lane.sink.delivers_in_send:
+                    metrics.scrobble_send_delay_seconds.observe(time.time() - event['created_at'], lane.sink.name)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for sink in self.queueing_sinks:
+            sink.close()
+        for lane in self.lanes:
+            lane.sink.close()
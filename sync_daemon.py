@@ -1,145 +1,245 @@
 #!/usr/bin/env python3
-import json
+import concurrent.futures
 import logging
+import signal
 import sys
 import threading
 import time
 import urllib.parse
 
-import guessit
 import os
-import requests
 
+import config_schema
+import log_pipeline
+import metrics
 import mpv
-import trakt_key_holder
+import trakt_client
+import trakt_id_cache
+import trakt_ranking
 import trakt_v2_oauth
+from guess_cache import GuessCache
+from mpv_discovery import MpvDiscovery
+from path_rules import PathRules
+from playback_session import PlaybackSession
+from scheduler import Scheduler
+from scrobble_queue import ScrobbleQueue
+from scrobble_sinks import ScrobbleDispatcher, TraktSink, create_scrobble_event, create_sink
+from watch_history import WatchHistory
 
 log = logging.getLogger('mpvTraktSync')
+ipc_log = logging.getLogger(log_pipeline.IPC_LOGGER)
+
+TRAKT_ID_CACHE_JSON = 'trakt_ids.json'  # used by older versions, migrated into TRAKT_ID_CACHE_DB
+TRAKT_ID_CACHE_DB = 'trakt_ids.sqlite'
+SCROBBLE_JOURNAL = 'scrobble_journal.jsonl'
+CONFIG_JSON = 'config.json'
+GUESS_INDEX_DB = 'guessit_index.sqlite'
+WATCH_HISTORY_DB = 'watch_history.sqlite'
+
+SCROBBLE_PROPERTIES = ['working-directory', 'path', 'percent-pos', 'pause', 'duration']
+
+# delay of a sync after pausing, resuming or starting a file, so e.g. a seek right after it is synced along
+TRANSITION_DELAY_SECONDS = 0.25
+# during continuous seeking, a sync happens at the latest this many seconds_between_mpv_event_and_trakt_sync
+# after the first seek
+MAX_BURST_DELAY_FACTOR = 3
+
+config = None  # config_schema.Config
+path_rules = None
+
+# loaded once and shared by all sync workers
+id_cache = None
+scrobble_queue = None
+scrobble_dispatcher = None
+guess_cache = None
+watch_history = None  # None, if watch_history_sync_minutes is 0
+
+# delayed calls of all sessions share one thread and syncs to trakt share a bounded pool,
+# so the number of threads doesn't grow with the number of timers or players
+scheduler = None
+sync_executor = None
+SYNC_WORKERS = 4
+
+
+class MpvSession:
+    # Connection and timers of one connected mpv instance. Its playback state is kept in a PlaybackSession.
+
+    def __init__(self, ipc_path):
+        self.ipc_path = ipc_path
+        self.monitor = None
+        self.state = PlaybackSession()
+
+        # rescheduled on every state change and poll, instead of creating a new call each time
+        self.sync_call = scheduler.create_call(self.sync_last_state)
+        self.regular_call = scheduler.create_call(self.issue_scrobble_commands)
+        self.burst_started_at = None  # time.monotonic() of the first state change since the last debounced sync
+        self.last_sync_at = None  # time.monotonic() of the last sync of the current file
+        self.is_closed = False  # set once the connection to mpv is lost, the session isn't reused
+
+    def on_command_response(self, monitor, command, response):
+        ipc_log.debug('on_command_response(%s, %s, %s)', self.ipc_path, command, response)
+
+        last_command_elements = command['command']
+        if last_command_elements[0] == 'get_property':
+            if response['error'] != 'success':
+                log.warning('Command %s failed: %s', command, response)
+            else:
+                self.on_property_value(last_command_elements[1], response['data'])
+                self.schedule_sync()
+        elif last_command_elements[0] == 'observe_property':
+            if response['error'] != 'success':
+                log.warning('Command %s failed: %s', command, response)
+
+    def on_property_value(self, property_name, value):
+        # Returns the previous value of the property
+        previous_value = self.state.update(property_name, value)
+        if property_name == 'path':
+            self.prefetch_guess()
+        return previous_value
+
+    def prefetch_guess(self):
+        # parse the file name right when a file starts, so the first sync doesn't wait for guessit
+        snapshot = self.state.get_snapshot()
+        if snapshot is not None:
+            path = get_absolute_path(snapshot.working_dir, snapshot.path)
+            if is_monitored(path):
+                sync_executor.submit(guess_cache.guess, path)
+
+    def schedule_sync(self):
+        # whether anything relevant changed is decided when the call fires, so that one sync covers all changes
+        # of a burst of events.
+        # Pausing, resuming and another file are synced almost right away. Seeks wait until no seek happened for
+        # seconds_between_mpv_event_and_trakt_sync, but not longer than MAX_BURST_DELAY_FACTOR times that.
+        # Syncs of the same file are min_seconds_between_trakt_syncs apart.
+        snapshot = self.state.get_snapshot()
+        log.debug('%s: %s', self.ipc_path, snapshot)
+        if snapshot is None:
+            return
+        now = time.monotonic()
+        # sync_last_state() clears burst_started_at in the scheduler thread, so it's read only once
+        burst_started_at = self.burst_started_at
+        if burst_started_at is None or not self.sync_call.is_scheduled():
+            burst_started_at = self.burst_started_at = now
+        if self.state.is_transition(snapshot):
+            delay = TRANSITION_DELAY_SECONDS
+        else:
+            delay = config.seconds_between_mpv_event_and_trakt_sync
+        delay = min(delay, burst_started_at + MAX_BURST_DELAY_FACTOR * delay - now)
+        last_sync_at = self.last_sync_at
+        if last_sync_at is not None:
+            delay = max(delay, last_sync_at + config.min_seconds_between_trakt_syncs - now)
+        self.sync_call.reschedule(max(delay, 0.0))
+
+    def sync_last_state(self):
+        # read the state when the timer fires and not when it is scheduled: in observe mode the position after a seek
+        # is pushed by mpv only after the seek event
+        if self.burst_started_at is not None:
+            metrics.scrobble_debounce_seconds.observe(time.monotonic() - self.burst_started_at)
+            self.burst_started_at = None
+        snapshot = self.state.get_snapshot()
+        if snapshot is None:
+            return
+        if not self.state.needs_sync(snapshot):
+            log.debug('%s: nothing changed since the last sync', self.ipc_path)
+            return
+        self.last_sync_at = time.monotonic()
+        sync_executor.submit(metrics.profiler.call, self.sync, snapshot, False)
+
+    def sync(self, snapshot, mpv_closed):
+        if sync_to_trakt(snapshot.is_paused, snapshot.playback_position, snapshot.working_dir, snapshot.path,
+                         snapshot.duration, snapshot.file_start_timestamp, mpv_closed) and not mpv_closed:
+            self.state.mark_synced(snapshot)
+
+    def on_event(self, monitor, event):
+        ipc_log.debug('on_event(%s, %s)', self.ipc_path, event)
+        event_name = event['event']
+
+        # when a new file starts, act as if a new mpv instance got connected
+        if event_name == 'start-file':
+            self.end_file()
+            if is_observe_mode():
+                # properties are already observed on this connection, but unchanged values (e.g. pause) are not
+                # pushed again for the new file. Fetch the complete state once.
+                self.request_properties()
+            else:
+                self.on_connected(monitor)
+
+        elif event_name == 'property-change':
+            previous_value = self.on_property_value(event['name'], event.get('data'))
+            # percent-pos changes continuously during playback. Only treat it as a state change when it completes
+            # the state, otherwise the debounce timer would be restarted on every frame and never fire.
+            if event['name'] != 'percent-pos' or previous_value is None:
+                self.schedule_sync()
+
+        elif event_name == 'end-file':
+            # sync the end of the file right away, mpv may stay open without playing anything
+            self.end_file()
+
+        elif event_name == 'seek':
+            if is_observe_mode():
+                self.schedule_sync()
+            else:
+                self.issue_scrobble_commands()
+
+        elif (event_name == 'pause' or event_name == 'unpause') and not is_observe_mode():
+            # in observe mode pause state changes arrive as property-change events
+            self.issue_scrobble_commands()
+
+    def on_connected(self, monitor):
+        log.debug('on_connected(%s)', self.ipc_path)
+        if is_observe_mode():
+            # mpv pushes the current value of each observed property right away and then on every change
+            for property_id, property_name in enumerate(SCROBBLE_PROPERTIES, start=1):
+                monitor.send_observe_property_command(property_id, property_name)
+        else:
+            self.issue_scrobble_commands()
+
+    def on_disconnected(self):
+        log.debug('on_disconnected(%s)', self.ipc_path)
+        # set before the calls are cancelled, see schedule_regular_timer()
+        self.is_closed = True
+        self.end_file()
+
+    def end_file(self):
+        # the file ended or mpv is gone: stop the timers and sync the final state
+        self.sync_call.cancel()
+        self.regular_call.cancel()
+        self.last_sync_at = None
+
+        # the final sync goes through the scheduler thread with the state of now, so it is submitted after a
+        # debounced sync that may be running at this moment
+        snapshot = self.state.reset()
+        if snapshot is not None:
+            scheduler.call_soon(sync_executor.submit, metrics.profiler.call, self.sync, snapshot, True)
+
+    def request_properties(self):
+        # all properties in one write, and a single sync decision once all values arrived
+        self.monitor.send_commands([['get_property', property_name] for property_name in SCROBBLE_PROPERTIES],
+                                   self.on_properties)
+
+    def on_properties(self, monitor, commands, responses):
+        for command, response in zip(commands, responses):
+            if response['error'] != 'success':
+                log.warning('Command %s failed: %s', command, response)
+            else:
+                self.on_property_value(command['command'][1], response['data'])
+        self.schedule_sync()
 
-TRAKT_ID_CACHE_JSON = 'trakt_ids.json'
-
-config = None
-
-last_is_paused = None
-last_playback_position = None
-last_working_dir = None
-last_path = None
-last_duration = None
-last_file_start_timestamp = None
-
-is_local_state_dirty = True
-
-next_sync_timer = None
-next_regular_timer = None
+    def issue_scrobble_commands(self):
+        if self.is_closed:
+            return
+        self.request_properties()
+        self.schedule_regular_timer()
 
+    def schedule_regular_timer(self):
+        self.regular_call.reschedule(config.seconds_between_regular_get_property_commands)
+        # a poll running in the scheduler thread may reschedule after on_disconnected() cancelled the call
+        if self.is_closed:
+            self.regular_call.cancel()
 
-def on_command_response(monitor, command, response):
-    log.debug('on_command_response(%s, %s)' % (command, response))
-    global last_is_paused, last_playback_position, last_working_dir, last_path, last_duration, last_file_start_timestamp
-    global next_sync_timer
 
-    last_command_elements = command['command']
-    if last_command_elements[0] == 'get_property':
-        if response['error'] != 'success':
-            log.warning('Command %s failed: %s', command, response)
-        else:
-            if last_command_elements[1] == 'pause':
-                last_is_paused = response['data']
-                if not last_is_paused and last_file_start_timestamp is None:
-                    last_file_start_timestamp = time.time()
-            elif last_command_elements[1] == 'percent-pos':
-                last_playback_position = response['data']
-            elif last_command_elements[1] == 'working-directory':
-                last_working_dir = response['data']
-            elif last_command_elements[1] == 'path':
-                last_path = response['data']
-            elif last_command_elements[1] == 'duration':
-                last_duration = response['data']
-
-            log.debug('is_local_state_dirty: %s\nlast_is_paused: %s\nlast_playback_position: %s\nlast_working_dir: %s\nlast_path: %s\nlast_duration: %s',
-                      is_local_state_dirty, last_is_paused, last_playback_position, last_working_dir, last_path, last_duration)
-            if is_local_state_dirty \
-                    and last_is_paused is not None \
-                    and last_playback_position is not None \
-                    and last_working_dir is not None \
-                    and last_path is not None \
-                    and last_duration is not None:
-                if next_sync_timer is not None:
-                    next_sync_timer.cancel()
-                next_sync_timer = threading.Timer(config['seconds_between_mpv_event_and_trakt_sync'], sync_to_trakt,
-                                                  (last_is_paused, last_playback_position, last_working_dir, last_path,
-                                                   last_duration, last_file_start_timestamp, False))
-                next_sync_timer.start()
-
-
-def on_event(monitor, event):
-    log.debug('on_event(%s)' % (event))
-    event_name = event['event']
-
-    # when a new file starts, act as if a new mpv instance got connected
-    if event_name == 'start-file':
-        on_disconnected()
-        on_connected(monitor)
-
-    elif event_name == 'pause' or event_name == 'unpause' or event_name == 'seek':
-        global is_local_state_dirty
-        is_local_state_dirty = True
-        issue_scrobble_commands(monitor)
-
-
-def on_connected(monitor):
-    log.debug('on_connected()')
-    global is_local_state_dirty
-    is_local_state_dirty = True
-    issue_scrobble_commands(monitor)
-
-
-def on_disconnected():
-    log.debug('on_disconnected()')
-    global last_is_paused, last_playback_position, last_working_dir, last_path, last_duration, last_file_start_timestamp
-    global next_sync_timer, next_regular_timer
-    global is_local_state_dirty
-
-    if next_sync_timer is not None:
-        next_sync_timer.cancel()
-
-    if next_regular_timer is not None:
-        next_regular_timer.cancel()
-
-    if last_is_paused is not None \
-            and last_playback_position is not None \
-            and last_working_dir is not None \
-            and last_path is not None \
-            and last_duration is not None:
-        threading.Thread(target=sync_to_trakt, args=(
-            last_is_paused, last_playback_position, last_working_dir, last_path, last_duration,
-            last_file_start_timestamp, True)).start()
-
-    last_is_paused = None
-    last_playback_position = None
-    last_working_dir = None
-    last_path = None
-    last_duration = None
-    last_file_start_timestamp = None
-    is_local_state_dirty = True
-
-
-def issue_scrobble_commands(monitor):
-    monitor.send_get_property_command('working-directory')
-    monitor.send_get_property_command('path')
-    monitor.send_get_property_command('percent-pos')
-    monitor.send_get_property_command('pause')
-    monitor.send_get_property_command('duration')
-    schedule_regular_timer(monitor)
-
-
-def schedule_regular_timer(monitor):
-    global next_regular_timer
-    if next_regular_timer is not None:
-        next_regular_timer.cancel()
-    next_regular_timer = threading.Timer(config['seconds_between_regular_get_property_commands'],
-                                         issue_scrobble_commands, [monitor])
-    next_regular_timer.start()
+def is_observe_mode():
+    return config.mpv_property_mode == 'observe'
 
 
 def is_finished(playback_position, duration, start_time):
@@ -149,8 +249,8 @@ def is_finished(playback_position, duration, start_time):
         #   at least a minimal playback position is reached
         # and
         #   the session is running long enough
-        if playback_position >= config['percent_minimal_playback_position_before_scrobble'] \
-                and watch_time >= duration * config['factor_must_watch_before_scrobble']:
+        if playback_position >= config.percent_minimal_playback_position_before_scrobble \
+                and watch_time >= duration * config.factor_must_watch_before_scrobble:
             return True
     return False
 
@@ -162,181 +262,417 @@ def is_url(url):
         return False
 
 
-def sync_to_trakt(is_paused, playback_position, working_dir, path, duration, start_time, mpv_closed):
-    log.debug('sync_to_trakt(%s, %d, %s, %s, %d, %d, %s)' % (is_paused, playback_position, working_dir, path, duration, start_time, mpv_closed))
-    do_sync = False
+def get_absolute_path(working_dir, path):
     if not is_url(path) and not os.path.isabs(path):
         # If mpv is not started via double click from a file manager, but rather from a terminal,
         # the path to the video file is relative and not absolute. For the monitored_directories thing
         # to work, we need an absolute path. that's why we need the working dir
         path = os.path.join(working_dir, path)
+    return path
+
 
-    for monitored_directory in config['monitored_directories']:
-        if path.startswith(monitored_directory):
-            do_sync = True
-            break
+def is_monitored(path):
+    return path_rules.is_monitored(path)
 
-    # empty monitored_directories means: always sync
-    if len(config['monitored_directories']) == 0:
-        do_sync = True
 
-    for excluded_directory in config['excluded_directories']:
-        if path.startswith(excluded_directory):
-            do_sync = False
-            break
+def sync_to_trakt(is_paused, playback_position, working_dir, path, duration, start_time, mpv_closed):
+    log.debug('sync_to_trakt(%s, %s, %s, %s, %s, %s, %s)', is_paused, playback_position, working_dir, path, duration,
+              start_time, mpv_closed)
+    path = get_absolute_path(working_dir, path)
+    do_sync = is_monitored(path)
 
-    log.debug('do_sync = %s' % (do_sync))
+    log.debug('do_sync = %s', do_sync)
     if do_sync:
-        guess = guessit.guessit(path)
-        log.debug(guess)
-
-        data = get_cached_trakt_data(guess)
-
-        if data is not None:
-            data['progress'] = playback_position
-            data['app_version'] = '1.0.3'
-
-            finished = is_finished(playback_position, duration, start_time)
-
-            # closed  finished  paused  trakt action
-            # False   False     False   start
-            # False   False     True    pause
-            # False   True      False   start
-            # False   True      True    pause
-            # True    False     False   pause
-            # True    False     True    pause
-            # True    True      False   stop
-            # True    True      True    stop
-
-            # is equal to:
-
-            if mpv_closed:
-                if finished:
-                    # trakt is closing and finished watching
-                    # trakt action: stop
-                    url = 'https://api.trakt.tv/scrobble/stop'
-                else:
-                    # closed before finished watching
-                    # trakt action: pause
-                    url = 'https://api.trakt.tv/scrobble/pause'
-            elif is_paused:
-                # paused, while still open
-                # trakt action: pause
-                url = 'https://api.trakt.tv/scrobble/pause'
+        guess = guess_cache.guess(path)
+        log.debug('%s', guess)
+
+        finished = is_finished(playback_position, duration, start_time)
+
+        # closed  finished  paused  trakt action
+        # False   False     False   start
+        # False   False     True    pause
+        # False   True      False   start
+        # False   True      True    pause
+        # True    False     False   pause
+        # True    False     True    pause
+        # True    True      False   stop
+        # True    True      True    stop
+
+        # is equal to:
+
+        if mpv_closed:
+            if finished:
+                # trakt is closing and finished watching
+                # trakt action: stop
+                action = 'stop'
             else:
-                # watching right now
-                # trakt action: start
-                url = 'https://api.trakt.tv/scrobble/start'
-
-            req = requests.post(url,
-                                json=data,
-                                headers={'trakt-api-version': '2', 'trakt-api-key': trakt_key_holder.get_id(),
-                                         'Authorization': 'Bearer ' + trakt_v2_oauth.get_access_token()})
-            log.info('%s %s %s', url, req.status_code, req.text)
+                # closed before finished watching
+                # trakt action: pause
+                action = 'pause'
+        elif is_paused:
+            # paused, while still open
+            # trakt action: pause
+            action = 'pause'
+        else:
+            # watching right now
+            # trakt action: start
+            action = 'start'
+
+        # the sinks send the scrobble in the background, the trakt queue resolves the trakt id on the way
+        scrobble_dispatcher.dispatch(create_scrobble_event(action, guess, playback_position, path))
+        return True
+    return False
+
+
+def get_trakt_id(kind, guess):
+    # returns the trakt id of the show or movie of guess, or NOT_FOUND.
+    # if the title is not found in id_cache, rank the search results of its title. They are requested from the
+    # trakt API, unless they are cached from an earlier search, e.g. for the same title with another year.
+    # raises requests.RequestException, if trakt can't be reached. Nothing is cached then.
+    import requests
+
+    trakt_id = id_cache.get(kind, guess['title'], guess.get('year'))
+    if trakt_id is None:
+        candidates = id_cache.get_search_results(kind, guess['title'])
+        if candidates is None:
+            log.info('requesting trakt id for %s %s', kind, guess['title'])
+            endpoint = '/search/' + kind
+            req = trakt_client.get_client().get(endpoint, params={'field': 'title', 'query': guess['title']})
+            if trakt_client.is_transient_failure(req.status_code):
+                raise requests.HTTPError('%s returned %d' % (endpoint, req.status_code), response=req)
             if 200 <= req.status_code < 300:
-                global is_local_state_dirty
-                is_local_state_dirty = False
+                candidates = trakt_ranking.get_candidates(req.json(), kind)
+                id_cache.put_search_results(kind, guess['title'], candidates)
+            else:
+                candidates = []
+                log.warning('trakt request failed %s %s', kind, guess)
+        # cache NOT_FOUND, so that unknown titles are only ranked once until the entry expires.
+        # without it, they would be ranked each time get_cached_trakt_data() is called
+        trakt_id = trakt_ranking.choose_trakt_id(candidates, guess) or trakt_id_cache.NOT_FOUND
+        if trakt_id == trakt_id_cache.NOT_FOUND:
+            log.warning('unknown %s %s', kind, guess)
+        id_cache.put(kind, guess['title'], guess.get('year'), trakt_id)
+    return trakt_id
 
-def choose_trakt_id(data, guess):
-    if guess['type'] == 'episode':
-        kind = 'show'
-    else:
-        kind = 'movie'
-    ## the first ordered show that matches the year is the most likely true match
-    if 'year' in guess:
-        for item in data:
-            if item['type'] == kind:
-                if item[kind]['year'] == guess['year']:
-                    return item[kind]['ids']['trakt']
-    else:
-        return data[0][kind]['ids']['trakt']
 
 def get_cached_trakt_data(guess):
-    # load cached ids
-    if os.path.isfile(TRAKT_ID_CACHE_JSON):
-        with open(TRAKT_ID_CACHE_JSON) as file:
-            id_cache = json.load(file)
-    else:
-        id_cache = {
-            'movies': {},
-            'shows': {}
-        }
+    # called by the scrobble queue worker
     # constructing data to be sent to trakt
-    # if show or movie name is not found in id_cache, request trakt id from trakt API and cache it.
     # then assign dict to data, which has the structure of the json trakt expects for a scrobble call
     data = None
-    if guess['type'] == 'episode':
-        print(guess)
+    if 'title' not in guess:
+        log.warning('No title in %s', guess)
+    elif guess.get('type') == 'episode':
+        log.debug('%s', guess)
         if 'episode' not in guess and 'episode_title' in guess:
             guess['episode'] = guess['episode_title']
-        if guess['title'].lower() not in id_cache['shows']:
-            log.info('requesting trakt id for show ' + guess['title'])
-            req = requests.get('https://api.trakt.tv/search/show?field=title&query=' + guess['title'],
-                               headers={'trakt-api-version': '2', 'trakt-api-key': trakt_key_holder.get_id()})
-            if 200 <= req.status_code < 300 and len(req.json()) > 0:
-                trakt_id = choose_trakt_id(req.json(), guess)
-            else:
-                # write n/a into cache, so that unknown shows are only requested once.
-                # without n/a unknown shows would be requested each time get_cached_trakt_data_from_guess() is called
-                trakt_id = 'n/a'
-                log.warning('trakt request failed or unknown show ' + str(guess))
-            id_cache['shows'][guess['title'].lower()] = trakt_id
-        trakt_id = id_cache['shows'][guess['title'].lower()]
-        if trakt_id != 'n/a':
-            data = {'show': {'ids': {'trakt': id_cache['shows'][guess['title'].lower()]}},
+        if 'season' not in guess or 'episode' not in guess:
+            # e.g. anime with absolute episode numbers, trakt can only scrobble episodes of a season
+            log.warning('No season or episode in %s', guess)
+            return None
+        trakt_id = get_trakt_id('show', guess)
+        if trakt_id != trakt_id_cache.NOT_FOUND:
+            data = {'show': {'ids': {'trakt': trakt_id}},
                     'episode': {'season': guess['season'], 'number': guess['episode']}}
-    elif guess['type'] == 'movie':
-        if guess['title'].lower() not in id_cache['movies']:
-            log.info('requesting trakt id for movie ' + guess['title'])
-            req = requests.get('https://api.trakt.tv/search/movie?field=title&query=' + guess['title'],
-                               headers={'trakt-api-version': '2', 'trakt-api-key': trakt_key_holder.get_id()})
-            if 200 <= req.status_code < 300 and len(req.json()) > 0:
-                trakt_id = choose_trakt_id(req.json(), guess)
-            else:
-                # write n/a into cache, so that unknown movies are only requested once.
-                # without n/a unknown movies would be requested each time get_cached_trakt_data_from_guess() is called
-                trakt_id = 'n/a'
-                log.warning('trakt request failed or unknown movie ' + str(guess))
-            id_cache['movies'][guess['title'].lower()] = trakt_id
-        trakt_id = id_cache['movies'][guess['title'].lower()]
-        if trakt_id != 'n/a':
-            data = {'movie': {'ids': {'trakt': id_cache['movies'][guess['title'].lower()]}}}
+    elif guess.get('type') == 'movie':
+        trakt_id = get_trakt_id('movie', guess)
+        if trakt_id != trakt_id_cache.NOT_FOUND:
+            data = {'movie': {'ids': {'trakt': trakt_id}}}
     else:
-        log.warning('Unknown guessit type ' + str(guess))
+        log.warning('Unknown guessit type %s', guess)
+
+    if data is not None and watch_history is not None:
+        plays = watch_history.get_plays(data)
+        if plays > 0:
+            log.info('%s was watched %d times before', guess['title'], plays)
+            if not config.scrobble_rewatches:
+                return None
+    return data
 
-    # update cached ids file
-    with open(TRAKT_ID_CACHE_JSON, mode='w') as file:
-        json.dump(id_cache, file)
 
-    return data
+def add_watched_play(data):
+    # called by the scrobble queue worker after trakt accepted a finished watch
+    if watch_history is not None:
+        watch_history.add_play(data)
+
+
+def sync_watch_history():
+    # runs in sync_executor, reschedules itself
+    import requests
+
+    try:
+        watch_history.sync(trakt_v2_oauth.get_access_token())
+    except requests.RequestException as e:
+        log.warning('Updating the watch history failed: %s', e)
+    if config.watch_history_sync_minutes > 0:
+        scheduler.call_later(config.watch_history_sync_minutes * 60, sync_executor.submit, sync_watch_history)
+
+
+def load_config():
+    # a misspelled or invalid option stops the daemon here, instead of at the first sync
+    try:
+        apply_config(config_schema.load(CONFIG_JSON))
+    except config_schema.ConfigError as e:
+        log.critical('Invalid config.json:\n%s', e)
+        sys.exit(1)
+
+
+def apply_config(new_config):
+    global config, path_rules
+    # compiled once, so checking a path doesn't depend on the number of directories
+    new_path_rules = PathRules(new_config.monitored_directories, new_config.excluded_directories)
+    # each is replaced in one step, other threads see either the old or the new value. Timers read their delays
+    # from config when they are rescheduled, so they pick up new values without being restarted.
+    path_rules = new_path_rules
+    config = new_config
+    log_pipeline.sampling_filter.configure(config.log_sample_rates)
+
+
+def reload_config():
+    # on SIGHUP or when config.json changed. mpv connections, caches and pending scrobbles are kept.
+    try:
+        new_config = config_schema.load(CONFIG_JSON)
+    except (config_schema.ConfigError, OSError) as e:
+        log.error('Keeping the current config, config.json is invalid:\n%s', e)
+        return
+    restart_options = config_schema.get_restart_options(config, new_config)
+    if watch_history is None and new_config.watch_history_sync_minutes > 0:
+        # the watch history can be switched off while running, but it's only loaded at start-up
+        restart_options.append('watch_history_sync_minutes')
+    if len(restart_options) > 0:
+        log.warning('Changes of %s take effect after a restart', ', '.join(restart_options))
+        new_config = new_config._replace(**{name: getattr(config, name) for name in restart_options})
+    old_config = config
+    apply_config(new_config)
+    if (old_config.trakt_api_url, old_config.trakt_request_timeout_seconds, old_config.trakt_max_retries) != \
+            (config.trakt_api_url, config.trakt_request_timeout_seconds, config.trakt_max_retries):
+        trakt_client.configure(config)
+    log.info('Reloaded config.json')
+
+
+def get_config_mtime():
+    try:
+        return os.stat(CONFIG_JSON).st_mtime_ns
+    except OSError:
+        # e.g. while an editor replaces it
+        return None
+
+
+def get_ipc_path_patterns():
+    if len(config.mpv_ipc_sockets) == 0:
+        # single mpv instance, configured in mpv.conf
+        return [mpv.MpvMonitor.detect_ipc_path()]
+    return config.mpv_ipc_sockets
+
+
+def index_library():
+    # parses all files in monitored_directories ahead of playback
+    cache = GuessCache(GUESS_INDEX_DB)
+    start = time.time()
+    parsed, skipped = cache.index_directories(config.monitored_directories, is_monitored)
+    log.info('Indexed %d new or changed files in %.1fs, %d files were up to date', parsed, time.time() - start, skipped)
+    cache.close()
+
+
+def prefetch_library():
+    # indexes monitored_directories like index_library() and then resolves the trakt ids of all shows and movies
+    # in them, so the first play of a show doesn't wait for a trakt search
+    import requests
+
+    global id_cache
+    index_library()
+    id_cache = create_id_cache()
+    cache = GuessCache(GUESS_INDEX_DB)
+    titles = {}
+    for path, guess in cache.get_indexed_guesses():
+        if guess.get('type') not in ('episode', 'movie') or 'title' not in guess or not is_monitored(path):
+            continue
+        kind = 'show' if guess['type'] == 'episode' else 'movie'
+        key = (kind, trakt_id_cache.normalize_title(guess['title']), guess.get('year'))
+        titles.setdefault(key, guess)
+    cache.close()
+    missing = [(kind, guess) for (kind, _, _), guess in titles.items()
+               if id_cache.get(kind, guess['title'], guess.get('year')) is None]
+    log.info('%d titles in the library, %d not in the trakt id cache', len(titles), len(missing))
+
+    trakt_client.configure(config)
+    rate_limiter = trakt_client.RateLimiter(config.prefetch_requests_per_second)
+
+    def resolve(kind, guess):
+        rate_limiter.wait()
+        return get_trakt_id(kind, guess)
+
+    start = time.time()
+    found = 0
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.prefetch_workers) as executor:
+        futures = {executor.submit(resolve, kind, guess): guess for kind, guess in missing}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                if future.result() != trakt_id_cache.NOT_FOUND:
+                    found += 1
+            except requests.RequestException as e:
+                # not cached, tried again on the next run
+                failed += 1
+                log.warning('Resolving %s failed: %s', futures[future]['title'], e)
+    log.info('Resolved %d titles in %.1fs: %d found on trakt, %d unknown, %d failed', len(missing),
+             time.time() - start, found, len(missing) - found - failed, failed)
+    id_cache.close()
+
+
+def create_id_cache():
+    return trakt_id_cache.TraktIdCache(TRAKT_ID_CACHE_DB,
+                                       ttl=config.trakt_id_cache_days * 24 * 60 * 60,
+                                       negative_ttl=config.trakt_id_cache_not_found_hours * 60 * 60,
+                                       max_entries=config.trakt_id_cache_max_entries,
+                                       legacy_json_path=TRAKT_ID_CACHE_JSON)
 
 
 def main():
     log.info('launched')
 
-    with open('config.json') as file:
-        global config
-        config = json.load(file)
+    trakt_client.configure(config)
+
+    if config.metrics_port > 0:
+        metrics.start_server(config.metrics_address, config.metrics_port, allow_profiling=config.metrics_allow_profiling)
+
+    global scheduler, sync_executor, id_cache, scrobble_queue, scrobble_dispatcher, guess_cache, watch_history
+    scheduler = Scheduler()
+    scheduler.start()
+    id_cache = create_id_cache()
+    scrobble_queue = ScrobbleQueue(SCROBBLE_JOURNAL, get_cached_trakt_data, on_watched=add_watched_play)
+    sinks = [TraktSink(scrobble_queue)] + [create_sink(sink_config) for sink_config in config.scrobble_sinks]
+    scrobble_dispatcher = ScrobbleDispatcher(sinks, max_workers=config.scrobble_sink_workers)
+    sync_executor = concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix='sync')
+    guess_cache = GuessCache(GUESS_INDEX_DB)
+    sync_executor.submit(guess_cache.warm_up)
+    sync_executor.submit(trakt_client.get_client().warm_up)
+    if config.watch_history_sync_minutes > 0:
+        watch_history = WatchHistory(WATCH_HISTORY_DB)
+
+    ipc_path_patterns = get_ipc_path_patterns()
+
+    sessions = {}
+    sessions_lock = threading.Lock()
+    discovery = MpvDiscovery(ipc_path_patterns, config.seconds_between_mpv_running_checks)
+    # config.json is reloaded when it changes, or on SIGHUP where inotify isn't available
+    discovery.watch_file(CONFIG_JSON)
+    config_mtime = get_config_mtime()
+    reload_requested = threading.Event()
+
+    def on_sighup(signal_number, frame):
+        reload_requested.set()
+        discovery.wake()
+
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, on_sighup)
+
+    def on_session_closed(session):
+        # mpv was closed
+        log.info('mpv closed: %s', session.ipc_path)
+        with sessions_lock:
+            del sessions[session.ipc_path]
+        discovery.wake()
+
+    def run_session(session):
+        try:
+            session.monitor.run()
+        finally:
+            on_session_closed(session)
+
+    async def run_session_async(session):
+        try:
+            await session.monitor.run()
+        finally:
+            on_session_closed(session)
+
+    use_asyncio = config.mpv_ipc_transport == 'asyncio'
+    if use_asyncio:
+        import asyncio
+
+        # a single event loop thread reads the sockets of all mpv instances
+        ipc_loop = asyncio.new_event_loop()
+        threading.Thread(target=ipc_loop.run_forever, name='mpv-ipc', daemon=True).start()
 
-    monitor = mpv.MpvMonitor.create(on_connected, on_event, on_command_response, on_disconnected)
     try:
         trakt_v2_oauth.get_access_token()  # prompts authentication, if necessary
+        scrobble_queue.start()
+        if watch_history is not None:
+            sync_executor.submit(sync_watch_history)
         while True:
-            if monitor.can_open():
-                # call monitor.run() as a daemon thread, so that all SIGTERMs are handled here
-                # Daemon threads die automatically, when the main process ends
-                thread = threading.Thread(target=monitor.run, daemon=True)
-                thread.start()
-                thread.join()
-                # If thread joins, mpv was closed.
-                log.info('mpv closed')
-            else:
-                # mpv not open
-                # sleep before next attempt
-                time.sleep(config['seconds_between_mpv_running_checks'])
+            for ipc_path in mpv.expand_ipc_paths(ipc_path_patterns):
+                with sessions_lock:
+                    if ipc_path in sessions:
+                        continue
+                    session = MpvSession(ipc_path)
+                    session.monitor = mpv.MpvMonitor.create(metrics.profiler.wrap(session.on_connected),
+                                                            metrics.profiler.wrap(session.on_event),
+                                                            metrics.profiler.wrap(session.on_command_response),
+                                                            metrics.profiler.wrap(session.on_disconnected),
+                                                            mpv_ipc_path=ipc_path, use_asyncio=use_asyncio)
+                    if not session.monitor.can_open():
+                        continue
+                    sessions[ipc_path] = session
+                if use_asyncio and asyncio.iscoroutinefunction(session.monitor.run):
+                    asyncio.run_coroutine_threadsafe(run_session_async(session), ipc_loop)
+                else:
+                    # call monitor.run() in daemon threads, so that all SIGTERMs are handled here
+                    # Daemon threads die automatically, when the main process ends
+                    threading.Thread(target=run_session, args=(session,), daemon=True).start()
+            # sleep until a new socket appears, config.json changes or the next check is due
+            discovery.wait()
+
+            if reload_requested.is_set() or get_config_mtime() != config_mtime:
+                reload_requested.clear()
+                config_mtime = get_config_mtime()
+                reload_config()
+                ipc_path_patterns = get_ipc_path_patterns()
+                discovery.set_patterns(ipc_path_patterns)
+                discovery.max_delay = config.seconds_between_mpv_running_checks
     except KeyboardInterrupt:
         log.info('terminating')
-        logging.shutdown()
+        # the queue worker resolves trakt ids with id_cache, it must be done before the cache is closed
+        scrobble_dispatcher.close()
+        scrobble_queue.stop()
+        id_cache.close()
+        guess_cache.close()
+        if watch_history is not None:
+            watch_history.close()
+        log_pipeline.shutdown()
+
+
+def check_startup():
+    # reports how long the daemon's imports and guessit's first parse take. The config is validated before.
+    import subprocess
+
+    print('config.json is valid')
+    # -X importtime reports every import of a fresh interpreter on stderr: "import time: self | cumulative | name"
+    # guessit and requests are imported lazily by the daemon, they're imported here to show their share
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import sync_daemon, guessit, requests'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE,
+                            universal_newlines=True).stderr
+    total = 0.0
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or line.endswith('package'):
+            continue
+        _, cumulative, name = line.split('|')
+        # names are indented by two spaces per nesting level. Nested imports are included in the cumulative time
+        # of their parent, so only the modules the daemon imports directly are listed.
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            total += int(cumulative) / 1e6
+        if depth <= 1:
+            imports.append((int(cumulative) / 1e6, name.strip()))
+    imports.sort(reverse=True)
+    print('%.3fs importing sync_daemon, guessit and requests, the slowest imports:' % total)
+    for seconds, name in imports[:15]:
+        print('  %7.3fs %s' % (seconds, name))
+
+    import guessit
+    start = time.perf_counter()
+    guessit.guessit('Warm.Up.S01E01.720p.mkv')
+    print('%.3fs for the first guessit parse, done in the background after start-up' % (time.perf_counter() - start))
 
 
 def register_exception_handler():
@@ -371,9 +707,28 @@ def register_exception_handler():
 
 
 if __name__ == '__main__':
+    import argparse
     import logging.config
 
+    parser = argparse.ArgumentParser(description='Scrobbles what you watch in mpv to trakt.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help='run the daemon (default)')
+    subparsers.add_parser('index', help='parse all files in monitored_directories ahead of playback')
+    subparsers.add_parser('prefetch', help='index monitored_directories and look up all their shows and movies on trakt')
+    parser.add_argument('--check', action='store_true',
+                        help='validate config.json, report the time spent on imports at start-up and exit')
+    args = parser.parse_args()
+
     logging.config.fileConfig('log.conf')
+    log_pipeline.make_non_blocking(log)
     register_exception_handler()
-
-    main()
+    load_config()
+
+    if args.check:
+        check_startup()
+    elif args.command == 'index':
+        index_library()
+    elif args.command == 'prefetch':
+        prefetch_library()
+    else:
+        main()
@@ -0,0 +1,101 @@
+import json
+import os
+import tempfile
+import unittest
+
+import config_schema
+from config_schema import ConfigError, parse
+
+
+class ConfigSchemaTest(unittest.TestCase):
+    def assert_problems(self, values, *expected_problems):
+        with self.assertRaises(ConfigError) as context:
+            parse(values)
+        problems = str(context.exception).split('\n')
+        self.assertEqual(problems, list(expected_problems))
+
+    def test_defaults(self):
+        config = parse({})
+        for name, option_spec in config_schema.OPTIONS.items():
+            self.assertEqual(getattr(config, name), option_spec.default)
+
+    def test_defaults_are_copies(self):
+        parse({}).excluded_directories.append('/changed')
+        self.assertEqual(parse({}).excluded_directories, ['https://www.youtube.com/'])
+
+    def test_values(self):
+        config = parse({'monitored_directories': ['/media'], 'seconds_between_mpv_event_and_trakt_sync': 5,
+                        'scrobble_rewatches': False})
+        self.assertEqual(config.monitored_directories, ['/media'])
+        self.assertEqual(config.seconds_between_mpv_event_and_trakt_sync, 5)
+        self.assertFalse(config.scrobble_rewatches)
+
+    def test_shipped_config_is_valid(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.json')
+        config_schema.load(path)
+
+    def test_not_an_object(self):
+        self.assert_problems([], 'config.json must contain an object')
+
+    def test_unknown_option_with_suggestion(self):
+        self.assert_problems({'monitord_directories': []},
+                             'unknown option monitord_directories, did you mean monitored_directories?')
+        self.assert_problems({'zzz': 1}, 'unknown option zzz')
+
+    def test_wrong_types(self):
+        self.assert_problems({'trakt_max_retries': 1.5, 'scrobble_rewatches': 'no'},
+                             'trakt_max_retries must be an integer, not 1.5',
+                             'scrobble_rewatches must be a boolean, not "no"')
+
+    def test_booleans_are_not_numbers(self):
+        self.assert_problems({'seconds_between_mpv_running_checks': True},
+                             'seconds_between_mpv_running_checks must be a number, not true')
+
+    def test_choices_minimum_and_items(self):
+        self.assert_problems({'mpv_ipc_transport': 'processes', 'trakt_max_retries': -1,
+                              'monitored_directories': ['/media', 1]},
+                             'mpv_ipc_transport must be one of "threads", "asyncio", not "processes"',
+                             'trakt_max_retries must be at least 0, not -1',
+                             'entries of monitored_directories must be a string, not 1')
+
+    def test_scrobble_sinks(self):
+        config = parse({'scrobble_sinks': [{'type': 'http_json', 'name': 'analytics', 'url': 'http://localhost',
+                                            'headers': {'X-Token': 'secret'}, 'timeout_seconds': 2}]})
+        self.assertEqual(config.scrobble_sinks[0]['name'], 'analytics')
+
+    def test_scrobble_sink_problems(self):
+        self.assert_problems({'scrobble_sinks': [{'url': 'http://localhost', 'header': {}}]},
+                             'unknown key header in an entry of scrobble_sinks, did you mean headers?')
+        self.assert_problems({'scrobble_sinks': [{'name': 'analytics'}]},
+                             'every entry of scrobble_sinks needs a url: {"name": "analytics"}')
+        self.assert_problems({'scrobble_sinks': [{'url': 'http://localhost', 'type': 'mqtt', 'headers': [],
+                                                  'timeout_seconds': -1}]},
+                             'headers of scrobble_sinks entries must be an object, not []',
+                             'type of scrobble_sinks entries must be one of "http_json", not "mqtt"',
+                             'timeout_seconds of scrobble_sinks entries must be at least 0, not -1')
+
+    def test_restart_options(self):
+        old_config = parse({})
+        new_config = parse({'metrics_port': 9100, 'seconds_between_mpv_event_and_trakt_sync': 1})
+        self.assertEqual(config_schema.get_restart_options(old_config, new_config), ['metrics_port'])
+
+    def test_load_invalid_json(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as file:
+            file.write('{"monitored_directories": [}')
+        try:
+            with self.assertRaises(ConfigError):
+                config_schema.load(file.name)
+        finally:
+            os.remove(file.name)
+
+    def test_load(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as file:
+            json.dump({'trakt_max_retries': 5}, file)
+        try:
+            self.assertEqual(config_schema.load(file.name).trakt_max_retries, 5)
+        finally:
+            os.remove(file.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
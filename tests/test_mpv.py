@@ -0,0 +1,119 @@
+import asyncio
+import gc
+import json
+import unittest
+
+import mpv
+from mpv import AsyncPosixMpvMonitor, LineFramer, MpvMonitor
+
+
+class LineFramerTest(unittest.TestCase):
+    def test_lines_split_between_reads(self):
+        framer = LineFramer()
+        self.assertEqual(framer.feed(b'{"a": 1}\n{"b"'), [b'{"a": 1}'])
+        self.assertEqual(framer.feed(b': 2}'), [])
+        self.assertEqual(framer.feed(b'\n{"c": 3}\n\n'), [b'{"b": 2}', b'{"c": 3}', b''])
+        self.assertEqual(framer.feed(b''), [])
+
+    def test_utf8_character_split_between_reads(self):
+        data = (json.dumps({'data': 'Séquence 東京'}, ensure_ascii=False) + '\n').encode('utf-8')
+        split_at = data.index('東'.encode('utf-8')) + 1
+        for decode in (False, True):
+            framer = LineFramer(decode=decode)
+            self.assertEqual(framer.feed(data[:split_at]), [])
+            line, = framer.feed(data[split_at:])
+            self.assertEqual(json.loads(line), {'data': 'Séquence 東京'})
+
+    def test_invalid_utf8_is_kept_when_decoding(self):
+        line, = LineFramer(decode=True).feed(b'{"data": "/media/\xff.mkv"}\n')
+        self.assertEqual(json.loads(line)['data'].encode('utf-8', errors='surrogateescape'), b'/media/\xff.mkv')
+
+
+class MpvMonitorCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.responses = []
+        self.monitor = MpvMonitor(None, None, lambda monitor, command, response: self.responses.append(response),
+                                  None)
+
+    def answer(self, request_id, data):
+        self.monitor.on_data(json.dumps({'request_id': request_id, 'error': 'success', 'data': data}).encode('utf-8')
+                             + b'\n')
+
+    def test_single_command_response(self):
+        self.monitor.send_command(['get_property', 'path'])
+        self.answer(1, '/media/movie.mkv')
+        self.assertEqual([response['data'] for response in self.responses], ['/media/movie.mkv'])
+        self.assertEqual(self.monitor.sent_commands, {})
+
+    def test_batch_is_written_at_once_and_completes_with_all_responses(self):
+        completed = []
+        future = self.monitor.send_commands([['get_property', 'path'], ['get_property', 'pause']],
+                                            lambda monitor, commands, responses: completed.append(responses))
+        self.assertEqual(self.monitor.write_queue.qsize(), 1)
+        # mpv may answer in any order
+        self.answer(2, False)
+        self.assertFalse(future.done())
+        self.answer(1, '/media/movie.mkv')
+        self.assertEqual([response['data'] for response in future.result(0)], ['/media/movie.mkv', False])
+        self.assertEqual(completed, [future.result(0)])
+        # on_complete replaces on_command_response
+        self.assertEqual(self.responses, [])
+
+    def test_unanswered_commands_expire(self):
+        future = self.monitor.send_commands([['get_property', 'path'], ['get_property', 'pause']])
+        self.answer(1, '/media/movie.mkv')
+        self.monitor.command_sent_at[2] -= mpv.COMMAND_TIMEOUT_SECONDS + 1
+        with self.assertLogs('mpvTraktSync', 'WARNING'):
+            self.monitor.send_command(['get_property', 'path'])
+        with self.assertRaises(TimeoutError):
+            future.result(0)
+        self.assertEqual(list(self.monitor.sent_commands), [3])
+        with self.assertLogs('mpvTraktSync', 'WARNING') as logs:
+            self.answer(2, False)
+        self.assertIn('unsent or expired', logs.output[0])
+
+    def test_disconnect_fails_pending_batches(self):
+        future = self.monitor.send_commands([['get_property', 'path']])
+        self.monitor.fire_disconnected()
+        with self.assertRaises(ConnectionError):
+            future.result(0)
+        self.assertEqual(self.monitor.command_sent_at, {})
+
+
+class AsyncPosixMpvMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.unhandled = []
+        self.loop.set_exception_handler(lambda loop, context: self.unhandled.append(context['message']))
+        self.monitor = AsyncPosixMpvMonitor('/tmp/mpv-socket', None, None, None, None)
+        # like run() before connecting, writes go nowhere
+        self.monitor.loop = self.loop
+
+    def disconnect(self):
+        self.monitor.fire_disconnected()
+        # fail_future is called soon in the loop
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_unawaited_commands_fail_silently(self):
+        async def send():
+            self.monitor.send_command(['get_property', 'path'])
+            self.monitor.send_commands([['get_property', 'pause'], ['get_property', 'percent-pos']])
+
+        self.loop.run_until_complete(send())
+        self.disconnect()
+        gc.collect()
+        self.assertEqual(self.unhandled, [])
+
+    def test_awaited_commands_still_fail(self):
+        async def send():
+            return self.monitor.send_command(['get_property', 'path'])
+
+        future = self.loop.run_until_complete(send())
+        self.disconnect()
+        with self.assertRaises(ConnectionError):
+            self.loop.run_until_complete(future)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from unittest import mock
+
+import config_schema
+import sync_daemon
+from scheduler import Scheduler
+
+
+class MpvSessionPollTest(unittest.TestCase):
+    def setUp(self):
+        # the scheduler isn't started, so scheduled calls only stay in its heap
+        patchers = [mock.patch.object(sync_daemon, 'config', config_schema.parse({'mpv_property_mode': 'poll'})),
+                    mock.patch.object(sync_daemon, 'scheduler', Scheduler())]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.session = sync_daemon.MpvSession('/tmp/mpv-socket')
+        self.session.monitor = mock.Mock()
+
+    def test_polls_while_connected(self):
+        self.session.on_connected(self.session.monitor)
+        self.assertEqual(self.session.monitor.send_commands.call_count, 1)
+        self.assertTrue(self.session.regular_call.is_scheduled())
+
+    def test_no_polls_after_disconnect(self):
+        self.session.on_connected(self.session.monitor)
+        self.session.on_disconnected()
+        self.assertFalse(self.session.regular_call.is_scheduled())
+        # a poll that was already running in the scheduler thread
+        self.session.issue_scrobble_commands()
+        self.session.schedule_regular_timer()
+        self.assertFalse(self.session.regular_call.is_scheduled())
+        self.assertEqual(self.session.monitor.send_commands.call_count, 1)
+
+    def test_polls_go_on_after_a_new_file(self):
+        self.session.on_connected(self.session.monitor)
+        self.session.on_event(self.session.monitor, {'event': 'start-file'})
+        self.assertTrue(self.session.regular_call.is_scheduled())
+        self.assertEqual(self.session.monitor.send_commands.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
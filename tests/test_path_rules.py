@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+from path_rules import PathRules, glob_to_regex, is_url
+
+
+class PathRulesTest(unittest.TestCase):
+    def test_no_rules_monitor_everything(self):
+        rules = PathRules([], [])
+        self.assertTrue(rules.is_monitored('/media/tv/Show.S01E01.mkv'))
+        self.assertTrue(rules.is_monitored('https://example.com/video'))
+
+    def test_directories_match_whole_components(self):
+        rules = PathRules(['/media/tv'], [])
+        self.assertTrue(rules.is_monitored('/media/tv/Show/Show.S01E01.mkv'))
+        self.assertTrue(rules.is_monitored('/media/tv/'))
+        self.assertFalse(rules.is_monitored('/media/tvshows/Show.S01E01.mkv'))
+        self.assertFalse(rules.is_monitored('/media/movies/Movie.2017.mkv'))
+
+    def test_excluded_overrides_monitored(self):
+        rules = PathRules(['/media'], ['/media/private'])
+        self.assertTrue(rules.is_monitored('/media/tv/Show.S01E01.mkv'))
+        self.assertFalse(rules.is_monitored('/media/private/Show.S01E01.mkv'))
+
+    def test_file_urls_are_local_paths(self):
+        rules = PathRules(['/media/tv'], [])
+        self.assertTrue(rules.is_monitored('file:///media/tv/Show%20Name/Show.S01E01.mkv'))
+
+    def test_urls_match_by_host_and_path(self):
+        rules = PathRules([], ['https://www.youtube.com/'])
+        self.assertFalse(rules.is_monitored('https://www.youtube.com/watch?v=abc'))
+        self.assertFalse(rules.is_monitored('http://WWW.YOUTUBE.COM/watch?v=abc'))
+        self.assertTrue(rules.is_monitored('https://vimeo.com/123'))
+
+    def test_star_matches_within_a_directory_name(self):
+        rules = PathRules(['/media/*/anime'], [])
+        self.assertTrue(rules.is_monitored('/media/disk1/anime/e.mkv'))
+        self.assertFalse(rules.is_monitored('/media/disk1/more/anime/e.mkv'))
+
+    def test_double_star_matches_any_number_of_directories(self):
+        rules = PathRules(['/data/**/anime'], [])
+        self.assertTrue(rules.is_monitored('/data/anime/e.mkv'))
+        self.assertTrue(rules.is_monitored('/data/a/anime/e.mkv'))
+        self.assertTrue(rules.is_monitored('/data/a/b/anime/e.mkv'))
+        self.assertFalse(rules.is_monitored('/data/xanime/e.mkv'))
+        self.assertFalse(rules.is_monitored('/data/other/e.mkv'))
+
+    def test_leading_double_star(self):
+        rules = PathRules(['**/Movies'], [])
+        self.assertTrue(rules.is_monitored('/Movies/m.mkv'))
+        self.assertTrue(rules.is_monitored('/a/b/Movies/m.mkv'))
+        self.assertFalse(rules.is_monitored('/a/XMovies/m.mkv'))
+
+    def test_trailing_double_star(self):
+        self.assertEqual(glob_to_regex('/x/**'), 'x/.*(?:/.*)?')
+
+    def test_symlinks_are_resolved(self):
+        with tempfile.TemporaryDirectory() as directory:
+            directory = os.path.realpath(directory)
+            media = os.path.join(directory, 'media')
+            os.mkdir(media)
+            link = os.path.join(directory, 'link')
+            os.symlink(media, link)
+            rules = PathRules([media], [])
+            self.assertTrue(rules.is_monitored(os.path.join(link, 'Show.S01E01.mkv')))
+
+    def test_is_url(self):
+        self.assertTrue(is_url('https://example.com/a'))
+        self.assertFalse(is_url('file:///media/a.mkv'))
+        self.assertFalse(is_url('/media/a.mkv'))
+
+
+if __name__ == '__main__':
+    unittest.main()
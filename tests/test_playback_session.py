@@ -0,0 +1,74 @@
+import unittest
+
+from playback_session import PlaybackSession, PlaybackSnapshot, has_trakt_relevant_changes
+
+
+def create_snapshot(position, updated_at, is_paused=False, path='/media/movie.mkv', duration=1000.0):
+    return PlaybackSnapshot(is_paused, position, '/media', path, duration, 0.0, updated_at)
+
+
+class TraktRelevantChangesTest(unittest.TestCase):
+    def test_first_snapshot(self):
+        self.assertTrue(has_trakt_relevant_changes(None, create_snapshot(0.0, 0.0)))
+
+    def test_normal_playback_is_extrapolated(self):
+        # 100s of a 1000s file are 10%
+        self.assertFalse(has_trakt_relevant_changes(create_snapshot(10.0, 0.0), create_snapshot(20.0, 100.0)))
+
+    def test_seeks(self):
+        old = create_snapshot(10.0, 0.0)
+        # the tolerance is 10s, 1% of the file
+        self.assertFalse(has_trakt_relevant_changes(old, create_snapshot(20.5, 100.0)))
+        self.assertTrue(has_trakt_relevant_changes(old, create_snapshot(21.5, 100.0)))
+        self.assertTrue(has_trakt_relevant_changes(old, create_snapshot(5.0, 100.0)))
+
+    def test_paused_position_doesnt_move(self):
+        old = create_snapshot(10.0, 0.0, is_paused=True)
+        self.assertFalse(has_trakt_relevant_changes(old, create_snapshot(10.0, 100.0, is_paused=True)))
+        self.assertTrue(has_trakt_relevant_changes(old, create_snapshot(20.0, 100.0, is_paused=True)))
+
+    def test_transitions(self):
+        old = create_snapshot(10.0, 0.0)
+        self.assertTrue(has_trakt_relevant_changes(old, create_snapshot(10.0, 0.0, is_paused=True)))
+        self.assertTrue(has_trakt_relevant_changes(old, create_snapshot(10.0, 0.0, path='/media/other.mkv')))
+        self.assertTrue(has_trakt_relevant_changes(old, create_snapshot(10.0, 0.0, duration=2000.0)))
+
+    def test_unknown_duration(self):
+        old = create_snapshot(10.0, 0.0, duration=0.0)
+        self.assertFalse(has_trakt_relevant_changes(old, create_snapshot(10.0, 100.0, duration=0.0)))
+        self.assertTrue(has_trakt_relevant_changes(old, create_snapshot(10.5, 100.0, duration=0.0)))
+
+
+class PlaybackSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.session = PlaybackSession()
+        for property_name, value in [('working-directory', '/media'), ('path', '/media/movie.mkv'),
+                                     ('duration', 1000.0), ('percent-pos', 10.0)]:
+            self.session.update(property_name, value)
+
+    def test_snapshot_needs_all_properties(self):
+        self.assertIsNone(self.session.get_snapshot())
+        self.assertIsNone(self.session.update('pause', False))
+        snapshot = self.session.get_snapshot()
+        self.assertEqual(snapshot.path, '/media/movie.mkv')
+        self.assertIsNotNone(snapshot.file_start_timestamp)
+
+    def test_needs_sync_until_marked_synced(self):
+        self.session.update('pause', False)
+        snapshot = self.session.get_snapshot()
+        self.assertTrue(self.session.needs_sync(snapshot))
+        self.session.mark_synced(snapshot)
+        self.assertFalse(self.session.needs_sync(snapshot))
+        self.assertEqual(self.session.update('pause', True), False)
+        self.assertTrue(self.session.needs_sync(self.session.get_snapshot()))
+
+    def test_snapshot_of_a_reset_session_isnt_marked_synced(self):
+        self.session.update('pause', False)
+        snapshot = self.session.reset()
+        self.assertIsNone(self.session.get_snapshot())
+        self.session.mark_synced(snapshot)
+        self.assertTrue(self.session.needs_sync(snapshot))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import time
+import unittest
+
+from scheduler import Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.calls = []
+
+    def record(self, name):
+        self.calls.append((name, time.monotonic()))
+
+    def wait_for_calls(self, count, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while len(self.calls) < count and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def test_calls_run_in_deadline_order(self):
+        self.scheduler.call_later(0.06, self.record, 'c')
+        self.scheduler.call_later(0.02, self.record, 'a')
+        self.scheduler.call_later(0.04, self.record, 'b')
+        self.wait_for_calls(3)
+        self.assertEqual([name for name, _ in self.calls], ['a', 'b', 'c'])
+
+    def test_call_soon_keeps_order(self):
+        for name in 'abcde':
+            self.scheduler.call_soon(self.record, name)
+        self.wait_for_calls(5)
+        self.assertEqual(''.join(name for name, _ in self.calls), 'abcde')
+
+    def test_cancel(self):
+        call = self.scheduler.call_later(0.02, self.record, 'cancelled')
+        self.assertTrue(call.is_scheduled())
+        call.cancel()
+        self.assertFalse(call.is_scheduled())
+        self.scheduler.call_later(0.05, self.record, 'after')
+        self.wait_for_calls(1)
+        time.sleep(0.02)
+        self.assertEqual([name for name, _ in self.calls], ['after'])
+
+    def test_reschedule_later_runs_once_at_the_new_deadline(self):
+        start = time.monotonic()
+        call = self.scheduler.create_call(self.record, 'debounced')
+        for _ in range(10):
+            call.reschedule(0.05)
+            time.sleep(0.005)
+        self.wait_for_calls(1)
+        time.sleep(0.05)
+        self.assertEqual(len(self.calls), 1)
+        self.assertGreaterEqual(self.calls[0][1] - start, 0.09)
+        self.assertFalse(call.is_scheduled())
+        # rescheduling later doesn't add heap entries
+        self.assertLessEqual(len(self.scheduler.heap), 1)
+
+    def test_reschedule_earlier(self):
+        start = time.monotonic()
+        call = self.scheduler.call_later(10.0, self.record, 'early')
+        call.reschedule(0.01)
+        self.wait_for_calls(1)
+        self.assertEqual(len(self.calls), 1)
+        self.assertLess(self.calls[0][1] - start, 1.0)
+
+    def test_failing_call_doesnt_stop_the_scheduler(self):
+        def fail():
+            raise ValueError('expected by the test')
+
+        with self.assertLogs('mpvTraktSync', 'ERROR'):
+            self.scheduler.call_soon(fail)
+            self.scheduler.call_later(0.01, self.record, 'after')
+            self.wait_for_calls(1)
+        self.assertEqual([name for name, _ in self.calls], ['after'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+import scrobble_queue
+from scrobble_queue import ScrobbleQueue, collapse
+
+
+def create_entry(seq, action, title, episode=1, created_at=None):
+    guess = {'type': 'episode', 'title': title, 'season': 1, 'episode': episode}
+    return {'op': 'add', 'seq': seq, 'action': action, 'guess': guess, 'progress': 50.0,
+            'created_at': time.time() if created_at is None else created_at}
+
+
+class CollapseTest(unittest.TestCase):
+    def test_latest_entry_of_an_item_supersedes_earlier_ones(self):
+        entries = [create_entry(1, 'start', 'Show'), create_entry(2, 'pause', 'Show'),
+                   create_entry(3, 'start', 'Show')]
+        latest_entries, superseded_entries = collapse(entries)
+        self.assertEqual([entry['seq'] for entry in latest_entries], [3])
+        self.assertEqual([entry['seq'] for entry in superseded_entries], [1, 2])
+
+    def test_stops_are_always_kept(self):
+        entries = [create_entry(1, 'stop', 'Show'), create_entry(2, 'start', 'Show'),
+                   create_entry(3, 'stop', 'Show')]
+        latest_entries, superseded_entries = collapse(entries)
+        self.assertEqual([entry['seq'] for entry in latest_entries], [1, 3])
+        self.assertEqual([entry['seq'] for entry in superseded_entries], [2])
+
+    def test_items_are_collapsed_separately_in_order(self):
+        entries = [create_entry(1, 'start', 'Show', episode=1), create_entry(2, 'start', 'Other'),
+                   create_entry(3, 'pause', 'Show', episode=2), create_entry(4, 'pause', 'show', episode=1)]
+        latest_entries, superseded_entries = collapse(entries)
+        # titles are compared case-insensitively
+        self.assertEqual([entry['seq'] for entry in latest_entries], [2, 3, 4])
+        self.assertEqual([entry['seq'] for entry in superseded_entries], [1])
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ''
+
+
+class ScrobbleQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.directory.name, 'scrobble_journal.jsonl')
+        self.client = mock.Mock()
+        self.client.post.return_value = FakeResponse(201)
+        patchers = [mock.patch('trakt_client.get_client', return_value=self.client),
+                    mock.patch('trakt_v2_oauth.get_access_token', return_value='token')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.watched = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_queue(self, resolve):
+        queue = ScrobbleQueue(self.journal_path, resolve, on_watched=self.watched.append)
+        # like start(), without the worker thread
+        queue.load()
+        queue.compact()
+        self.addCleanup(lambda: queue.journal.close())
+        return queue
+
+    def test_pending_scrobbles_survive_a_restart(self):
+        queue = self.create_queue(lambda guess: None)
+        queue.enqueue('start', {'type': 'movie', 'title': 'Movie'}, 1.0)
+        queue.enqueue('pause', {'type': 'movie', 'title': 'Other'}, 2.0)
+        queue.mark_done([queue.pending[1]])
+        queue.journal.close()
+
+        queue = self.create_queue(lambda guess: None)
+        self.assertEqual([entry['guess']['title'] for entry in queue.pending.values()], ['Other'])
+        self.assertEqual(queue.next_seq, 3)
+
+    def test_sent_scrobbles_are_done(self):
+        data = {'movie': {'ids': {'trakt': 1}}}
+        queue = self.create_queue(lambda guess: dict(data))
+        queue.enqueue('stop', {'type': 'movie', 'title': 'Movie'}, 95.0)
+        queue.process(list(queue.pending.values()))
+        self.assertEqual(len(queue.pending), 0)
+        self.assertEqual(self.client.post.call_args[0][0], '/scrobble/stop')
+        self.assertEqual(len(self.watched), 1)
+
+    def test_unreachable_trakt_keeps_the_scrobble(self):
+        def resolve(guess):
+            raise requests.ConnectionError('expected by the test')
+
+        queue = self.create_queue(resolve)
+        queue.enqueue('start', {'type': 'movie', 'title': 'Movie'}, 1.0)
+        with self.assertRaises(requests.RequestException):
+            queue.process(list(queue.pending.values()))
+        self.assertEqual(len(queue.pending), 1)
+
+    def test_transient_status_keeps_the_scrobble(self):
+        self.client.post.return_value = FakeResponse(524)
+        queue = self.create_queue(lambda guess: {'movie': {'ids': {'trakt': 1}}})
+        queue.enqueue('start', {'type': 'movie', 'title': 'Movie'}, 1.0)
+        with self.assertRaises(requests.HTTPError):
+            queue.process(list(queue.pending.values()))
+        self.assertEqual(len(queue.pending), 1)
+
+    def test_local_errors_keep_the_scrobble(self):
+        connection = sqlite3.connect(':memory:')
+        connection.close()
+
+        def resolve(guess):
+            # like a TraktIdCache closed while the daemon stops
+            connection.execute('SELECT 1')
+
+        queue = self.create_queue(resolve)
+        queue.enqueue('stop', {'type': 'movie', 'title': 'Movie'}, 95.0)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            queue.process(list(queue.pending.values()))
+        self.assertEqual(len(queue.pending), 1)
+        queue.journal.close()
+        # nothing was written as done
+        self.assertEqual(len(self.create_queue(resolve).pending), 1)
+
+    def test_worker_backs_off_after_local_errors(self):
+        def resolve(guess):
+            raise OSError('expected by the test')
+
+        queue = self.create_queue(resolve)
+        queue.enqueue('start', {'type': 'movie', 'title': 'Movie'}, 1.0)
+        queue.thread = threading.Thread(target=queue.run)
+        with self.assertLogs('mpvTraktSync', 'WARNING'):
+            queue.thread.start()
+            deadline = time.time() + 2.0
+            while queue.retry_at == 0.0 and time.time() < deadline:
+                time.sleep(0.01)
+        queue.stop()
+        self.assertFalse(queue.thread.is_alive())
+        self.assertGreater(queue.retry_at, 0.0)
+        self.assertEqual(len(queue.pending), 1)
+
+    def test_stop_ends_an_idle_worker(self):
+        queue = self.create_queue(lambda guess: None)
+        queue.thread = threading.Thread(target=queue.run)
+        queue.thread.start()
+        queue.stop()
+        self.assertFalse(queue.thread.is_alive())
+
+    def test_failing_scrobble_is_dropped_and_doesnt_block_later_ones(self):
+        def resolve(guess):
+            if guess['title'] == 'Broken':
+                raise TypeError('expected by the test')
+            return {'movie': {'ids': {'trakt': 1}}}
+
+        queue = self.create_queue(resolve)
+        queue.enqueue('start', {'type': 'movie', 'title': 'Broken'}, 1.0)
+        queue.enqueue('start', {'type': 'movie', 'title': 'Movie'}, 1.0)
+        with self.assertLogs('mpvTraktSync', 'ERROR'):
+            queue.process(list(queue.pending.values()))
+        self.assertEqual(len(queue.pending), 0)
+        self.assertEqual(self.client.post.call_count, 1)
+
+    def test_late_stops_are_added_to_the_history(self):
+        queue = self.create_queue(lambda guess: {'show': {'ids': {'trakt': 7}},
+                                                 'episode': {'season': guess['season'],
+                                                             'number': guess['episode']}})
+        late = time.time() - scrobble_queue.REALTIME_SECONDS - 60
+        queue.pending = {seq: create_entry(seq, action, 'Show', episode=seq, created_at=late)
+                         for seq, action in [(1, 'start'), (2, 'stop'), (3, 'stop')]}
+        queue.process(list(queue.pending.values()))
+        self.assertEqual(len(queue.pending), 0)
+        # the late start is dropped, both stops go to /sync/history in one request
+        self.assertEqual(self.client.post.call_count, 1)
+        endpoint, = self.client.post.call_args[0]
+        history = self.client.post.call_args[1]['json']
+        self.assertEqual(endpoint, '/sync/history')
+        self.assertEqual([episode['number'] for episode in history['shows'][0]['seasons'][0]['episodes']], [2, 3])
+        self.assertEqual(len(self.watched), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+from unittest import mock
+
+import requests
+
+from trakt_client import TraktClient
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class TraktClientRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.client = TraktClient(max_retries=3)
+        # a session set up front keeps get_session() from importing the API keys
+        self.client.session = mock.Mock()
+        patcher = mock.patch('time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def respond(self, *results):
+        self.client.session.request.side_effect = list(results)
+
+    def test_get_is_retried_after_server_errors_and_timeouts(self):
+        self.respond(FakeResponse(524), requests.Timeout('expected by the test'), FakeResponse(200))
+        with self.assertLogs('mpvTraktSync', 'WARNING'):
+            response = self.client.get('/search/show')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.session.request.call_count, 3)
+
+    def test_get_gives_up_after_max_retries(self):
+        self.respond(*[FakeResponse(502)] * 4)
+        with self.assertLogs('mpvTraktSync', 'WARNING'):
+            self.assertEqual(self.client.get('/search/show').status_code, 502)
+        self.assertEqual(self.client.session.request.call_count, 4)
+
+    def test_post_is_not_retried_after_server_errors(self):
+        self.respond(FakeResponse(524), FakeResponse(201))
+        self.assertEqual(self.client.post('/scrobble/stop').status_code, 524)
+        self.assertEqual(self.client.session.request.call_count, 1)
+
+    def test_post_is_not_retried_after_timeouts(self):
+        self.respond(requests.Timeout('expected by the test'), FakeResponse(201))
+        with self.assertRaises(requests.Timeout):
+            self.client.post('/scrobble/stop')
+        self.assertEqual(self.client.session.request.call_count, 1)
+
+    def test_post_is_retried_when_trakt_asks_for_it(self):
+        self.respond(FakeResponse(429, {'Retry-After': '2'}), FakeResponse(503, {'Retry-After': '1'}),
+                     FakeResponse(201))
+        with self.assertLogs('mpvTraktSync', 'WARNING'):
+            self.assertEqual(self.client.post('/scrobble/stop').status_code, 201)
+        self.assertEqual([call[0][0] for call in self.sleep.call_args_list], [2.0, 1.0])
+
+    def test_post_rate_limit_without_retry_after_is_not_retried(self):
+        self.respond(FakeResponse(429), FakeResponse(201))
+        self.assertEqual(self.client.post('/scrobble/stop').status_code, 429)
+
+
+if __name__ == '__main__':
+    unittest.main()
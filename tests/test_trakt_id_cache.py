@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import trakt_id_cache
+from trakt_id_cache import NOT_FOUND, TraktIdCache, normalize_title
+
+
+class TraktIdCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.now = 1000000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_cache(self, **kwargs):
+        cache = TraktIdCache(os.path.join(self.directory.name, 'trakt_ids.sqlite'), **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_normalize_title(self):
+        self.assertEqual(normalize_title('The.Office.(US)'), 'the office us')
+        self.assertEqual(normalize_title('Pokémon'), 'pokemon')
+
+    def test_put_and_get(self):
+        cache = self.create_cache()
+        cache.put('show', 'The Office (US)', 2005, 1)
+        cache.put('show', 'Unknown Show', None, None)
+        self.assertEqual(cache.get('show', 'the office us', 2005), 1)
+        self.assertIsNone(cache.get('show', 'The Office (US)', 2001))
+        self.assertIsNone(cache.get('movie', 'The Office (US)', 2005))
+        self.assertEqual(cache.get('show', 'Unknown Show'), NOT_FOUND)
+
+    def test_found_and_not_found_titles_expire(self):
+        cache = self.create_cache(ttl=100, negative_ttl=10)
+        cache.put('movie', 'Dune', 2021, 2)
+        cache.put('movie', 'Unknown Movie', None, NOT_FOUND)
+        self.now += 11
+        self.assertEqual(cache.get('movie', 'Dune', 2021), 2)
+        self.assertIsNone(cache.get('movie', 'Unknown Movie'))
+        self.now += 90
+        self.assertIsNone(cache.get('movie', 'Dune', 2021))
+        # a new search result replaces the expired entry
+        cache.put('movie', 'Dune', 2021, 3)
+        self.assertEqual(cache.get('movie', 'Dune', 2021), 3)
+        self.assertEqual(cache.entry_count, 2)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = self.create_cache(max_entries=2)
+        cache.put('show', 'A', None, 1)
+        self.now += 1
+        cache.put('show', 'B', None, 2)
+        self.now += trakt_id_cache.LAST_USED_RESOLUTION_SECONDS + 1
+        # using A makes B the least recently used entry
+        self.assertEqual(cache.get('show', 'A'), 1)
+        self.now += 1
+        cache.put('show', 'C', None, 3)
+        self.assertEqual(cache.get('show', 'A'), 1)
+        self.assertIsNone(cache.get('show', 'B'))
+        self.assertEqual(cache.get('show', 'C'), 3)
+        self.assertEqual(cache.entry_count, 2)
+
+    def test_legacy_json_is_migrated_once(self):
+        json_path = os.path.join(self.directory.name, 'trakt_ids.json')
+        with open(json_path, 'w') as file:
+            json.dump({'shows': {'the office us': 1, 'unknown show': 'n/a'}, 'movies': {'dune': 2}}, file)
+        with self.assertLogs('mpvTraktSync', 'INFO'):
+            cache = self.create_cache(legacy_json_path=json_path)
+        self.assertEqual(cache.get('show', 'The Office (US)'), 1)
+        self.assertEqual(cache.get('show', 'Unknown Show'), NOT_FOUND)
+        self.assertEqual(cache.get('movie', 'Dune'), 2)
+        self.assertEqual(cache.entry_count, 3)
+        cache.put('movie', 'Dune', None, 4)
+        cache.close()
+
+        with open(json_path, 'w') as file:
+            json.dump({'movies': {'dune': 5}}, file)
+        self.assertEqual(self.create_cache(legacy_json_path=json_path).get('movie', 'Dune'), 4)
+
+    def test_corrupt_legacy_json_is_skipped(self):
+        json_path = os.path.join(self.directory.name, 'trakt_ids.json')
+        with open(json_path, 'w') as file:
+            file.write('{"shows": ')
+        with self.assertLogs('mpvTraktSync', 'WARNING'):
+            cache = self.create_cache(legacy_json_path=json_path)
+        self.assertEqual(cache.entry_count, 0)
+
+    def test_search_results(self):
+        cache = self.create_cache(ttl=100)
+        candidates = [{'title': 'Dune', 'year': 2021, 'trakt': 2, 'score': 10.0}]
+        cache.put_search_results('movie', 'Dune', candidates)
+        self.assertEqual(cache.get_search_results('movie', 'dune'), candidates)
+        self.now += 101
+        self.assertIsNone(cache.get_search_results('movie', 'Dune'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+from trakt_ranking import choose_trakt_id, get_candidates, rank_candidates
+
+
+def create_result(kind, title, year, trakt_id, score):
+    return {'type': kind, 'score': score, kind: {'title': title, 'year': year, 'ids': {'trakt': trakt_id}}}
+
+
+class TraktRankingTest(unittest.TestCase):
+    def test_get_candidates_keeps_only_the_requested_kind(self):
+        results = [create_result('show', 'The Office', 2005, 1, 10.0),
+                   create_result('movie', 'The Office', 2005, 2, 9.0),
+                   {'type': 'show', 'score': 1.0}]
+        self.assertEqual(get_candidates(results, 'show'),
+                         [{'title': 'The Office', 'year': 2005, 'trakt': 1, 'score': 10.0}])
+
+    def test_exact_title_and_year_win(self):
+        candidates = get_candidates([create_result('show', 'The Office', 2001, 1, 10.0),
+                                     create_result('show', 'The Office', 2005, 2, 8.0)], 'show')
+        self.assertEqual(choose_trakt_id(candidates, {'title': 'the office', 'year': 2005}), 2)
+
+    def test_neighbouring_year_beats_a_distant_one(self):
+        candidates = get_candidates([create_result('movie', 'Dune', 1984, 1, 10.0),
+                                     create_result('movie', 'Dune', 2021, 2, 10.0)], 'movie')
+        self.assertEqual(choose_trakt_id(candidates, {'title': 'Dune', 'year': 2020}), 2)
+
+    def test_punctuation_and_case_are_ignored(self):
+        candidates = get_candidates([create_result('show', "Grey's Anatomy", 2005, 3, 5.0)], 'show')
+        self.assertEqual(choose_trakt_id(candidates, {'title': 'greys anatomy'}), 3)
+
+    def test_unrelated_titles_are_not_trusted(self):
+        candidates = get_candidates([create_result('show', 'Completely Different', 2005, 4, 10.0)], 'show')
+        self.assertIsNone(choose_trakt_id(candidates, {'title': 'Naruto', 'year': 2005}))
+
+    def test_abbreviated_titles_match_trakts_top_result(self):
+        candidates = get_candidates([create_result('show', 'Star Trek: The Next Generation', 1987, 1, 900.0),
+                                     create_result('show', 'Star Trek', 1966, 2, 400.0),
+                                     create_result('show', 'Star Trek: Picard', 2020, 3, 300.0)], 'show')
+        self.assertEqual(choose_trakt_id(candidates, {'title': 'Star Trek TNG'}), 1)
+        candidates = get_candidates([create_result('show', 'Law & Order: Special Victims Unit', 1999, 4, 800.0),
+                                     create_result('show', 'Law & Order', 1990, 5, 500.0)], 'show')
+        self.assertEqual(choose_trakt_id(candidates, {'title': 'Law and Order SVU'}), 4)
+
+    def test_only_result_is_chosen(self):
+        candidates = get_candidates([create_result('show', 'Star Trek: The Next Generation', 1987, 1, 0.0)], 'show')
+        self.assertEqual(choose_trakt_id(candidates, {'title': 'Star Trek TNG'}), 1)
+        candidates = get_candidates([create_result('show', 'Law & Order: Special Victims Unit', 1999, 4, 0.0)],
+                                    'show')
+        self.assertEqual(choose_trakt_id(candidates, {'title': 'Law and Order SVU'}), 4)
+
+    def test_exact_year_with_a_longer_title(self):
+        candidates = get_candidates([create_result('movie', 'Star Wars', 1977, 11, 900.0),
+                                     create_result('movie', 'Star Wars: The Last Jedi', 2017, 12, 400.0)], 'movie')
+        self.assertEqual(choose_trakt_id(candidates, {'title': 'Star Wars Episode IV A New Hope', 'year': 1977}), 11)
+
+    def test_top_result_with_another_year_is_not_trusted(self):
+        candidates = get_candidates([create_result('show', 'Star Trek: The Next Generation', 1987, 1, 900.0)], 'show')
+        self.assertIsNone(choose_trakt_id(candidates, {'title': 'Star Trek TNG', 'year': 2005}))
+
+    def test_no_candidates(self):
+        self.assertIsNone(choose_trakt_id([], {'title': 'Naruto'}))
+
+    def test_rank_is_sorted_and_between_0_and_1(self):
+        candidates = get_candidates([create_result('show', 'Show B', None, 1, 0.0),
+                                     create_result('show', 'Show', 2010, 2, 0.0)], 'show')
+        ranked = rank_candidates(candidates, {'title': 'Show', 'year': 2010})
+        scores = [score for score, _ in ranked]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertTrue(all(0.0 <= score <= 1.0 for score in scores))
+        self.assertEqual(ranked[0][1]['trakt'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
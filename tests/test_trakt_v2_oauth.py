@@ -0,0 +1,57 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from trakt_v2_oauth import TokenManager
+
+
+def create_tokens(access_token, age, expires_in=3600):
+    return {'access_token': access_token, 'refresh_token': 'refresh', 'created_at': time.time() - age,
+            'expires_in': expires_in}
+
+
+class TokenManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = TokenManager()
+        self.refreshes = []
+
+    def refresh(self):
+        # stands in for the POST to trakt, which takes a while
+        self.refreshes.append(threading.current_thread().name)
+        time.sleep(0.05)
+        self.manager.set_tokens(create_tokens('new', 0))
+
+    def test_valid_token_is_returned_without_refreshing(self):
+        self.manager.set_tokens(create_tokens('current', 60))
+        with mock.patch.object(self.manager, 'refresh', self.refresh):
+            self.assertEqual(self.manager.get_access_token(), 'current')
+        self.assertEqual(self.refreshes, [])
+
+    def test_expired_token_is_refreshed_once_for_concurrent_callers(self):
+        self.manager.set_tokens(create_tokens('expired', 7200))
+        access_tokens = []
+        threads = [threading.Thread(target=lambda: access_tokens.append(self.manager.get_access_token()))
+                   for _ in range(8)]
+        with mock.patch.object(self.manager, 'refresh', self.refresh), self.assertLogs('mpvTraktSync', 'INFO'):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(self.refreshes), 1)
+        self.assertEqual(access_tokens, ['new'] * 8)
+
+    def test_token_is_refreshed_in_the_background_before_it_expires(self):
+        # 80% of the lifetime passed
+        self.manager.set_tokens(create_tokens('old', 2880))
+        with mock.patch.object(self.manager, 'refresh', self.refresh):
+            self.manager.start()
+            deadline = time.time() + 2.0
+            while self.manager.tokens['access_token'] != 'new' and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.manager.get_access_token(), 'new')
+        self.assertEqual(self.refreshes, ['trakt-token'])
+
+
+if __name__ == '__main__':
+    unittest.main()
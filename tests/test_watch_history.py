@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from watch_history import WatchHistory
+
+
+def create_episode_data(show_id, season, episode):
+    return {'show': {'ids': {'trakt': show_id}}, 'episode': {'season': season, 'number': episode}}
+
+
+def create_history_entry(history_id, show_id, season, episode, watched_at):
+    return dict(create_episode_data(show_id, season, episode), id=history_id, watched_at=watched_at)
+
+
+class FakeResponse:
+    def __init__(self, data, page_count=1):
+        self.status_code = 200
+        self.data = data
+        self.headers = {'X-Pagination-Page-Count': str(page_count)}
+
+    def json(self):
+        return self.data
+
+
+# answers like trakt, from the plays in self.activities and self.history_pages
+class FakeTrakt:
+    def __init__(self):
+        self.activities = {'episodes': {'watched_at': '2024-01-01T00:00:00.000Z'},
+                           'movies': {'watched_at': '2024-01-01T00:00:00.000Z'}}
+        self.history_pages = {'episodes': [[]], 'movies': [[]]}
+        self.requests = []
+
+    def get(self, endpoint, params=None, access_token=None):
+        self.requests.append((endpoint, params))
+        if endpoint == '/sync/last_activities':
+            return FakeResponse(self.activities)
+        if endpoint == '/sync/watched/shows':
+            return FakeResponse([{'show': {'ids': {'trakt': 7}}, 'seasons': [
+                {'number': 1, 'episodes': [{'number': 1, 'plays': 1, 'last_watched_at': '2024-01-01'}]}]}])
+        if endpoint == '/sync/watched/movies':
+            return FakeResponse([{'movie': {'ids': {'trakt': 9}}, 'plays': 2, 'last_watched_at': '2023-12-01'}])
+        pages = self.history_pages[endpoint.rsplit('/', 1)[1]]
+        page = params.get('page', 1)
+        return FakeResponse(pages[page - 1] if page <= len(pages) else [], len(pages))
+
+
+class WatchHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'watch_history.sqlite')
+        self.trakt = FakeTrakt()
+        self.trakt.history_pages['episodes'] = [[create_history_entry(100, 7, 1, 1, '2024-01-01')]]
+        patcher = mock.patch('trakt_client.get_client', return_value=self.trakt)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.history = self.open_history()
+        with self.assertLogs('mpvTraktSync', 'INFO'):
+            self.history.sync('token')
+        self.trakt.requests = []
+
+    def open_history(self):
+        history = WatchHistory(self.path)
+        self.addCleanup(history.close)
+        return history
+
+    def test_full_download(self):
+        self.assertEqual(self.history.get_plays(create_episode_data(7, 1, 1)), 1)
+        self.assertEqual(self.history.get_plays({'movie': {'ids': {'trakt': 9}}}), 2)
+        self.assertEqual(self.history.get_plays(create_episode_data(7, 1, 2)), 0)
+        self.assertEqual(self.history.state['episodes_history_id'], '100')
+
+    def test_unchanged_activities_download_nothing_else(self):
+        self.history.sync('token')
+        self.assertEqual([endpoint for endpoint, _ in self.trakt.requests], ['/sync/last_activities'])
+
+    def test_new_plays_are_added_once(self):
+        # a play scrobbled by the daemon counts right away, and isn't counted again once it's downloaded
+        self.history.add_play(create_episode_data(7, 1, 2))
+        self.assertEqual(self.history.get_plays(create_episode_data(7, 1, 2)), 1)
+
+        self.trakt.activities['episodes']['watched_at'] = '2024-01-02T00:00:00.000Z'
+        self.trakt.history_pages['episodes'] = [
+            [create_history_entry(103, 7, 1, 2, '2024-01-02'), create_history_entry(102, 7, 1, 1, '2024-01-02')],
+            [create_history_entry(101, 7, 1, 1, '2024-01-01'), create_history_entry(100, 7, 1, 1, '2024-01-01')],
+            [create_history_entry(99, 7, 1, 1, '2023-12-01')]]
+        with self.assertLogs('mpvTraktSync', 'INFO'):
+            self.history.sync('token')
+        # the second page reached known plays, movies didn't change
+        self.assertEqual([(endpoint, (params or {}).get('page')) for endpoint, params in self.trakt.requests],
+                         [('/sync/last_activities', None), ('/sync/history/episodes', 1),
+                          ('/sync/history/episodes', 2)])
+        self.assertEqual(self.history.get_plays(create_episode_data(7, 1, 1)), 3)
+        self.assertEqual(self.history.get_plays(create_episode_data(7, 1, 2)), 1)
+        self.assertEqual(self.history.recent_plays, {})
+
+        # the deltas are persisted
+        history = self.open_history()
+        self.assertEqual(history.get_plays(create_episode_data(7, 1, 1)), 3)
+        self.assertEqual(history.episodes[(7, 1, 1)][1], '2024-01-02')
+        self.assertEqual(history.state['episodes_history_id'], '103')
+        self.assertEqual(history.state['episodes_watched_at'], '2024-01-02T00:00:00.000Z')
+
+    def test_complete_history_is_downloaded_again_after_a_while(self):
+        with mock.patch('time.time', return_value=float(self.history.state['full_sync_at']) + 8 * 24 * 60 * 60):
+            with self.assertLogs('mpvTraktSync', 'INFO'):
+                self.history.sync('token')
+        self.assertIn(('/sync/watched/shows', None), self.trakt.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+import email.utils
+import logging
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger('mpvTraktSync')
+
+TRAKT_API_URL = 'https://api.trakt.tv'
+
+# requests that can be sent twice without changing the outcome. Others, e.g. a POST that scrobbles or adds a play to
+# the history, may have reached trakt even if the response got lost, so sending them again could record a play twice.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+def is_transient_failure(status_code):
+    # 429: rate limit exceeded, 5xx: trakt or cloudflare is having issues, e.g. 524 for a timeout.
+    # TraktClient retries these, and callers keep scrobbles for later, if they persist.
+    return status_code == 429 or status_code >= 500
+
+
+def is_rejected_before_processing(response):
+    # trakt sends 429 and 503 with Retry-After when it refused the request without processing it
+    return response.status_code in (429, 503) and 'Retry-After' in response.headers
+
+
+# Spaces out calls of wait() from all threads to at most rate per second, e.g. to stay below trakt's rate limit of
+# 1000 GET requests per 5 minutes in bulk operations
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_until = max(self.next_time, now)
+            self.next_time = wait_until + self.interval
+        time.sleep(wait_until - now)
+
+
+# HTTP client for the trakt API. All requests share one requests.Session, so connections to api.trakt.tv are
+# pooled and kept alive, instead of doing a TCP and TLS handshake for every call.
+# requests takes a while to import, so the session is created on the first request or by warm_up().
+class TraktClient:
+    def __init__(self, base_url=TRAKT_API_URL, timeout=10.0, max_retries=3, max_backoff=60.0, pool_size=10):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.session = None
+        self.session_lock = threading.Lock()
+
+    def get_session(self):
+        with self.session_lock:
+            if self.session is None:
+                import requests
+                import requests.adapters
+
+                # the compiled API keys aren't needed to import this module, e.g. in the tests
+                import trakt_key_holder
+
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({'trakt-api-version': '2', 'trakt-api-key': trakt_key_holder.get_id()})
+                self.session = session
+            return self.session
+
+    def warm_up(self):
+        # run in the background after start-up, so the first scrobble doesn't wait for importing requests
+        self.get_session()
+
+    def get(self, endpoint, **kwargs):
+        return self.request('GET', endpoint, **kwargs)
+
+    def post(self, endpoint, **kwargs):
+        return self.request('POST', endpoint, **kwargs)
+
+    def request(self, method, endpoint, json=None, params=None, access_token=None):
+        # Retries failed connections, timeouts, rate limits and server errors of idempotent requests with exponential
+        # backoff. Other requests are only retried if trakt rejected them before processing, see IDEMPOTENT_METHODS.
+        # Raises requests.RequestException if the last attempt failed without a response.
+        import requests
+
+        session = self.get_session()
+        headers = {}
+        if access_token is not None:
+            headers['Authorization'] = 'Bearer ' + access_token
+
+        idempotent = method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                response = session.request(method, self.base_url + endpoint, json=json, params=params,
+                                           headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                self.record(method, endpoint, time.monotonic() - start, 'error')
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                delay = self.get_backoff(attempt)
+                log.warning('%s %s failed: %s. Retrying in %.1fs', method, endpoint, e, delay)
+            else:
+                self.record(method, endpoint, time.monotonic() - start, response.status_code)
+                if idempotent:
+                    retry = is_transient_failure(response.status_code)
+                else:
+                    retry = is_rejected_before_processing(response)
+                if not retry or attempt >= self.max_retries:
+                    return response
+                delay = self.get_retry_after(response)
+                if delay is None:
+                    delay = self.get_backoff(attempt)
+                log.warning('%s %s returned %d. Retrying in %.1fs', method, endpoint, response.status_code, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def get_backoff(self, attempt):
+        return min(2.0 ** attempt, self.max_backoff)
+
+    def get_retry_after(self, response):
+        # trakt sends Retry-After in seconds on 429. HTTP also allows a date.
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is None:
+            return None
+        try:
+            return min(max(float(retry_after), 0.0), self.max_backoff)
+        except ValueError:
+            pass
+        try:
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        return min(max(retry_date.timestamp() - time.time(), 0.0), self.max_backoff)
+
+    def record(self, method, endpoint, seconds, status):
+        metrics.trakt_request_seconds.observe(seconds, method, endpoint)
+        metrics.trakt_requests_total.inc(method, endpoint, str(status))
+        log.debug('%s %s: %s in %.3fs', method, endpoint, status, seconds)
+
+
+client = None
+client_lock = threading.Lock()
+
+
+def configure(config):
+    global client
+    with client_lock:
+        client = TraktClient(base_url=config.trakt_api_url,
+                             timeout=config.trakt_request_timeout_seconds,
+                             max_retries=config.trakt_max_retries)
+
+
+def get_client():
+    global client
+    with client_lock:
+        if client is None:
+            client = TraktClient()
+        return client
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import metrics
+
+log = logging.getLogger('mpvTraktSync')
+
+# cached value for titles, which trakt doesn't know
+NOT_FOUND = 'n/a'
+
+# last_used_at is only updated, if it is older than this, so cache hits don't cause a write each time
+LAST_USED_RESOLUTION_SECONDS = 60 * 60
+
+SCHEMA_VERSION = 1
+
+
+def normalize_title(title):
+    # 'The Office (US)', 'the office us' and 'The.Office.US' map to the same key
+    title = unicodedata.normalize('NFKD', title)
+    title = ''.join(char for char in title if not unicodedata.combining(char))
+    title = re.sub(r'[\W_]+', ' ', title.casefold())
+    return title.strip()
+
+
+# Index of (kind, normalized title, year) -> trakt id in a SQLite database.
+# Lookups are primary key lookups, so they don't depend on the size of the cache. Found ids expire after ttl
+# seconds and unknown titles after negative_ttl seconds, so titles added to trakt later are found eventually.
+# If the cache grows beyond max_entries, the least recently used entries are removed.
+class TraktIdCache:
+    def __init__(self, path, ttl=90 * 24 * 60 * 60, negative_ttl=24 * 60 * 60, max_entries=10000,
+                 legacy_json_path=None):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        # used by the sync workers and the main thread, self.lock serializes access
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS trakt_ids ('
+                                    'kind TEXT NOT NULL, '
+                                    'title TEXT NOT NULL, '
+                                    'year INTEGER NOT NULL, '  # 0 if unknown
+                                    'trakt_id INTEGER, '  # NULL if not found on trakt
+                                    'expires_at REAL NOT NULL, '
+                                    'last_used_at REAL NOT NULL, '
+                                    'PRIMARY KEY (kind, title, year))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS trakt_ids_last_used_at ON trakt_ids (last_used_at)')
+            # complete search results, so a title can be ranked again without searching trakt again
+            self.connection.execute('CREATE TABLE IF NOT EXISTS search_results ('
+                                    'kind TEXT NOT NULL, '
+                                    'query TEXT NOT NULL, '
+                                    'candidates TEXT NOT NULL, '
+                                    'expires_at REAL NOT NULL, '
+                                    'PRIMARY KEY (kind, query))')
+
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version < SCHEMA_VERSION:
+            if legacy_json_path is not None and os.path.isfile(legacy_json_path):
+                self.migrate_json(legacy_json_path)
+            self.connection.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+
+        self.entry_count = self.connection.execute('SELECT COUNT(*) FROM trakt_ids').fetchone()[0]
+
+    def migrate_json(self, json_path):
+        # trakt_ids.json of older versions: {'shows': {lowercase title: id or 'n/a'}, 'movies': {...}}
+        try:
+            with open(json_path) as file:
+                legacy_ids = json.load(file)
+        except ValueError as e:
+            log.warning('Not migrating corrupt trakt id cache %s: %s', json_path, e)
+            return
+        now = time.time()
+        rows = []
+        for section, kind in (('shows', 'show'), ('movies', 'movie')):
+            for title, trakt_id in legacy_ids.get(section, {}).items():
+                if trakt_id is None or trakt_id == NOT_FOUND:
+                    rows.append((kind, normalize_title(title), 0, None, now + self.negative_ttl, now))
+                else:
+                    rows.append((kind, normalize_title(title), 0, trakt_id, now + self.ttl, now))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO trakt_ids VALUES (?, ?, ?, ?, ?, ?)', rows)
+        log.info('Migrated %d trakt ids from %s', len(rows), json_path)
+
+    def get(self, kind, title, year=None):
+        # returns the trakt id, NOT_FOUND for titles unknown to trakt or None if not cached or expired
+        key = (kind, normalize_title(title), year or 0)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT trakt_id, expires_at, last_used_at FROM trakt_ids '
+                                          'WHERE kind = ? AND title = ? AND year = ?', key).fetchone()
+            if row is None:
+                metrics.trakt_id_cache_lookups_total.inc('miss')
+                return None
+            trakt_id, expires_at, last_used_at = row
+            if expires_at < now:
+                metrics.trakt_id_cache_lookups_total.inc('miss')
+                return None
+            if now - last_used_at > LAST_USED_RESOLUTION_SECONDS:
+                with self.connection:
+                    self.connection.execute('UPDATE trakt_ids SET last_used_at = ? '
+                                            'WHERE kind = ? AND title = ? AND year = ?', (now,) + key)
+        if trakt_id is None:
+            metrics.trakt_id_cache_lookups_total.inc('not_found')
+            return NOT_FOUND
+        metrics.trakt_id_cache_lookups_total.inc('hit')
+        return trakt_id
+
+    def put(self, kind, title, year, trakt_id):
+        key = (kind, normalize_title(title), year or 0)
+        now = time.time()
+        if trakt_id is None or trakt_id == NOT_FOUND:
+            values = (None, now + self.negative_ttl, now)
+        else:
+            values = (trakt_id, now + self.ttl, now)
+        with self.lock, self.connection:
+            updated = self.connection.execute('UPDATE trakt_ids SET trakt_id = ?, expires_at = ?, last_used_at = ? '
+                                              'WHERE kind = ? AND title = ? AND year = ?', values + key).rowcount
+            if updated == 0:
+                self.connection.execute('INSERT INTO trakt_ids VALUES (?, ?, ?, ?, ?, ?)', key + values)
+                self.entry_count += 1
+                if self.entry_count > self.max_entries:
+                    self.evict(self.entry_count - self.max_entries)
+
+    def get_search_results(self, kind, query):
+        # returns the cached candidates of a search, or None if not cached or expired
+        with self.lock:
+            row = self.connection.execute('SELECT candidates, expires_at FROM search_results '
+                                          'WHERE kind = ? AND query = ?', (kind, normalize_title(query))).fetchone()
+        if row is None or row[1] < time.time():
+            metrics.trakt_search_cache_lookups_total.inc('miss')
+            return None
+        metrics.trakt_search_cache_lookups_total.inc('hit')
+        return json.loads(row[0])
+
+    def put_search_results(self, kind, query, candidates):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM search_results WHERE expires_at < ?', (now,))
+            self.connection.execute('INSERT OR REPLACE INTO search_results VALUES (?, ?, ?, ?)',
+                                    (kind, normalize_title(query), json.dumps(candidates), now + self.ttl))
+
+    def evict(self, count):
+        # expects self.lock to be held
+        self.connection.execute('DELETE FROM trakt_ids WHERE rowid IN '
+                                '(SELECT rowid FROM trakt_ids ORDER BY last_used_at LIMIT ?)', (count,))
+        self.entry_count -= count
+        log.debug('Evicted %d least recently used trakt ids', count)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
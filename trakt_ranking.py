@@ -0,0 +1,85 @@
+import difflib
+
+from trakt_id_cache import normalize_title
+
+# the best candidate is chosen, if it scores at least this
+MIN_SCORE = 0.75
+
+# Otherwise trakt's top result is chosen, unless its year contradicts the guess or its title has hardly anything in
+# common with it. guessit titles are often abbreviated, e.g. 'Star Trek TNG', which trakt's search still finds.
+MIN_FALLBACK_TITLE_SIMILARITY = 0.3
+
+# weights of the parts of a score, they add up to 1. trakt's relevance order carries as much weight as an exact
+# year, so an abbreviated title doesn't lose against a shorter, more similar one, e.g. 'Star Trek'.
+TITLE_WEIGHT = 0.4
+YEAR_WEIGHT = 0.3
+RELEVANCE_WEIGHT = 0.3
+
+
+def get_candidates(results, kind):
+    # The parts of a trakt search response needed for ranking, small enough to be cached:
+    # [{'title': ..., 'year': ..., 'trakt': id, 'score': trakt's relevance}]
+    candidates = []
+    for result in results:
+        if result.get('type') != kind or kind not in result:
+            continue
+        item = result[kind]
+        candidates.append({'title': item.get('title') or '', 'year': item.get('year'),
+                           'trakt': item['ids']['trakt'], 'score': result.get('score') or 0.0})
+    return candidates
+
+
+def get_title_similarity(title, candidate_title):
+    title = normalize_title(title)
+    candidate_title = normalize_title(candidate_title)
+    if title == candidate_title:
+        return 1.0
+    return difflib.SequenceMatcher(None, title, candidate_title).ratio()
+
+
+def get_year_proximity(year, candidate_year):
+    if year is None:
+        # guessit found no year, any year is equally likely
+        return 0.5
+    if candidate_year is None:
+        return 0.25
+    difference = abs(year - candidate_year)
+    if difference == 0:
+        return 1.0
+    if difference == 1:
+        # release years differ between countries, and episodes of a season may span new year
+        return 0.5
+    return 0.0
+
+
+def rank_candidates(candidates, guess):
+    # Returns [(score, candidate)], best first. Scores are between 0 and 1.
+    max_relevance = max([candidate['score'] for candidate in candidates] + [0.0])
+    ranked = []
+    for position, candidate in enumerate(candidates):
+        if max_relevance > 0:
+            relevance = candidate['score'] / max_relevance
+        else:
+            # trakt returns its best matches first
+            relevance = 1.0 / (position + 1)
+        score = TITLE_WEIGHT * get_title_similarity(guess['title'], candidate['title']) \
+            + YEAR_WEIGHT * get_year_proximity(guess.get('year'), candidate['year']) \
+            + RELEVANCE_WEIGHT * relevance
+        ranked.append((score, candidate))
+    ranked.sort(key=lambda scored_candidate: -scored_candidate[0])
+    return ranked
+
+
+def choose_trakt_id(candidates, guess):
+    # the trakt id of the best candidate for guess, or None if no candidate is good enough
+    ranked = rank_candidates(candidates, guess)
+    if len(ranked) == 0:
+        return None
+    if ranked[0][0] >= MIN_SCORE:
+        return ranked[0][1]['trakt']
+    # trakt returns its best matches first
+    top_candidate = candidates[0]
+    if get_year_proximity(guess.get('year'), top_candidate['year']) > 0 \
+            and get_title_similarity(guess['title'], top_candidate['title']) >= MIN_FALLBACK_TITLE_SIMILARITY:
+        return top_candidate['trakt']
+    return None
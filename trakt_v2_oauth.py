@@ -2,55 +2,133 @@ import datetime
 import json
 import logging
 import sys
+import tempfile
+import threading
 import time
 
 import os
-import requests
 
-import trakt_key_holder
+import trakt_client
 
 log = logging.getLogger('mpvTraktSync')
 
 LOCAL_STORAGE_JSON_FILE = './trakt_token.json'
 
-
-def get_access_token():
-    if not os.path.isfile(LOCAL_STORAGE_JSON_FILE):
-        prompt_device_authentication()
-
-    tokens = json.load(open(LOCAL_STORAGE_JSON_FILE))
-
-    expire_date = datetime.datetime.utcfromtimestamp(
-        tokens['created_at'] + tokens['expires_in'])
-    remaining_time = expire_date - datetime.datetime.utcnow()
-
-    # make sure the token is at least valid for the next day
-    if remaining_time < datetime.timedelta(days=1):
-        log.info('Token expired')
-        token_refresh_request = requests.post('https://api.trakt.tv/oauth/token', json={
-            'refresh_token': tokens['refresh_token'],
+# the token is refreshed in the background, once less than this share of its lifetime is left
+REFRESH_AT_REMAINING_LIFETIME = 0.25
+
+# a failed background refresh is retried after this many seconds
+REFRESH_RETRY_SECONDS = 5 * 60
+
+
+def save_tokens(tokens):
+    # atomically, so a crash can't leave a truncated token file behind
+    directory = os.path.dirname(os.path.abspath(LOCAL_STORAGE_JSON_FILE))
+    file_descriptor, temp_path = tempfile.mkstemp(prefix='.trakt_token.', dir=directory)
+    with os.fdopen(file_descriptor, 'w') as file:
+        json.dump(tokens, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, LOCAL_STORAGE_JSON_FILE)
+
+
+def load_tokens():
+    with open(LOCAL_STORAGE_JSON_FILE) as file:
+        return json.load(file)
+
+
+# Keeps the trakt tokens in memory, so getting the access token needs neither disk access nor date math.
+# A background thread refreshes the token well before it expires. Only if it expired anyway, get_access_token()
+# refreshes it itself. A lock makes sure that concurrent callers never refresh twice.
+class TokenManager:
+    def __init__(self):
+        self.tokens = None
+        self.expires_at = None
+        self.refresh_at = None
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def get_access_token(self):
+        tokens = self.tokens
+        if tokens is not None and time.time() < self.expires_at:
+            return tokens['access_token']
+        with self.lock:
+            if self.tokens is None:
+                if not os.path.isfile(LOCAL_STORAGE_JSON_FILE):
+                    prompt_device_authentication()
+                self.set_tokens(load_tokens())
+                self.start()
+            if time.time() >= self.expires_at:
+                log.info('Token expired')
+                self.refresh()
+            return self.tokens['access_token']
+
+    def set_tokens(self, tokens):
+        with self.condition:
+            self.tokens = tokens
+            self.expires_at = tokens['created_at'] + tokens['expires_in']
+            self.refresh_at = self.expires_at - tokens['expires_in'] * REFRESH_AT_REMAINING_LIFETIME
+            self.condition.notify()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='trakt-token', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        import requests
+
+        while True:
+            with self.condition:
+                while time.time() < self.refresh_at:
+                    self.condition.wait(self.refresh_at - time.time())
+            with self.lock:
+                if time.time() < self.refresh_at:
+                    # refreshed by get_access_token() in the meantime
+                    continue
+                try:
+                    self.refresh()
+                except requests.RequestException as e:
+                    log.warning('Refreshing the trakt token failed, retrying in %ds: %s', REFRESH_RETRY_SECONDS, e)
+                    with self.condition:
+                        self.refresh_at = time.time() + REFRESH_RETRY_SECONDS
+
+    def refresh(self):
+        # expects self.lock to be held. Raises requests.RequestException if it failed.
+        import requests
+
+        import trakt_key_holder
+
+        token_refresh_request = trakt_client.get_client().post('/oauth/token', json={
+            'refresh_token': self.tokens['refresh_token'],
             'client_id': trakt_key_holder.get_id(),
             'client_secret': trakt_key_holder.get_secret(),
             'redirect_uri': 'urn:ietf:wg:oauth:2.0:oob',
             'grant_type': 'refresh_token'
         })
 
-        if token_refresh_request.status_code == 200:
-            log.info('Successfully refreshed token')
-            # save response to local json file
-            json.dump(token_refresh_request.json(),
-                      open(LOCAL_STORAGE_JSON_FILE, 'w'))
+        if token_refresh_request.status_code != 200:
+            raise requests.HTTPError('Refreshing token failed with http code %d.\n%s' %
+                                     (token_refresh_request.status_code, token_refresh_request.text),
+                                     response=token_refresh_request)
+        log.info('Successfully refreshed token')
+        tokens = token_refresh_request.json()
+        save_tokens(tokens)
+        self.set_tokens(tokens)
 
-            # reload new token
-            tokens = json.load(open(LOCAL_STORAGE_JSON_FILE))
-        else:
-            sys.exit('Refreshing token failed with http code %d.\n%s' %
-                     (token_refresh_request.status_code, token_refresh_request.text))
-    return tokens['access_token']
+
+token_manager = TokenManager()
+
+
+def get_access_token():
+    return token_manager.get_access_token()
 
 
 def prompt_device_authentication():
-    code_request = requests.post('https://api.trakt.tv/oauth/device/code', json={
+    # the compiled API keys are imported where they're needed, like in trakt_client
+    import trakt_key_holder
+
+    code_request = trakt_client.get_client().post('/oauth/device/code', json={
         'client_id': trakt_key_holder.get_id()
     })
 
@@ -63,14 +141,13 @@ def prompt_device_authentication():
 
         while datetime.datetime.now() - start_time < datetime.timedelta(seconds=code_json['expires_in']):
             time.sleep(code_json['interval'])
-            token_request = requests.post('https://api.trakt.tv/oauth/device/token', json={
+            token_request = trakt_client.get_client().post('/oauth/device/token', json={
                 'code': code_json['device_code'],
                 'client_id': trakt_key_holder.get_id(),
                 'client_secret': trakt_key_holder.get_secret()
             })
             if token_request.status_code == 200:
-                token_json = token_request.json()
-                json.dump(token_json, open(LOCAL_STORAGE_JSON_FILE, 'w'))
+                save_tokens(token_request.json())
                 log.info('\nSuccessfully established access to trakt account')
                 got_access_token = True
                 break
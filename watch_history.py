@@ -0,0 +1,195 @@
+import logging
+import sqlite3
+import threading
+import time
+
+import trakt_client
+
+log = logging.getLogger('mpvTraktSync')
+
+# the complete history is downloaded again after this many seconds, to pick up plays removed on trakt
+FULL_SYNC_SECONDS = 7 * 24 * 60 * 60
+
+HISTORY_PAGE_SIZE = 1000
+
+
+def get_key(data):
+    # ('movie', trakt id) or ('episode', show trakt id, season, episode) of trakt scrobble data, or None if it isn't a
+    # single item, e.g. for a file with several episodes
+    if 'movie' in data:
+        key = ('movie', data['movie']['ids']['trakt'])
+    else:
+        key = ('episode', data['show']['ids']['trakt'], data['episode']['season'], data['episode']['number'])
+    if not all(isinstance(part, int) and not isinstance(part, bool) for part in key[1:]):
+        return None
+    return key
+
+
+def get_json(endpoint, access_token, params=None):
+    # raises requests.RequestException, if trakt can't be reached or answers with an error
+    import requests
+
+    response = trakt_client.get_client().get(endpoint, params=params, access_token=access_token)
+    if response.status_code != 200:
+        raise requests.HTTPError('%s returned %d' % (endpoint, response.status_code), response=response)
+    return response
+
+
+# Local copy of the trakt watch history of the user.
+# Watched episodes and movies are kept in dicts keyed by trakt ids, so lookups are O(1), and persisted in SQLite.
+# sync() downloads the complete history once and afterwards only the plays since the last sync, if
+# /sync/last_activities says something changed.
+class WatchHistory:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.episodes = {}  # (show trakt id, season, episode) -> [plays, last watched at]
+        self.movies = {}  # movie trakt id -> [plays, last watched at]
+        self.state = {}  # e.g. 'episodes_watched_at' -> value of /sync/last_activities
+        # get_key() -> number of plays scrobbled by the daemon, that aren't in the downloaded history yet
+        self.recent_plays = {}
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS watched_episodes ('
+                                    'show_id INTEGER NOT NULL, '
+                                    'season INTEGER NOT NULL, '
+                                    'episode INTEGER NOT NULL, '
+                                    'plays INTEGER NOT NULL, '
+                                    'last_watched_at TEXT NOT NULL, '
+                                    'PRIMARY KEY (show_id, season, episode))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS watched_movies ('
+                                    'movie_id INTEGER PRIMARY KEY, '
+                                    'plays INTEGER NOT NULL, '
+                                    'last_watched_at TEXT NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sync_state ('
+                                    'key TEXT PRIMARY KEY, '
+                                    'value TEXT NOT NULL)')
+        for show_id, season, episode, plays, last_watched_at in \
+                self.connection.execute('SELECT * FROM watched_episodes'):
+            self.episodes[(show_id, season, episode)] = [plays, last_watched_at]
+        for movie_id, plays, last_watched_at in self.connection.execute('SELECT * FROM watched_movies'):
+            self.movies[movie_id] = [plays, last_watched_at]
+        self.state = dict(self.connection.execute('SELECT key, value FROM sync_state'))
+        log.debug('Watch history: %d episodes, %d movies', len(self.episodes), len(self.movies))
+
+    def get_plays(self, data):
+        # number of plays of the item of trakt scrobble data, 0 if not watched
+        key = get_key(data)
+        if key is None:
+            return 0
+        with self.lock:
+            if key[0] == 'movie':
+                watch = self.movies.get(key[1])
+            else:
+                watch = self.episodes.get(key[1:])
+            return (0 if watch is None else watch[0]) + self.recent_plays.get(key, 0)
+
+    def add_play(self, data):
+        # a play the daemon scrobbled. It counts until the next sync downloads it from trakt.
+        key = get_key(data)
+        if key is not None:
+            with self.lock:
+                self.recent_plays[key] = self.recent_plays.get(key, 0) + 1
+
+    def is_watched(self, data):
+        return self.get_plays(data) > 0
+
+    def sync(self, access_token):
+        # Raises requests.RequestException, if trakt can't be reached. The index stays as it was then.
+        activities = get_json('/sync/last_activities', access_token).json()
+        episodes_watched_at = activities['episodes']['watched_at']
+        movies_watched_at = activities['movies']['watched_at']
+        full_sync_at = float(self.state.get('full_sync_at', 0))
+        if time.time() - full_sync_at > FULL_SYNC_SECONDS:
+            self.download_all(access_token)
+        else:
+            if episodes_watched_at != self.state.get('episodes_watched_at'):
+                self.download_history('episodes', access_token)
+            if movies_watched_at != self.state.get('movies_watched_at'):
+                self.download_history('movies', access_token)
+        self.save_state({'episodes_watched_at': episodes_watched_at, 'movies_watched_at': movies_watched_at})
+
+    def download_all(self, access_token):
+        episodes = {}
+        for show in get_json('/sync/watched/shows', access_token).json():
+            show_id = show['show']['ids']['trakt']
+            for season in show.get('seasons', []):
+                for episode in season['episodes']:
+                    episodes[(show_id, season['number'], episode['number'])] = [episode['plays'],
+                                                                                episode['last_watched_at']]
+        movies = {}
+        for movie in get_json('/sync/watched/movies', access_token).json():
+            movies[movie['movie']['ids']['trakt']] = [movie['plays'], movie['last_watched_at']]
+        # the newest history entries, so later deltas start after them
+        newest_ids = {}
+        for kind in ('episodes', 'movies'):
+            history = get_json('/sync/history/' + kind, access_token, {'limit': 1}).json()
+            newest_ids[kind + '_history_id'] = str(history[0]['id']) if len(history) > 0 else '0'
+
+        with self.lock:
+            self.episodes = episodes
+            self.movies = movies
+            self.recent_plays = {}
+        with self.connection:
+            self.connection.execute('DELETE FROM watched_episodes')
+            self.connection.executemany('INSERT INTO watched_episodes VALUES (?, ?, ?, ?, ?)',
+                                        [key + tuple(watch) for key, watch in episodes.items()])
+            self.connection.execute('DELETE FROM watched_movies')
+            self.connection.executemany('INSERT INTO watched_movies VALUES (?, ?, ?)',
+                                        [(key,) + tuple(watch) for key, watch in movies.items()])
+        self.save_state(dict(newest_ids, full_sync_at=str(time.time())))
+        log.info('Downloaded watch history: %d episodes, %d movies', len(episodes), len(movies))
+
+    def download_history(self, kind, access_token):
+        # adds the plays since the last sync. History ids grow, so plays already counted are skipped.
+        last_history_id = int(self.state.get(kind + '_history_id', 0))
+        new_entries = []
+        page = 1
+        while True:
+            response = get_json('/sync/history/' + kind, access_token, {'page': page, 'limit': HISTORY_PAGE_SIZE})
+            entries = response.json()
+            new_entries.extend(entry for entry in entries if entry['id'] > last_history_id)
+            # history is newest first. Stop when reaching known entries or the last page.
+            if len(entries) == 0 or entries[-1]['id'] <= last_history_id \
+                    or page >= int(response.headers.get('X-Pagination-Page-Count', page)):
+                break
+            page += 1
+        if len(new_entries) == 0:
+            return
+
+        rows = []
+        with self.lock:
+            for entry in reversed(new_entries):
+                if kind == 'episodes':
+                    key = (entry['show']['ids']['trakt'], entry['episode']['season'], entry['episode']['number'])
+                    watch = self.episodes.setdefault(key, [0, entry['watched_at']])
+                    recent_key = ('episode',) + key
+                else:
+                    key = (entry['movie']['ids']['trakt'],)
+                    watch = self.movies.setdefault(key[0], [0, entry['watched_at']])
+                    recent_key = ('movie',) + key
+                # the play is in the downloaded history now
+                if self.recent_plays.get(recent_key, 0) > 1:
+                    self.recent_plays[recent_key] -= 1
+                else:
+                    self.recent_plays.pop(recent_key, None)
+                watch[0] += 1
+                watch[1] = max(watch[1], entry['watched_at'])
+                rows.append(key + tuple(watch))
+        with self.connection:
+            if kind == 'episodes':
+                self.connection.executemany('INSERT OR REPLACE INTO watched_episodes VALUES (?, ?, ?, ?, ?)', rows)
+            else:
+                self.connection.executemany('INSERT OR REPLACE INTO watched_movies VALUES (?, ?, ?)', rows)
+        self.save_state({kind + '_history_id': str(max(entry['id'] for entry in new_entries))})
+        log.info('Added %d new plays of %s to the watch history', len(new_entries), kind)
+
+    def save_state(self, values):
+        self.state.update(values)
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', values.items())
+
+    def close(self):
+        with self.lock:
+            self.connection.close()